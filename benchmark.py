@@ -0,0 +1,200 @@
+"""
+Бенчмарк пайплайна без расхода квоты: синтетическая новелла + локальная имитация LLM.
+Запускает run_pipeline() во временной папке и печатает главы в минуту, запросы и токены промпта на главу,
+время по фазам. Настройки config можно переопределить, чтобы сравнивать планирование и промпты:
+
+    python benchmark.py --chapters 30 --latency 0.2 --set MAX_CONCURRENT_CHAPTERS=4 --set PACKING_ENABLED=True
+
+С --faults подмешиваются сбои API, а в отчет добавляется статистика повторов (потерянное время, лишние запросы,
+задержка восстановления):
+
+    python benchmark.py --faults rate_limit=0.1,timeout=0.05,empty=0.05,truncated=0.05
+
+Квоты RATE_LIMIT_RPM/RATE_LIMIT_TPM для имитации по умолчанию сняты (иначе время измеряет ограничитель, а не пайплайн);
+чтобы проверить работу с настоящими квотами, задайте их явно: --set RATE_LIMIT_RPM=30
+"""
+import os
+import ast
+import json
+import random
+import shutil
+import argparse
+import tempfile
+
+import config
+from utils.fault_injection import FaultInjectingClient
+
+# Квоты имитации по умолчанию: фактически без ограничения скорости
+MOCK_RATE_LIMIT_RPM = 1000000
+MOCK_RATE_LIMIT_TPM = 10 ** 12
+# Предупреждать, если ожидание ограничителя занимает больше этой доли времени пайплайна
+LIMITER_WARNING_FRACTION = 0.3
+
+CHINESE_CHARS = "的一是了我不人在他有这个上们来到时大地为子中你说生国年着就那和要她出也得里后自以会家可下而过天去能对小多然于心学么之都好看起发当没成只如事把还用第样道想作种开美总从无情己面最女但现前些所同日手又行意动方期它头经长儿回位分爱老因很给名法间斯知世什两次使身者被高已亲其进此话常与活正感"
+NAMES = ("林远", "苏晴", "王老", "青云宗", "玄天剑", "赵无极", "夜城", "白衣人")
+
+
+def redirect_data_paths(data_dir):
+    """Переносит все рабочие пути config в data_dir (до импорта модулей фаз - они читают пути при импорте)."""
+    config.DATA_DIR = data_dir
+    config.INPUT_DIR = os.path.join(data_dir, 'input')
+    config.ORIGINAL_CHAPTERS_DIR = os.path.join(data_dir, 'chapters_original_cn')
+    config.TRANSLATED_CHAPTERS_DIR = os.path.join(data_dir, 'chapters_translated_ru')
+    config.TRANSLATED_CHAPTERS_WITH_TITLES_DIR = os.path.join(data_dir, 'chapters_translated_ru_with_titles')
+    config.OUTPUT_DIR = os.path.join(data_dir, 'output')
+    config.LOG_DIR = os.path.join(data_dir, 'logs')
+    config.LOG_FILE = os.path.join(config.LOG_DIR, 'translation.log')
+    config.GLOSSARY_FILE = os.path.join(data_dir, 'glossary.json')
+    config.CHECKPOINT_DIR = os.path.join(data_dir, 'checkpoints')
+    config.RESPONSE_CACHE_FILE = os.path.join(data_dir, 'api_cache.sqlite')
+    config.USAGE_LEDGER_FILE = os.path.join(data_dir, 'usage_ledger.sqlite')
+    config.TOKEN_CALIBRATION_FILE = os.path.join(data_dir, 'token_calibration.json')
+    config.CHAPTER_MANIFEST_FILE = os.path.join(data_dir, 'chapter_manifest.sqlite')
+    config.SUMMARY_FILE = os.path.join(data_dir, 'summaries.sqlite')
+    config.JOB_QUEUE_FILE = os.path.join(data_dir, 'job_queue.sqlite')
+    config.TITLE_TRANSLATIONS_FILE = os.path.join(data_dir, 'chapter_titles.json')
+    config.CHROMA_DB_PATH = os.path.join(data_dir, 'chroma_db')
+    config.INPUT_NOVEL_FILE = os.path.join(config.INPUT_DIR, 'synthetic_novel.txt')
+
+
+def generate_synthetic_novel(path, num_chapters, chapter_chars, seed):
+    """Пишет новеллу из num_chapters глав по ~chapter_chars иероглифов с повторяющимися именами (для глоссария)."""
+    rng = random.Random(seed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding=config.INPUT_FILE_ENCODING) as f:
+        for chapter in range(1, num_chapters + 1):
+            f.write(f"## 第{chapter}章 {''.join(rng.choice(CHINESE_CHARS) for _ in range(4))}\n")
+            written = 0
+            while written < chapter_chars:
+                sentence = "".join(rng.choice(CHINESE_CHARS) for _ in range(rng.randint(8, 30)))
+                paragraph = "，".join([rng.choice(NAMES) + sentence for _ in range(rng.randint(2, 5))]) + "。"
+                f.write(paragraph + "\n\n")
+                written += len(paragraph)
+
+
+def parse_override(item):
+    """'КЛЮЧ=значение' -> (ключ, значение); значение разбирается как литерал Python, иначе строка."""
+    key, _, value = item.partition('=')
+    try:
+        return key.strip(), ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return key.strip(), value
+
+
+def parse_fault_rates(value):
+    """'rate_limit=0.1,timeout=0.05' -> {'rate_limit': 0.1, 'timeout': 0.05}"""
+    rates = {}
+    for item in value.split(','):
+        if item.strip():
+            kind, _, rate = item.partition('=')
+            rates[kind.strip()] = float(rate)
+    return rates
+
+
+def collect_mock_stats(client):
+    """Суммирует статистику имитаций LLM (клиент может быть маршрутизатором или оберткой со сбоями)."""
+    if isinstance(client, FaultInjectingClient):
+        client = client.client
+    clients = [backend.client for backend in client.backends] if hasattr(client, 'backends') else [client]
+    totals = {}
+    for mock_client in clients:
+        if not hasattr(mock_client, 'stats'):
+            continue
+        for kind, stats in mock_client.stats().items():
+            kind_totals = totals.setdefault(kind, {"requests": 0, "prompt_tokens": 0, "output_tokens": 0})
+            for key, value in stats.items():
+                kind_totals[key] += value
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк пайплайна на синтетической новелле с имитацией LLM.")
+    parser.add_argument('--chapters', type=int, default=20, help="Число глав синтетической новеллы")
+    parser.add_argument('--chapter-chars', type=int, default=2000, help="Примерная длина главы в иероглифах")
+    parser.add_argument('--latency', type=float, default=0.2, help="Фиксированная задержка ответа имитации, сек")
+    parser.add_argument('--prompt-tps', type=float, default=20000, help="Скорость обработки промпта, токенов/сек")
+    parser.add_argument('--output-tps', type=float, default=500, help="Скорость генерации ответа, токенов/сек")
+    parser.add_argument('--seed', type=int, default=0, help="Seed новеллы и ответов имитации")
+    parser.add_argument('--faults', type=parse_fault_rates, default={}, metavar='ВИД=ДОЛЯ,...',
+                        help="Подмешивать сбои API: rate_limit, timeout, empty, blocked, truncated, error")
+    parser.add_argument('--set', action='append', default=[], metavar='КЛЮЧ=ЗНАЧЕНИЕ', help="Переопределить настройку config")
+    parser.add_argument('--work-dir', help="Рабочая папка (по умолчанию временная, удаляется после запуска)")
+    parser.add_argument('--json', help="Сохранить отчет в JSON")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="novel_benchmark_")
+    redirect_data_paths(work_dir)
+    config.MOCK_LLM_ENABLED = True
+    config.MOCK_LLM_LATENCY = args.latency
+    config.MOCK_LLM_PROMPT_TOKENS_PER_SECOND = args.prompt_tps
+    config.MOCK_LLM_OUTPUT_TOKENS_PER_SECOND = args.output_tps
+    config.MOCK_LLM_SEED = args.seed
+    config.RAG_ENABLED = False # Эмбеддинги не относятся к API; включается через --set RAG_ENABLED=True
+    config.FAULT_INJECTION_RATES = args.faults
+    config.RATE_LIMIT_RPM = MOCK_RATE_LIMIT_RPM
+    config.RATE_LIMIT_TPM = MOCK_RATE_LIMIT_TPM
+    overrides = dict(parse_override(item) for item in args.set)
+    for key, value in overrides.items():
+        setattr(config, key, value)
+    generate_synthetic_novel(config.INPUT_NOVEL_FILE, args.chapters, args.chapter_chars, args.seed)
+
+    # Модули фаз импортируются после настройки config
+    import main as pipeline
+    import phase2_translate
+    phase2_translate.setup_logging()
+
+    phase_times = pipeline.run_pipeline()
+    translated = len([f for f in os.listdir(config.TRANSLATED_CHAPTERS_DIR) if f.endswith('_ru.txt')]) if os.path.exists(config.TRANSLATED_CHAPTERS_DIR) else 0
+    chapters_total = len(os.listdir(config.ORIGINAL_CHAPTERS_DIR))
+    mock_stats = collect_mock_stats(phase2_translate.get_client())
+    requests_total = sum(stats["requests"] for stats in mock_stats.values())
+    prompt_tokens_total = sum(stats["prompt_tokens"] for stats in mock_stats.values())
+    phase2_seconds = phase_times.get('phase2', 0.0)
+
+    report = {
+        "chapters": chapters_total,
+        "translated": translated,
+        "chapters_per_minute": translated / phase2_seconds * 60 if phase2_seconds else 0.0,
+        "requests_per_chapter": requests_total / translated if translated else 0.0,
+        "prompt_tokens_per_chapter": prompt_tokens_total / translated if translated else 0.0,
+        "phase_seconds": phase_times,
+        "requests_by_kind": mock_stats,
+        "retries": phase2_translate.retry_stats.summary(),
+        "overrides": overrides,
+    }
+    if isinstance(phase2_translate.get_client(), FaultInjectingClient):
+        report["faults"] = phase2_translate.get_client().stats()
+    print("\n=== Бенчмарк пайплайна (имитация LLM) ===")
+    print(f"Глав переведено: {translated}/{chapters_total}")
+    print(f"Глав в минуту (Фаза 2): {report['chapters_per_minute']:.1f}")
+    print(f"Запросов на главу: {report['requests_per_chapter']:.2f}")
+    print(f"Токенов промпта на главу: {report['prompt_tokens_per_chapter']:.0f}")
+    print("Время по фазам: " + ", ".join(f"{name} {seconds:.1f} с" for name, seconds in phase_times.items()))
+    for kind, stats in sorted(mock_stats.items()):
+        print(f"  {kind}: запросов {stats['requests']}, токенов промпта {stats['prompt_tokens']}, ответа {stats['output_tokens']}")
+    if "faults" in report:
+        retries = report["retries"]
+        print(f"Подмешано сбоев: {report['faults']['injected']} на {report['faults']['requests']} запросов")
+        print(f"Сбои по видам (зафиксировано): {retries['failures']}")
+        print(f"Лишних запросов: {retries['wasted_requests']} (ответов с браком {retries['rejected_responses']})")
+        print(f"Потеряно на паузах: {retries['backoff_seconds']:.1f} с, ожидание ограничителя: {retries['limiter_wait_seconds']:.1f} с")
+        print(f"Восстановление после сбоя: в среднем {retries['recovery_mean_seconds']:.1f} с, макс. {retries['recovery_max_seconds']:.1f} с "
+              f"({retries['recovered_calls']} вызовов), неудачных вызовов: {retries['failed_calls']}")
+    # Ожидание суммируется по потокам: делим на число параллельных глав
+    total_seconds = phase_times.get('total', 0.0)
+    limiter_share = report["retries"]["limiter_wait_seconds"] / max(1, config.MAX_CONCURRENT_CHAPTERS) / total_seconds if total_seconds else 0.0
+    if limiter_share > LIMITER_WARNING_FRACTION:
+        print(f"\n!!! ВНИМАНИЕ: ожидание ограничителя скорости - {limiter_share:.0%} времени пайплайна "
+              f"(RATE_LIMIT_RPM={config.RATE_LIMIT_RPM}, RATE_LIMIT_TPM={config.RATE_LIMIT_TPM}). "
+              f"Результат измеряет квоту, а не пайплайн. !!!")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Отчет сохранен: {args.json}")
+
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,22 @@ OUTPUT_DIR = os.path.join(DATA_DIR, 'output')
 LOG_DIR = os.path.join(DATA_DIR, 'logs')
 GLOSSARY_FILE = os.path.join(DATA_DIR, 'glossary.json')
 LOG_FILE = os.path.join(LOG_DIR, 'translation.log')
+# Чекпойнты первого прохода (ответ P1 и кандидаты в глоссарий) по главам
+CHECKPOINT_DIR = os.path.join(DATA_DIR, 'checkpoints')
+# Манифест состояния глав (статус перевода, индексация RAG): возобновление без чтения переведенных глав
+CHAPTER_MANIFEST_ENABLED = True
+CHAPTER_MANIFEST_FILE = os.path.join(DATA_DIR, 'chapter_manifest.sqlite')
+# Очередь глав для нескольких процессов (или машин с общей папкой data): каждый процесс берет главы в аренду,
+# поэтому одну главу не переводят дважды. Запустите python main.py в нескольких процессах; состояние: python job_status.py
+JOB_QUEUE_ENABLED = False
+JOB_QUEUE_FILE = os.path.join(DATA_DIR, 'job_queue.sqlite')
+# Идентификатор процесса в очереди ('' - имя хоста и PID)
+JOB_WORKER_ID = ''
+# Срок аренды главы и интервал ее продления (сек.): аренда упавшего процесса истекает и глава переходит к другому
+JOB_LEASE_SECONDS = 300
+JOB_HEARTBEAT_SECONDS = 60
+# Сколько раз глава с ошибкой (API или брак) берется в работу повторно
+JOB_MAX_ATTEMPTS = 3
 
 # Имя входного файла новеллы (должен лежать в data/input/)
 INPUT_NOVEL_FILENAME = 'Найденная_ночь_Полностью_00ksw_Selenium.txt'
@@ -33,8 +49,93 @@ MODEL_NAME = "gemini-2.5-flash-preview-04-17"
 API_TIMEOUT = 300  # 5 минут
 # Максимальное количество повторных попыток при ошибках API
 MAX_RETRIES = 3
-# Задержка между успешными запросами к API в секундах
-DELAY_BETWEEN_REQUESTS = 1.5
+# Сколько глав переводится одновременно (1 = последовательно, как раньше)
+MAX_CONCURRENT_CHAPTERS = 1
+
+# --- Ограничение скорости запросов (общий token bucket с AIMD) ---
+# Квоты модели: запросов в минуту и токенов (промпт + ответ, примерно) в минуту
+RATE_LIMIT_RPM = 30
+RATE_LIMIT_TPM = 1000000
+# Сколько запросов можно отправить сразу при запуске, не дожидаясь пополнения ведра
+# (None - по одному на каждую параллельную главу; в любом случае не больше RPM)
+RATE_LIMIT_INITIAL_BURST = None
+# Во сколько раз снижать скорость после ответа 429
+RATE_LIMIT_DECREASE_FACTOR = 0.5
+# После скольких успешных запросов подряд повышать скорость и на какую долю лимита
+RATE_LIMIT_INCREASE_AFTER = 10
+RATE_LIMIT_INCREASE_STEP = 0.05
+# Нижняя граница скорости (доля от лимита)
+RATE_LIMIT_MIN_FRACTION = 0.1
+# Общая пауза после 429 в секундах и случайный разброс пауз (доля)
+RATE_LIMIT_COOLDOWN = 5.0
+RATE_LIMIT_JITTER = 0.2
+
+# --- Бэкенды LLM и маршрутизация запросов ---
+# Ключи других провайдеров с OpenAI-совместимым API (файл .env)
+OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
+CHUTES_API_TOKEN = os.getenv('CHUTES_API_TOKEN')
+# Распределять запросы между несколькими провайдерами/ключами (False - только Gemini, как раньше)
+LLM_ROUTER_ENABLED = False
+# Бэкенды маршрутизатора, у каждого своя квота rpm/tpm (общий лимит RATE_LIMIT_* тогда = сумме квот).
+# type 'gemini' - клиент google.generativeai с GOOGLE_API_KEY;
+# type 'openai' - OpenAI-совместимый HTTP API. В api_key можно перечислить несколько ключей через запятую.
+# Дополнительные ключи Gemini подключаются как 'openai' с base_url https://generativelanguage.googleapis.com/v1beta/openai
+# Бэкенды без ключа пропускаются. Кэш контекста 'gemini' работает только через бэкенд 'gemini'.
+LLM_BACKENDS = [
+    {"name": "gemini", "type": "gemini", "rpm": RATE_LIMIT_RPM, "tpm": RATE_LIMIT_TPM},
+    {"name": "openrouter", "type": "openai", "base_url": "https://openrouter.ai/api/v1",
+     "api_key": OPENROUTER_API_KEY, "model": "google/gemini-2.5-flash", "rpm": 20, "tpm": 1000000},
+    {"name": "chutes", "type": "openai", "base_url": "https://llm.chutes.ai/v1",
+     "api_key": CHUTES_API_TOKEN, "model": "deepseek-ai/DeepSeek-V3-0324", "rpm": 20, "tpm": 1000000},
+]
+
+# --- Локальная имитация LLM ---
+# Вместо Gemini используется детерминированная заглушка (benchmark.py, проверки без расхода квоты)
+MOCK_LLM_ENABLED = False
+# Время ответа: фиксированная задержка (сек) + обработка промпта и генерация ответа (токенов в секунду)
+MOCK_LLM_LATENCY = 0.5
+MOCK_LLM_PROMPT_TOKENS_PER_SECOND = 20000
+MOCK_LLM_OUTPUT_TOKENS_PER_SECOND = 200
+MOCK_LLM_SEED = 0
+
+# --- Подмешивание сбоев API (проверка и настройка логики повторов) ---
+# Вероятности сбоев на запрос: 'rate_limit' (429), 'timeout', 'empty' (пустой ответ),
+# 'blocked' (ответ заблокирован), 'truncated' (обрезанный ответ), 'error' (непредвиденная ошибка).
+# Пустой словарь - сбои не подмешиваются. Пример: {"rate_limit": 0.1, "timeout": 0.05}
+FAULT_INJECTION_RATES = {}
+# Сколько секунд "висит" запрос перед подмешанным таймаутом и какая доля ответа остается при обрезке
+FAULT_INJECTION_TIMEOUT_DELAY = 1.0
+FAULT_INJECTION_TRUNCATE_FRACTION = 0.3
+FAULT_INJECTION_SEED = 0
+
+# --- Кэш ответов API ---
+# Повторные одинаковые запросы (после сбоя, очистки брака, пересборки названий) берутся из кэша
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_FILE = os.path.join(DATA_DIR, 'api_cache.sqlite')
+# Максимальный размер кэша в МБ (старые записи вытесняются)
+RESPONSE_CACHE_MAX_MB = 500
+
+# --- Журнал расхода квоты API ---
+# На каждую попытку запроса пишутся токены из usage_metadata ответа, время ответа, глава и проход
+# Сводка по главам и проходам: python usage_report.py
+USAGE_LEDGER_ENABLED = True
+USAGE_LEDGER_FILE = os.path.join(DATA_DIR, 'usage_ledger.sqlite')
+# Цены за миллион токенов по моделям ('*' - для остальных моделей); только для оценки стоимости в отчете
+USAGE_PRICES_PER_MILLION = {
+    '*': {'input': 0.30, 'cached_input': 0.075, 'output': 2.50},
+}
+
+# --- Кэш контекста на стороне провайдера ---
+# Стабильный префикс промпта (глоссарий и контекст главы) загружается один раз и переиспользуется в P1/P2
+# и повторах той же главы; между главами префикс разный (RAG-контекст и термины глоссария главы)
+# 'off' - выключено, 'gemini' - CachedContent Gemini API (не совместим с LLM_ROUTER_ENABLED, MOCK_LLM_ENABLED
+# и FAULT_INJECTION_RATES - тогда выключается), 'local' - локальная имитация для офлайн-проверки
+CONTEXT_CACHE_BACKEND = 'off'
+# Время жизни записи кэша в секундах и максимум одновременно хранимых записей
+CONTEXT_CACHE_TTL_SECONDS = 600
+CONTEXT_CACHE_MAX_ENTRIES = 8
+# Префиксы короче не кэшируются (у Gemini есть минимальный размер кэша)
+CONTEXT_CACHE_MIN_TOKENS = 4096
 
 # --- Настройки RAG (Retrieval-Augmented Generation) ---
 RAG_ENABLED = True
@@ -48,6 +149,10 @@ CHROMA_COLLECTION_NAME = "novel_chapters"
 RAG_NUM_RESULTS = 5
 # Стратегия разбиения глав на чанки для RAG
 RAG_CHUNK_STRATEGY = 'paragraph'
+# Индексация: фрагменты многих глав кодируются пакетами этого размера (одно кодирование и одна запись на пакет)
+RAG_EMBED_BATCH_SIZE = 256
+# Сколько прочитанных глав может ждать кодирования
+RAG_READ_AHEAD_CHAPTERS = 64
 
 TRANSLATED_CHAPTERS_WITH_TITLES_DIR = os.path.join(DATA_DIR, 'chapters_translated_ru_with_titles')
 
@@ -56,11 +161,98 @@ TRANSLATED_CHAPTERS_WITH_TITLES_DIR = os.path.join(DATA_DIR, 'chapters_translate
 MAX_PROMPT_TOKENS = 800000
 # Максимальное количество токенов из "хвоста" предыдущих глав (N-2, N-3...)
 PREVIOUS_CHUNK_TOKENS = 1000 # 0, чтобы отключить
+# Режим контекста предыдущих глав:
+# 'recent'  - полная N-1 и концы N-2/N-3 (как раньше)
+# 'summary' - накопленное краткое содержание истории, краткие содержания N-3..N-1 и конец N-1 (PREVIOUS_CHUNK_TOKENS);
+#             содержания создаются отдельными короткими запросами один раз на главу и хранятся в SUMMARY_FILE
+CONTEXT_MODE = 'recent'
+SUMMARY_FILE = os.path.join(DATA_DIR, 'summaries.sqlite')
+# Длина краткого содержания главы и всей истории (в словах)
+SUMMARY_CHAPTER_MAX_WORDS = 150
+SUMMARY_STORY_MAX_WORDS = 600
+# При первом включении режима содержание истории собирается не больше чем из стольких последних глав
+SUMMARY_STORY_CATCHUP_CHAPTERS = 20
+# Запас токенов в бюджете промпта: инструкции и рост глоссария между P1 и P2
+PROMPT_RESERVE_TOKENS = 2000
+# Сколько подсчетов токенов хранить в памяти (кэш по хэшу содержимого)
+TOKEN_CACHE_MAX_ENTRIES = 4096
+# Быстрая оценка токенов по классам символов (иероглифы, кириллица, латиница, пробелы) вместо кодирования tiktoken
+# Коэффициенты калибруются по prompt_token_count из ответов API и сохраняются в TOKEN_CALIBRATION_FILE
+TOKEN_ESTIMATOR_ENABLED = True
+TOKEN_CALIBRATION_FILE = os.path.join(DATA_DIR, 'token_calibration.json')
+# Вес начальных коэффициентов в калибровке (в числе наблюдений)
+TOKEN_CALIBRATION_PRIOR_SAMPLES = 20
+# Если оценка ближе этой доли к лимиту, промпт дополнительно кодируется tiktoken (берется большее значение)
+TOKEN_EXACT_MARGIN = 0.1
+# Передавать в промпт только термины глоссария, встречающиеся в главе и ее контексте
+GLOSSARY_FILTER_ENABLED = True
+# Режим первого прохода:
+# 'full'          - полный черновой перевод + кандидаты в глоссарий (как раньше)
+# 'glossary_only' - только извлечение кандидатов: короткий промпт и короткий ответ
+P1_MODE = 'full'
+# Лимит длины ответа P1 в режиме 'glossary_only'
+P1_GLOSSARY_MAX_OUTPUT_TOKENS = 2048
+# Принимать черновик P1 как финальный перевод (без P2), если P1 не добавил новых терминов
+# и черновик прошел проверку на брак. Работает только с P1_MODE = 'full'.
+SINGLE_PASS_IF_GLOSSARY_UNCHANGED = False
+
+# --- Перевод больших глав по сегментам ---
+# Главы длиннее SEGMENT_MAX_TOKENS делятся по абзацам на сегменты, которые переводятся параллельно
+SEGMENTATION_ENABLED = False
+SEGMENT_MAX_TOKENS = 8000
+# Сколько сегментов одной главы переводится одновременно
+MAX_CONCURRENT_SEGMENTS = 4
+
+# --- Пакетный перевод коротких глав ---
+# Подряд идущие короткие главы переводятся одним запросом на проход с разделителями глав
+PACKING_ENABLED = False
+# Глава считается короткой, если в ней не больше стольких токенов
+PACK_MAX_CHAPTER_TOKENS = 1500
+# Суммарный объем глав в одном пакете (токены) и максимальное число глав в пакете
+PACK_TOKEN_BUDGET = 6000
+PACK_MAX_CHAPTERS = 8
+
+# --- Потоковая генерация P2 ---
+# Перевод пишется в <глава>_ru.txt.part по мере генерации, явный брак прерывает генерацию
+# (выключено по умолчанию: не все бэкенды и прокси корректно отдают поток)
+STREAMING_ENABLED = False
+# Проверять долю иероглифов только после стольких видимых символов ответа
+STREAM_CHECK_MIN_CHARS = 500
+# Прерывать, если доля китайских иероглифов выше (заметно строже итоговой проверки - только явный брак)
+STREAM_ABORT_CHINESE_RATIO = 0.3
+# Прерывать, если столько символов подряд идут без разделения на абзацы
+STREAM_MAX_CHARS_WITHOUT_BREAK = 4000
 
 # --- Настройки Сборки EPUB ---
 EPUB_FILENAME = "Найденная_ночь_Перевод_Gemini.epub"
 EPUB_AUTHOR = "会说话的肘子"
 EPUB_LANGUAGE = "ru"
+# Переводы названий глав (при следующей сборке в API уходят только названия новых глав)
+TITLE_TRANSLATIONS_FILE = os.path.join(DATA_DIR, 'chapter_titles.json')
+
+# --- План перевода без запросов к API (python main.py --plan) ---
+# Сколько токенов ответа приходится на токен оригинала (перевод на русский длиннее китайского текста)
+PLAN_OUTPUT_TOKENS_PER_SOURCE_TOKEN = 1.2
+# Скорость генерации ответа, токенов/сек, и накладные расходы на запрос, сек.;
+# если в журнале расхода квоты уже есть данные, скорость берется из него
+PLAN_OUTPUT_TOKENS_PER_SECOND = 150
+PLAN_REQUEST_OVERHEAD_SECONDS = 2.0
+
+# --- Режим наблюдения (python main.py --watch) ---
+# Процесс не завершается: клиент API, токенизатор и RAG загружаются один раз, а при изменении файла новеллы
+# в data/input новые главы разделяются, индексируются, переводятся и добавляются в EPUB
+# Интервал проверки файла новеллы (сек.) и сколько секунд файл должен не меняться перед разделением
+WATCH_POLL_SECONDS = 30
+WATCH_SETTLE_SECONDS = 5
+
+# --- HTTP-сервис перевода фрагментов (python translation_server.py) ---
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+# Сколько фрагментов переводится одновременно и сколько запросов может ждать (сверх - ответ 503)
+SERVICE_MAX_CONCURRENT = 4
+SERVICE_MAX_QUEUE = 32
+# Максимальная длина фрагмента в запросе (символов)
+SERVICE_MAX_TEXT_CHARS = 50000
 
 # --- Прочее ---
 LOG_LEVEL = "INFO" # DEBUG, INFO, WARNING, ERROR, CRITICAL
\ No newline at end of file
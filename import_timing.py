@@ -0,0 +1,57 @@
+"""
+Время импорта модулей пайплайна: каждый модуль импортируется в отдельном процессе (холодный старт),
+показывается время импорта и какие тяжелые библиотеки при этом загрузились.
+
+    python import_timing.py
+    python import_timing.py --repeat 5 phase3_assemble main
+"""
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+DEFAULT_MODULES = ["config", "phase1_split", "phase3_assemble", "phase2_translate", "main", "usage_report", "job_status"]
+# Библиотеки, которые не должны загружаться без перевода (клиент API, токенизатор, RAG)
+HEAVY_MODULES = ["google.generativeai", "tiktoken", "chromadb", "sentence_transformers", "torch"]
+
+MEASURE_CODE = """
+import sys, json, time, warnings, logging
+warnings.filterwarnings("ignore")
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+logging.disable(logging.CRITICAL)
+print(json.dumps({{"seconds": elapsed, "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure(module):
+    """Импортирует модуль в новом интерпретаторе: (секунды, загруженные тяжелые библиотеки)."""
+    result = subprocess.run([sys.executable, "-c", MEASURE_CODE.format(module=module, heavy=HEAVY_MODULES)],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"код {result.returncode}")
+    data = json.loads(result.stdout.strip().splitlines()[-1])
+    return data["seconds"], data["heavy"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время холодного импорта модулей пайплайна.")
+    parser.add_argument('modules', nargs='*', default=DEFAULT_MODULES, help="Модули (по умолчанию - основные модули пайплайна)")
+    parser.add_argument('--repeat', type=int, default=3, help="Сколько раз измерять каждый модуль (берется медиана)")
+    args = parser.parse_args()
+
+    print(f"{'Модуль':<20} {'Медиана, с':>11} {'Мин., с':>9}  Тяжелые библиотеки")
+    for module in args.modules:
+        try:
+            runs = [measure(module) for _ in range(max(1, args.repeat))]
+        except RuntimeError as e:
+            print(f"{module:<20} ошибка импорта: {e}")
+            continue
+        seconds = [run[0] for run in runs]
+        print(f"{module:<20} {statistics.median(seconds):>11.3f} {min(seconds):>9.3f}  {', '.join(runs[-1][1]) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
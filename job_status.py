@@ -0,0 +1,41 @@
+"""
+Состояние очереди глав (config.JOB_QUEUE_FILE): число глав по состояниям и главы в аренде у процессов.
+
+    python job_status.py
+    python job_status.py --reset-failed
+"""
+import os
+import argparse
+
+import config
+from utils.job_queue import JobQueue
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Состояние очереди глав для нескольких процессов перевода.")
+    parser.add_argument('--queue', default=config.JOB_QUEUE_FILE, help="Файл очереди (SQLite)")
+    parser.add_argument('--reset-failed', action='store_true', help="Вернуть в очередь главы с исчерпанными попытками")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.queue):
+        print(f"Очередь не найдена: {args.queue}")
+        return
+    queue = JobQueue(args.queue, max_attempts=config.JOB_MAX_ATTEMPTS)
+    if args.reset_failed:
+        print(f"Возвращено в очередь глав: {queue.reset_failed()}")
+    counts, leased = queue.counts()
+    queue.close()
+
+    print("=== Главы по состояниям ===")
+    for state, count in sorted(counts.items()):
+        print(f"{state:<10} {count:>6}")
+    print(f"{'ИТОГО':<10} {sum(counts.values()):>6}")
+    print("\n=== Аренда по процессам ===")
+    if not leased:
+        print("Нет активных процессов.")
+    for worker, count in sorted(leased.items()):
+        print(f"{worker:<40} {count:>4}")
+
+
+if __name__ == "__main__":
+    main()
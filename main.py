@@ -1,33 +1,27 @@
 import os
+import json
 import time
 import logging
+import argparse
 import config # Наша конфигурация
 from phase1_split import split_novel_into_chapters
-from phase2_translate import translate_chapters
+from phase2_translate import translate_chapters, plan_translation, warm_up, setup_logging
 from phase3_assemble import assemble_epub
 from utils.file_utils import ensure_dir_exists
 
-# --- Настройка логирования ---
-log_file_path = config.LOG_FILE
-ensure_dir_exists(config.LOG_DIR)
-for handler in logging.root.handlers[:]: logging.root.removeHandler(handler)
-logging.basicConfig(
-    level=getattr(logging, config.LOG_LEVEL.upper(), logging.INFO),
-    format='%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file_path, encoding='utf-8', mode='a'),
-        logging.StreamHandler()
-    ]
-)
-
 def run_pipeline():
-    """Запускает последовательно все фазы обработки новеллы."""
+    """
+    Запускает последовательно все фазы обработки новеллы.
+    Возвращает время выполнения фаз в секундах: {'phase1': ..., 'phase2': ..., 'phase3': ..., 'total': ...}.
+    """
     start_time = time.time()
+    phase_times = {}
     logging.info("--- Запуск полного пайплайна перевода новеллы ---")
 
     # --- Фаза 1: Разделение на главы ---
     logging.info("--- Начало Фазы 1: Разделение на главы ---")
     success_phase1 = False
+    phase_start = time.time()
     try:
         ensure_dir_exists(config.ORIGINAL_CHAPTERS_DIR) # Убедимся, что папка для глав существует
         success_phase1 = split_novel_into_chapters() # Вызываем всегда
@@ -35,12 +29,15 @@ def run_pipeline():
             logging.info("--- Завершение Фазы 1: Разделение на главы успешно (или пропущено для существующих) ---")
         else:
             logging.error("--- Завершение Фазы 1: Разделение на главы с ошибкой ---")
-            return # Прерываем, если разделение не удалось
+            return phase_times # Прерываем, если разделение не удалось
     except Exception as e:
         logging.exception("Непредвиденная ошибка во время Фазы 1 (Разделение)")
-        return
+        return phase_times
+    finally:
+        phase_times['phase1'] = time.time() - phase_start
 
     # --- Фаза 2: Перевод глав ---
+    phase_start = time.time()
     if success_phase1:
         logging.info("--- Начало Фазы 2: Перевод глав ---")
         success_phase2 = False
@@ -55,10 +52,12 @@ def run_pipeline():
             logging.exception("Непредвиденная ошибка во время Фазы 2 (Перевод)")
     else:
          logging.error("Фаза 1 не была успешной, Фаза 2 пропускается.")
+    phase_times['phase2'] = time.time() - phase_start
 
 
     # --- Фаза 3: Сборка EPUB ---
     logging.info("--- Начало Фазы 3: Сборка EPUB ---")
+    phase_start = time.time()
     try:
         if not os.path.exists(config.TRANSLATED_CHAPTERS_DIR) or not os.listdir(config.TRANSLATED_CHAPTERS_DIR):
              logging.warning("Нет переведенных глав для сборки EPUB. Фаза 3 пропущена.")
@@ -71,13 +70,141 @@ def run_pipeline():
              logging.warning("Фаза 2 не была успешной или нет переведенных глав. Сборка EPUB пропущена.")
     except Exception as e:
         logging.exception("Ошибка во время Фазы 3 (Сборка EPUB)")
+    phase_times['phase3'] = time.time() - phase_start
 
     end_time = time.time()
     total_time = end_time - start_time
+    phase_times['total'] = total_time
     logging.info(f"--- Пайплайн завершен за {total_time:.2f} секунд ({total_time/60:.2f} минут) ---")
+    return phase_times
+
+def format_duration(seconds):
+    """Секунды -> 'Xд Yч Zм'."""
+    minutes = int(seconds // 60)
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    return (f"{days}д " if days else "") + (f"{hours}ч " if days or hours else "") + f"{minutes}м"
+
+
+def run_plan(json_path=None):
+    """
+    Режим плана: разделение на главы (Фаза 1) и оценка Фазы 2 без запросов к API -
+    ожидающие главы, запросы и токены по проходам, стоимость и время при настроенных лимитах.
+    """
+    ensure_dir_exists(config.ORIGINAL_CHAPTERS_DIR)
+    if not split_novel_into_chapters():
+        logging.error("Фаза 1 (разделение на главы) завершилась с ошибкой. План не построен.")
+        return None
+    plan = plan_translation()
+    print("\n=== План перевода (без запросов к API) ===")
+    print(f"Глав: {plan['chapters_total']}, ожидают перевода: {plan['chapters_pending']}")
+    print(f"{'Проход':<14} {'Запросов':>9} {'Токенов промпта':>16} {'Токенов ответа':>15}")
+    for pass_name, stats in plan["passes"].items():
+        print(f"{pass_name:<14} {stats['requests']:>9} {stats['prompt_tokens']:>16} {stats['output_tokens']:>15}")
+    print(f"{'ИТОГО':<14} {plan['requests']:>9} {plan['prompt_tokens']:>16} {plan['output_tokens']:>15}")
+    print(f"Оценка стоимости: ${plan['cost']:.2f}")
+    wall_time = plan["wall_time"]; limits = plan["rate_limits"]
+    print(f"Лимиты: {limits['rpm']} RPM, {limits['tpm']} TPM, глав одновременно: {limits['max_concurrent_chapters']}")
+    print("Время по ограничениям: " + ", ".join(f"{name} {format_duration(seconds)}" for name, seconds in wall_time["bounds_seconds"].items()))
+    print(f"Ожидаемое время Фазы 2: {format_duration(wall_time['seconds'])} (ограничивает: {wall_time['bottleneck']})")
+    print("Не учтены: рост глоссария по ходу перевода, повторы после сбоев, попадания в кэш ответов и перевод названий.")
+    if json_path:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(plan, f, ensure_ascii=False, indent=2)
+        print(f"План сохранен: {json_path}")
+    return plan
+
+
+def list_original_chapters():
+    """Множество файлов оригинальных глав."""
+    try:
+        return {f for f in os.listdir(config.ORIGINAL_CHAPTERS_DIR) if f.endswith(".txt")}
+    except FileNotFoundError:
+        return set()
+
+
+def get_input_signature():
+    """
+    Снимок папки с исходными файлами (config.INPUT_DIR): отсортированные (имя, время изменения, размер)
+    для каждого файла. None, если папки нет или она пуста.
+    """
+    try:
+        entries = [entry for entry in os.scandir(config.INPUT_DIR) if entry.is_file()]
+    except FileNotFoundError:
+        return None
+    signature = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except FileNotFoundError: # Файл удален между listdir и stat
+            continue
+        signature.append((entry.name, stat.st_mtime, stat.st_size))
+    return tuple(sorted(signature)) or None
+
+
+def run_watch_cycle(force=False):
+    """
+    Цикл режима наблюдения: разделение (пишутся только новые главы), перевод непереведенных глав
+    (новые главы индексируются в RAG в начале translate_chapters) и сборка EPUB (в API уходят только
+    названия новых глав). force - переводить и собирать, даже если новых глав нет. Возвращает новые главы.
+    """
+    chapters_before = list_original_chapters()
+    ensure_dir_exists(config.ORIGINAL_CHAPTERS_DIR)
+    if not split_novel_into_chapters():
+        logging.error("[Наблюдение] Фаза 1 (разделение на главы) завершилась с ошибкой.")
+        return []
+    new_chapters = sorted(list_original_chapters() - chapters_before)
+    if not new_chapters and not force:
+        logging.info("[Наблюдение] Файл новеллы изменился, но новых глав нет.")
+        return []
+    if new_chapters:
+        logging.info(f"[Наблюдение] Новых глав: {len(new_chapters)} ({new_chapters[0]} ... {new_chapters[-1]}).")
+    cycle_start = time.time()
+    if translate_chapters():
+        ensure_dir_exists(config.OUTPUT_DIR)
+        assemble_epub()
+    logging.info(f"[Наблюдение] Цикл завершен за {time.time() - cycle_start:.1f} с.")
+    return new_chapters
+
+
+def run_watch():
+    """
+    Режим наблюдения: ресурсы перевода загружаются один раз, затем папка с исходными файлами (INPUT_DIR) проверяется
+    каждые WATCH_POLL_SECONDS секунд; после изменения (и WATCH_SETTLE_SECONDS секунд без записи) новые главы
+    переводятся и добавляются в EPUB. Остановка - Ctrl+C.
+    """
+    logging.info(f"--- Режим наблюдения: {config.INPUT_DIR} (проверка каждые {config.WATCH_POLL_SECONDS} с) ---")
+    warm_start = time.time()
+    warm_up()
+    logging.info(f"[Наблюдение] Клиент API, токенизатор и RAG загружены за {time.time() - warm_start:.1f} с.")
+    last_signature = get_input_signature()
+    if last_signature:
+        run_watch_cycle(force=True)
+    try:
+        while True:
+            time.sleep(config.WATCH_POLL_SECONDS)
+            signature = get_input_signature()
+            if signature is None or signature == last_signature:
+                continue
+            # Файлы еще могут дописываться: ждем, пока папка перестанет меняться
+            time.sleep(config.WATCH_SETTLE_SECONDS)
+            if get_input_signature() != signature:
+                continue
+            last_signature = signature
+            run_watch_cycle()
+    except KeyboardInterrupt:
+        logging.info("[Наблюдение] Остановлено пользователем.")
+
 
 # --- Блок if __name__ == "__main__": ---
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пайплайн перевода китайской веб-новеллы на русский язык.")
+    parser.add_argument('--plan', action='store_true', help="Только оценить запросы, токены и время перевода (без запросов к API)")
+    parser.add_argument('--json', help="Сохранить план в JSON (с --plan)")
+    parser.add_argument('--watch', action='store_true', help="Не завершаться: переводить новые главы по мере появления в файле новеллы")
+    args = parser.parse_args()
+
+    setup_logging()
     ensure_dir_exists(config.DATA_DIR)
     ensure_dir_exists(config.INPUT_DIR)
     if not os.path.exists(config.GLOSSARY_FILE):
@@ -85,4 +212,9 @@ if __name__ == "__main__":
              with open(config.GLOSSARY_FILE, 'w', encoding='utf-8') as f: f.write("{\n}")
              logging.info(f"Создан пустой файл глоссария: {config.GLOSSARY_FILE}")
          except IOError as e: logging.error(f"Не удалось создать файл глоссария: {e}")
-    run_pipeline()
\ No newline at end of file
+    if args.plan:
+        run_plan(args.json)
+    elif args.watch:
+        run_watch()
+    else:
+        run_pipeline()
\ No newline at end of file
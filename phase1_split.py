@@ -4,20 +4,6 @@ import logging
 from utils.file_utils import sanitize_filename, ensure_dir_exists
 import config
 
-# Настройка логирования
-# ... (остается без изменений) ...
-log_file_path = config.LOG_FILE
-ensure_dir_exists(config.LOG_DIR)
-for handler in logging.root.handlers[:]: logging.root.removeHandler(handler)
-logging.basicConfig(
-    level=getattr(logging, config.LOG_LEVEL.upper(), logging.INFO),
-    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file_path, encoding='utf-8', mode='a'),
-        logging.StreamHandler()
-    ]
-)
-
 def split_novel_into_chapters():
     """
     Разделяет большой текстовый файл новеллы на отдельные файлы глав,
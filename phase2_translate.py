@@ -1,337 +1,506 @@
 import os
 import json
 import time
+import hashlib
 import logging
 import re
-import google.generativeai as genai
-from google.api_core import exceptions as google_exceptions
+from google.api_core import exceptions as google_exceptions 
 from collections import deque
-import tiktoken
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
 import config
-from utils.file_utils import ensure_dir_exists, save_glossary
+from utils.file_utils import ensure_dir_exists, save_glossary 
 from utils.rag_utils import initialize_rag, index_all_chapters, find_relevant_chunks
+from utils.rate_limiter import AdaptiveRateLimiter, UnlimitedRateLimiter
+from utils.response_cache import ResponseCache, make_cache_key
+from utils.token_utils import TokenCounter
+from utils.token_estimator import TokenEstimator
+from utils.glossary_matcher import GlossaryMatcher
+from utils.context_cache import GeminiContextCache, LocalContextCache
+from utils.llm_backends import create_backend_router, close_stream
+from utils.mock_backend import MockLLMBackend
+from utils.fault_injection import FaultInjectingClient
+from utils.retry_stats import RetryStats
+from utils.usage_ledger import UsageLedger, RETRY_PASS, get_usage_counts, estimate_cost
+from utils.summary_store import SummaryStore, KIND_CHAPTER, KIND_STORY
+from utils.chapter_manifest import ChapterManifest, STATUS_DONE, STATUS_EMPTY, STATUS_API_ERROR, STATUS_REJECTED
+from utils.job_queue import JobQueue
 
 # --- Настройка логирования ---
-log_file_path = config.LOG_FILE
-ensure_dir_exists(config.LOG_DIR)
-for handler in logging.root.handlers[:]:
-    logging.root.removeHandler(handler)
-logging.basicConfig(
-    level=getattr(logging, config.LOG_LEVEL.upper(), logging.INFO),
-    format='%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file_path, encoding='utf-8', mode='a'),
-        logging.StreamHandler()
-    ]
+def setup_logging():
+    """
+    Настраивает логирование в config.LOG_FILE и консоль. Вызывается точками входа (main.py, сервис перевода, бенчмарк),
+    а не при импорте: импорт модулей пайплайна не создает папок и файлов.
+    """
+    ensure_dir_exists(config.LOG_DIR)
+    # Закрываем предыдущие обработчики, если они есть
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+    logging.basicConfig(
+        level=getattr(logging, config.LOG_LEVEL.upper(), logging.INFO),
+        format='%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
+        handlers=[
+            logging.FileHandler(config.LOG_FILE, encoding='utf-8', mode='a'),
+            logging.StreamHandler()
+        ]
+    )
+
+# --- Ленивая инициализация тяжелых ресурсов ---
+# Клиент API (google.generativeai), токенизатор tiktoken и RAG (sentence-transformers, ChromaDB) создаются
+# при первом обращении (get_client, get_rate_limiter, get_token_counter, is_rag_ready), а не при импорте:
+# разделение на главы, сборка EPUB и служебные команды их не загружают.
+# Хранилища SQLite (кэш ответов, журнал квоты, манифест, очередь...) тоже открываются при первом обращении (get_*).
+init_lock = threading.RLock()
+client = None # Можно подменить до первого запроса (бенчмарк, проверки)
+client_initialized = False
+backend_router = None
+rate_limiter = None
+rate_limit_rpm, rate_limit_tpm = None, None
+token_counter = None
+RAG_INITIALIZED = None # None - RAG еще не инициализировался
+
+# Калиброванная оценка токенов по классам символов (tiktoken - только у границы бюджета)
+token_estimator = TokenEstimator(config.TOKEN_CALIBRATION_FILE, config.TOKEN_CALIBRATION_PRIOR_SAMPLES) if config.TOKEN_ESTIMATOR_ENABLED else None
+
+# Глоссарий общий для параллельно переводимых глав
+glossary_lock = threading.Lock()
+# Автомат поиска терминов глоссария в тексте (в промпт попадают только встреченные термины)
+glossary_matcher = GlossaryMatcher()
+
+RATE_LIMITER_SETTINGS = dict(
+    decrease_factor=config.RATE_LIMIT_DECREASE_FACTOR,
+    increase_after=config.RATE_LIMIT_INCREASE_AFTER,
+    increase_step=config.RATE_LIMIT_INCREASE_STEP,
+    min_fraction=config.RATE_LIMIT_MIN_FRACTION,
+    cooldown_seconds=config.RATE_LIMIT_COOLDOWN,
+    jitter=config.RATE_LIMIT_JITTER,
+    initial_burst=config.RATE_LIMIT_INITIAL_BURST or max(1, config.MAX_CONCURRENT_CHAPTERS),
 )
 
-# --- Инициализация API клиента Google и токенизатора ---
-client = None
-tokenizer = None
-try:
-    if not config.GOOGLE_API_KEY:
-        raise ValueError("API ключ Google AI не найден в .env или config.py")
-    genai.configure(api_key=config.GOOGLE_API_KEY)
-    client = genai.GenerativeModel(config.MODEL_NAME)
-    logging.info(f"Клиент API Google Gemini инициализирован для модели: {config.MODEL_NAME}")
-except Exception as e:
-    logging.exception("Ошибка инициализации API клиента Google Gemini.")
-    client = None
-
-try:
-    # Используем tiktoken для примерной оценки, т.к. Google API не предоставляет точный подсчет заранее
-    tokenizer = tiktoken.get_encoding("cl100k_base")
-    logging.info("Токенизатор tiktoken (cl100k_base) инициализирован для примерной оценки.")
-except Exception:
-    logging.warning("Не удалось инициализировать tiktoken. Подсчет токенов будет грубым.")
-    tokenizer = None
-
-# --- Инициализация RAG ---
-RAG_INITIALIZED = initialize_rag()
-
-# --- Вспомогательные функции ---
+# Статистика повторов запросов (паузы, лишние запросы, восстановление после сбоев)
+retry_stats = RetryStats()
 
-def count_tokens(text):
-    """Подсчитывает токены в тексте (примерно)."""
-    if tokenizer:
-        try:
-            return len(tokenizer.encode(text))
-        except Exception as e:
-            logging.warning(f"Ошибка tiktoken.encode: {e}. Возвращаем оценку.")
-            return len(text) // 3
-    else:
-        return len(text) // 3
 
-def get_last_n_tokens(text, n_tokens):
-    """Возвращает примерно последние N токенов текста."""
-    if not tokenizer or n_tokens <= 0:
-        estimated_chars = n_tokens * 4
-        return text[-estimated_chars:] if estimated_chars > 0 else ""
+def create_gemini_client():
+    """Клиент Google Gemini (или локальная имитация при MOCK_LLM_ENABLED); None при ошибке."""
+    if config.MOCK_LLM_ENABLED:
+        logging.info("Используется локальная имитация LLM (MOCK_LLM_ENABLED): квота API не расходуется.")
+        return MockLLMBackend(config.MOCK_LLM_LATENCY, config.MOCK_LLM_PROMPT_TOKENS_PER_SECOND,
+                              config.MOCK_LLM_OUTPUT_TOKENS_PER_SECOND, config.MOCK_LLM_SEED)
     try:
-        tokens = tokenizer.encode(text)
-        if len(tokens) <= n_tokens:
-            return text
-        else:
-            last_tokens = tokens[-n_tokens:]
-            return tokenizer.decode(last_tokens, errors='ignore')
-    except Exception as e:
-        logging.warning(f"Ошибка get_last_n_tokens: {e}. Возвращаем срез.")
-        estimated_chars = n_tokens * 4
-        return text[-estimated_chars:]
-
-def call_gemini_api_with_retries(prompt_text):
-    """Отправляет запрос к Google Gemini API с логикой повторных попыток."""
-    if not client:
-        logging.error("Клиент Google API не инициализирован.")
+        if not config.GOOGLE_API_KEY:
+            raise ValueError("API ключ Google AI не найден в .env или config.py")
+        import google.generativeai as genai # Импорт занимает больше секунды - только при первом запросе
+        genai.configure(api_key=config.GOOGLE_API_KEY)
+        # Создаем модель (клиент создается при вызове generate_content)
+        gemini_client = genai.GenerativeModel(config.MODEL_NAME)
+        logging.info(f"Клиент API Google Gemini инициализирован для модели: {config.MODEL_NAME}")
+        return gemini_client
+    except Exception:
+        logging.exception("Ошибка инициализации API клиента Google Gemini.")
         return None
 
-    generation_config = {"temperature": 0.7}
-    safety_settings = [
-        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-    ]
 
-    for attempt in range(config.MAX_RETRIES + 1):
-        try:
-            logging.debug(f"Попытка Google API №{attempt + 1}/{config.MAX_RETRIES + 1}...")
-            response = client.generate_content(
-                prompt_text,
-                generation_config=generation_config,
-                safety_settings=safety_settings,
-                request_options={'timeout': config.API_TIMEOUT}
-            )
-
-            # Добавим проверку на наличие кандидатов (может отсутствовать в ответе)
-            if not hasattr(response, 'text') or not response.text:
-                 # Если текста нет, проверяем причину блокировки
-                 block_reason = "Неизвестно"
-                 finish_reason = "Неизвестно"
-                 if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
-                      block_reason = response.prompt_feedback.block_reason
-                 if hasattr(response, 'candidates') and response.candidates and hasattr(response.candidates[0],'finish_reason'):
-                      finish_reason = response.candidates[0].finish_reason
-
-                 # Если заблокировано из-за безопасности или другого фатального финиша
-                 if block_reason != "BLOCK_REASON_UNSPECIFIED" or finish_reason not in ["FINISH_REASON_UNSPECIFIED", "STOP"]:
-                      error_message = f"Ответ заблокирован/прерван ({block_reason}/{finish_reason}). Ответ: {response}"
-                      logging.error(error_message)
-                      # Не повторяем попытку при блокировке
-                      return f"[ОШИБКА ПЕРЕВОДА: {error_message}]"
-                 else:
-                      # Иная причина отсутствия текста, логгируем и пробуем снова
-                      logging.warning(f"Google API вернул пустой текст (Попытка {attempt + 1}). Причина: {block_reason}/{finish_reason}. Ответ: {response}")
-                      if attempt >= config.MAX_RETRIES: break
-                      wait_time = 2 ** (attempt + 1); logging.info(f"Повтор через {wait_time} сек..."); time.sleep(wait_time); continue
+def get_client():
+    """
+    Клиент API (создается при первом вызове): Gemini или имитация, поверх - маршрутизатор по бэкендам
+    (LLM_ROUTER_ENABLED) и подмешивание сбоев (FAULT_INJECTION_RATES).
+    """
+    global client, client_initialized, backend_router
+    with init_lock:
+        if client_initialized or client is not None:
+            return client
+        client_initialized = True
+        client = create_gemini_client()
+        # --- Маршрутизатор запросов по нескольким провайдерам и ключам ---
+        # Заменяет client: у каждого бэкенда своя квота, при 429 запрос уходит другому бэкенду
+        if config.LLM_ROUTER_ENABLED:
+            try:
+                # Бэкенды-имитации без своих настроек ведут себя как MOCK_LLM_*
+                mock_settings = dict(latency=config.MOCK_LLM_LATENCY, prompt_tokens_per_second=config.MOCK_LLM_PROMPT_TOKENS_PER_SECOND,
+                                     output_tokens_per_second=config.MOCK_LLM_OUTPUT_TOKENS_PER_SECOND, seed=config.MOCK_LLM_SEED)
+                backend_router = create_backend_router(config.LLM_BACKENDS, client, count_tokens, config.API_TIMEOUT, RATE_LIMITER_SETTINGS,
+                                                       mock_settings)
+                client = backend_router
+            except Exception:
+                logging.exception("Не удалось создать маршрутизатор бэкендов LLM. Работаем только с Gemini.")
+                backend_router = None
+        # --- Подмешивание сбоев (проверка логики повторов) ---
+        if config.FAULT_INJECTION_RATES and client:
+            client = FaultInjectingClient(client, config.FAULT_INJECTION_RATES, config.FAULT_INJECTION_TIMEOUT_DELAY,
+                                          config.FAULT_INJECTION_TRUNCATE_FRACTION, config.FAULT_INJECTION_SEED)
+            logging.warning(f"ВКЛЮЧЕНО подмешивание сбоев API: {config.FAULT_INJECTION_RATES}")
+        return client
+
+
+def get_rate_limits():
+    """
+    Общий лимит (RPM, TPM): с маршрутизатором - сумма квот бэкендов, иначе из config.
+    Маршрутизатору нужен клиент, поэтому при LLM_ROUTER_ENABLED клиент создается.
+    """
+    global rate_limit_rpm, rate_limit_tpm
+    with init_lock:
+        if rate_limit_rpm is None:
+            if config.LLM_ROUTER_ENABLED:
+                get_client()
+            rate_limit_rpm, rate_limit_tpm = backend_router.total_limits() if backend_router else (config.RATE_LIMIT_RPM, config.RATE_LIMIT_TPM)
+        return rate_limit_rpm, rate_limit_tpm
 
-            logging.debug(f"Google API ответ успешно получен: {response.text[:100]}...")
-            return response.text
 
-        except google_exceptions.ResourceExhausted as e:
-            wait_time = 2 ** (attempt + 1); logging.warning(f"RateLimit Google API (Попытка {attempt + 1}): {e}. Повтор через {wait_time} сек."); time.sleep(wait_time)
-        except (google_exceptions.RetryError, google_exceptions.DeadlineExceeded, TimeoutError) as e: # Добавили TimeoutError
-             wait_time = 2 ** attempt; logging.warning(f"Сетевая/Таймаут Google API (Попытка {attempt + 1}): {e}. Повтор через {wait_time} сек."); time.sleep(wait_time)
-        except google_exceptions.InvalidArgument as e:
-             logging.error(f"Неправильный аргумент Google API (Попытка {attempt + 1}): {e}"); return f"[ОШИБКА ПЕРЕВОДА: Неправильный аргумент API]"
-        except Exception as e:
-            logging.exception(f"Неожиданная ошибка Google API (Попытка {attempt + 1}):")
-            wait_time = 5; time.sleep(wait_time)
+def get_rate_limiter():
+    """
+    Общий ограничитель скорости запросов к API. С маршрутизатором квоту и 429 учитывают только
+    ограничители бэкендов (второй, общий, не видел бы поглощенных маршрутизатором 429), поэтому общий не ограничивает.
+    """
+    global rate_limiter
+    with init_lock:
+        if rate_limiter is None:
+            get_rate_limits()
+            rate_limiter = UnlimitedRateLimiter() if backend_router else AdaptiveRateLimiter(*get_rate_limits(), **RATE_LIMITER_SETTINGS)
+        return rate_limiter
+
+
+def get_token_counter():
+    """Мемоизированный подсчет токенов (одни и те же строки кодируются один раз); tiktoken загружается при первом вызове."""
+    global token_counter
+    with init_lock:
+        if token_counter is None:
+            tokenizer = None
+            try:
+                # Используем tiktoken для примерной оценки, т.к. Google API не предоставляет точный подсчет заранее
+                import tiktoken
+                tokenizer = tiktoken.get_encoding("cl100k_base")
+                logging.info("Токенизатор tiktoken (cl100k_base) инициализирован для примерной оценки.")
+            except Exception:
+                logging.warning("Не удалось инициализировать tiktoken. Подсчет токенов будет грубым.")
+            token_counter = TokenCounter(tokenizer, config.TOKEN_CACHE_MAX_ENTRIES, token_estimator, config.TOKEN_EXACT_MARGIN)
+        return token_counter
+
+
+def is_rag_ready():
+    """RAG инициализирован (модель эмбеддингов и ChromaDB загружаются при первом вызове)."""
+    global RAG_INITIALIZED
+    if not config.RAG_ENABLED:
+        return False
+    with init_lock:
+        if RAG_INITIALIZED is None:
+            RAG_INITIALIZED = initialize_rag()
+        return RAG_INITIALIZED
+
+
+def warm_up():
+    """Создает все ленивые ресурсы заранее (режим наблюдения: первая новая глава не ждет загрузки моделей)."""
+    get_client()
+    get_rate_limiter()
+    get_token_counter()
+    is_rag_ready()
+
+# --- Параметры генерации ---
+GENERATION_CONFIG = {"temperature": 0.7}
+# P1 в режиме 'glossary_only': короткий ответ со списком терминов
+P1_GLOSSARY_GENERATION_CONFIG = {"temperature": 0.3, "max_output_tokens": config.P1_GLOSSARY_MAX_OUTPUT_TOKENS}
+# Краткие содержания глав и истории (CONTEXT_MODE = 'summary')
+SUMMARY_GENERATION_CONFIG = {"temperature": 0.3}
+# --- Хранилища SQLite и кэш контекста (открываются при первом обращении) ---
+lazy_stores = {} # имя -> открытое хранилище или None (выключено в config или не открылось)
+
+
+def get_lazy_store(name, enabled, create, failure_message):
+    """Открывает хранилище name функцией create при первом обращении; None - выключено или не открылось (ошибка в лог)."""
+    if name in lazy_stores:
+        return lazy_stores[name]
+    with init_lock:
+        if name not in lazy_stores:
+            store = None
+            if enabled:
+                try:
+                    store = create()
+                except Exception:
+                    logging.exception(failure_message)
+            lazy_stores[name] = store
+        return lazy_stores[name]
+
+
+def get_response_cache():
+    """Кэш ответов API (SQLite)."""
+    def create():
+        cache = ResponseCache(config.RESPONSE_CACHE_FILE, config.RESPONSE_CACHE_MAX_MB * 1024 * 1024)
+        logging.info(f"Кэш ответов API: {config.RESPONSE_CACHE_FILE}")
+        return cache
+    return get_lazy_store("response_cache", config.RESPONSE_CACHE_ENABLED, create,
+                          "Не удалось открыть кэш ответов API. Работаем без кэша.")
+
+
+def get_usage_ledger():
+    """Журнал расхода квоты API (токены из usage_metadata по главам и проходам)."""
+    return get_lazy_store("usage_ledger", config.USAGE_LEDGER_ENABLED, lambda: UsageLedger(config.USAGE_LEDGER_FILE),
+                          "Не удалось открыть журнал расхода квоты. Работаем без него.")
+
+
+def get_summary_store():
+    """Краткие содержания вместо текста предыдущих глав (CONTEXT_MODE = 'summary')."""
+    def create():
+        store = SummaryStore(config.SUMMARY_FILE)
+        logging.info(f"Контекст предыдущих глав: краткие содержания ({config.SUMMARY_FILE}).")
+        return store
+    return get_lazy_store("summary_store", config.CONTEXT_MODE == 'summary', create,
+                          "Не удалось открыть хранилище кратких содержаний. Контекст - текст недавних глав.")
+
+
+def get_chapter_manifest():
+    """Манифест состояния глав (возобновление с первой непереведенной главы)."""
+    return get_lazy_store("chapter_manifest", config.CHAPTER_MANIFEST_ENABLED, lambda: ChapterManifest(config.CHAPTER_MANIFEST_FILE),
+                          "Не удалось открыть манифест глав. Возобновление по содержимому папки переводов.")
+
+
+def get_job_queue():
+    """Очередь глав для нескольких процессов-исполнителей."""
+    def create():
+        queue = JobQueue(config.JOB_QUEUE_FILE, config.JOB_WORKER_ID or None, config.JOB_LEASE_SECONDS, config.JOB_MAX_ATTEMPTS)
+        logging.info(f"Очередь глав: {config.JOB_QUEUE_FILE}, исполнитель {queue.worker_id}.")
+        return queue
+    return get_lazy_store("job_queue", config.JOB_QUEUE_ENABLED, create,
+                          "Не удалось открыть очередь глав. Перевод без координации с другими процессами.")
+
+
+def get_context_cache():
+    """
+    Кэш стабильного префикса промпта на стороне провайдера.
+    Запросы через CachedContent Gemini идут мимо маршрутизатора (и его ограничителей), имитации
+    и подмешивания сбоев, поэтому с ними кэш 'gemini' не включается.
+    """
+    def create():
+        if config.CONTEXT_CACHE_BACKEND == 'gemini':
+            if config.LLM_ROUTER_ENABLED or config.MOCK_LLM_ENABLED or config.FAULT_INJECTION_RATES:
+                logging.warning("Кэш контекста 'gemini' выключен: он несовместим с маршрутизатором, имитацией LLM "
+                                "и подмешиванием сбоев. Запросы уходят целиком.")
+                return None
+            cache = GeminiContextCache(config.MODEL_NAME, config.CONTEXT_CACHE_TTL_SECONDS, config.CONTEXT_CACHE_MAX_ENTRIES)
+        else:
+            cache = LocalContextCache(get_client, config.CONTEXT_CACHE_TTL_SECONDS, config.CONTEXT_CACHE_MAX_ENTRIES)
+        logging.info(f"Кэш контекста: {config.CONTEXT_CACHE_BACKEND}, TTL {config.CONTEXT_CACHE_TTL_SECONDS} сек.")
+        return cache
+    return get_lazy_store("context_cache", config.CONTEXT_CACHE_BACKEND in ('gemini', 'local'), create,
+                          "Не удалось создать кэш контекста. Запросы уходят целиком.")
 
-        if attempt >= config.MAX_RETRIES: logging.error("Достигнут лимит попыток API."); break
 
-    return None
+original_chapter_order = None
+job_queue_claimed = set() # Главы, арендованные этим процессом и еще не завершенные
 
+# --- Вспомогательные функции ---
 
-def load_glossary():
-    """Загружает глоссарий из JSON файла."""
-    try:
-        if os.path.exists(config.GLOSSARY_FILE):
-            with open(config.GLOSSARY_FILE, 'r', encoding='utf-8') as f:
-                content = f.read()
-                if not content.strip(): return {}
-                glossary_data = json.loads(content)
-                logging.info(f"Глоссарий загружен. Записей: {len(glossary_data)}")
-                return glossary_data
-        else: logging.warning(f"Файл глоссария не найден: {config.GLOSSARY_FILE}."); return {}
-    except json.JSONDecodeError as e:
-         logging.error(f"Ошибка декодирования JSON глоссария {config.GLOSSARY_FILE}: {e}.")
-         return {}
-    except Exception as e: logging.error(f"Ошибка загрузки глоссария: {e}"); return {}
+def count_tokens(text):
+    """Подсчитывает токены в тексте (примерно, с кэшем по содержимому)."""
+    return get_token_counter().count(text)
 
+def count_tokens_near_budget(estimate, budget, *texts):
+    """Оценка размера текстов, уточненная полным кодированием, если она близка к бюджету."""
+    return get_token_counter().refine_near_budget(estimate, budget, *texts)
 
-def format_glossary_for_prompt(glossary_data):
-    """Форматирует глоссарий для вставки в промпт."""
-    if not glossary_data:
-        return "Нет записей."
-    # Форматируем как список для лучшего восприятия моделью
-    return "Ключевые термины и имена:\n" + "\n".join([f"- {k}: {v}" for k, v in glossary_data.items()])
+def get_last_n_tokens(text, n_tokens):
+    """Возвращает примерно последние N токенов текста (кодируется только хвост)."""
+    return get_token_counter().last_n_tokens(text, n_tokens)
 
+def backoff_sleep(seconds):
+    """Пауза перед повтором запроса (учитывается в статистике повторов)."""
+    time.sleep(seconds)
+    retry_stats.on_backoff(seconds)
 
-def parse_api_response_for_glossary(response_text):
-    """Извлекает кандидатов для глоссария из ответа API."""
-    candidates = {}
-    # Ищем блок с более строгим маркером
-    match = re.search(r"\[GLOSSARY_CANDIDATES_START\](.*?)\[GLOSSARY_CANDIDATES_END\]", response_text, re.DOTALL | re.IGNORECASE)
-    if match:
-        content = match.group(1).strip()
-        # Ищем пары "Оригинал: ПредложенныйПеревод", разрешая пробелы вокруг двоеточия
-        pairs = re.findall(r"^\s*(.+?)\s*[:：]\s*(.+?)\s*$", content, re.MULTILINE)
-        for original, proposed in pairs:
-            original = original.strip(); proposed = proposed.strip()
-            # Добавляем фильтрацию: пропускаем слишком короткие или слишком длинные термины
-            if original and proposed and 1 < len(original) < 50 and 1 < len(proposed) < 50:
-                 # Можно добавить проверку, что оригинал содержит хотя бы один китайский иероглиф
-                 if re.search(r'[\u4e00-\u9fff]', original):
-                      candidates[original] = proposed
-                      logging.debug(f" -> Найден кандидат: '{original}': '{proposed}'")
-                 else:
-                      logging.debug(f" -> Пропущен кандидат (не содержит иероглифов): '{original}'")
-            else:
-                logging.debug(f" -> Пропущен кандидат (не прошел проверку длины): '{original}': '{proposed}'")
 
-    if not candidates:
-        logging.info(" -> Кандидаты для глоссария не найдены в ответе API.")
-    return candidates
+def log_retry_stats():
+    """Пишет в лог сводку по повторам запросов: потерянное время, лишние запросы, восстановление."""
+    stats = retry_stats.summary()
+    if not stats['calls']:
+        return
+    logging.info(f"Повторы API: вызовов {stats['calls']}, попыток {stats['attempts']}, сбоев {stats['failures']}, "
+                 f"лишних запросов {stats['wasted_requests']} (из них брак {stats['rejected_responses']}), "
+                 f"паузы {stats['backoff_seconds']:.1f} сек., ожидание лимита {stats['limiter_wait_seconds']:.1f} сек., "
+                 f"восстановление в среднем {stats['recovery_mean_seconds']:.1f} сек. (макс. {stats['recovery_max_seconds']:.1f}), "
+                 f"неудачных вызовов {stats['failed_calls']}.")
 
 
-def update_glossary(current_glossary, candidates):
-    """Обновляет глоссарий предложенными кандидатами, избегая конфликтов."""
-    added_count = 0; conflict_count = 0
-    glossary_changed = False
-    for original, proposed in candidates.items():
-        if original not in current_glossary:
-            # Дополнительная проверка: не добавляем, если перевод совпадает с оригиналом (транслитерация)
-            if original != proposed:
-                current_glossary[original] = proposed
-                added_count += 1; glossary_changed = True
-                logging.info(f" -> Глоссарий+: '{original}': '{proposed}'")
-            else:
-                logging.debug(f" -> Пропущено добавление (перевод совпадает с оригиналом): '{original}'")
-        elif current_glossary[original] != proposed:
-            conflict_count += 1
-            logging.warning(f" -> Конфликт глоссария '{original}': Предложено '{proposed}', оставлено '{current_glossary[original]}'")
+def get_finish_reason(response):
+    """Причина завершения генерации строкой ('STOP', 'MAX_TOKENS', 'SAFETY'...) или None, если ее нет в ответе."""
+    try:
+        candidates = getattr(response, 'candidates', None)
+        reason = candidates[0].finish_reason if candidates else None
+    except (AttributeError, IndexError, ValueError):
+        return None
+    if reason is None:
+        return None
+    return getattr(reason, 'name', None) or str(reason) # Enum google.generativeai или строка бэкенда
 
-    if added_count > 0 or conflict_count > 0:
-        logging.info(f"Обновление глоссария: +{added_count}, конфликтов {conflict_count}.")
-    return glossary_changed
 
+def get_response_model(response):
+    """Модель, которая ответила: model_name ответа бэкенда (маршрутизатор), иначе config.MODEL_NAME."""
+    return getattr(response, 'model_name', None) or config.MODEL_NAME
 
-def extract_translation_from_response(response_text):
-     """Извлекает основной текст перевода, удаляя блок кандидатов и другие маркеры."""
-     # Сначала ищем маркер начала перевода
-     translation_match = re.search(r"\[ПЕРЕВОД_СТАРТ\](.*)", response_text, re.DOTALL | re.IGNORECASE)
-     if translation_match:
-         text = translation_match.group(1)
-         # Затем ищем маркер конца или блок кандидатов, чтобы обрезать
-         end_match = re.search(r"\[ПЕРЕВОД_КОНЕЦ\]|\[GLOSSARY_CANDIDATES_START\]", text, re.DOTALL | re.IGNORECASE)
-         if end_match:
-             translation = text[:end_match.start()].strip()
-         else:
-             translation = text.strip() # Берем все после [ПЕРЕВОД_СТАРТ], если нет других маркеров
-     else:
-         # Если нет маркера [ПЕРЕВОД_СТАРТ], пробуем старый метод: удалить блок кандидатов
-         translation = re.sub(r"\[GLOSSARY_CANDIDATES_START\](.*?)\[GLOSSARY_CANDIDATES_END\]", "", response_text, flags=re.DOTALL | re.IGNORECASE)
-         translation = translation.strip()
 
-     # Финальная очистка от оставшихся маркеров
-     translation = re.sub(r"\[/?(ПЕРЕВОД|ПЕРЕВОД_СТАРТ|ПЕРЕВОД_КОНЕЦ|GLOSSARY_CANDIDATES_START|GLOSSARY_CANDIDATES_END)\]", "", translation, flags=re.IGNORECASE)
-     return translation.strip()
+def get_cache_model_names():
+    """
+    Модели, ответы которых подходят для запроса: с маршрутизатором - модели всех его бэкендов
+    (запрос может уйти любому), иначе только config.MODEL_NAME.
+    """
+    if config.LLM_ROUTER_ENABLED:
+        get_client()
+    if not backend_router:
+        return [config.MODEL_NAME]
+    return list(dict.fromkeys(model_name or config.MODEL_NAME for model_name in backend_router.model_names()))
+
+
+def get_request_key(generation_config, prompt_text):
+    """Идентификатор запроса в журнале расхода квоты (не зависит от того, какая модель ответила)."""
+    return make_cache_key(config.MODEL_NAME, generation_config, prompt_text)
+
+
+def invalidate_cached_response(prompt_text, generation_config=None):
+    """Удаляет ответ на промпт из кэша (чтобы повтор ушел в API, а не вернул тот же брак)."""
+    response_cache = get_response_cache()
+    usage_ledger = get_usage_ledger()
+    retry_stats.on_rejected()
+    generation_config = generation_config or GENERATION_CONFIG
+    if response_cache:
+        for model_name in get_cache_model_names():
+            response_cache.invalidate(make_cache_key(model_name, generation_config, prompt_text))
+    if usage_ledger:
+        usage_ledger.mark_rejected(get_request_key(generation_config, prompt_text))
+
+
+def calibrate_token_estimator(prompt_prefix, prompt_text, response):
+    """Калибрует оценку токенов по prompt_token_count из usage_metadata ответа (только ответы основной модели: у других свой токенизатор)."""
+    prompt_tokens = get_usage_counts(response)[0]
+    if token_estimator and prompt_tokens and get_response_model(response) == config.MODEL_NAME:
+        get_token_counter().observe((prompt_prefix, prompt_text), prompt_tokens)
+
+
+def save_token_calibration():
+    """Сохраняет калибровку оценки токенов и пишет коэффициенты в лог."""
+    if token_estimator and token_estimator.samples:
+        token_estimator.save()
+        logging.info(f"Калибровка оценки токенов ({token_estimator.samples} наблюдений): "
+                     + ", ".join(f"{name} {ratio:.3f}" for name, ratio in token_estimator.ratios.items()))
+
+
+def record_usage(chapter, source_chapter, pass_name, request_key, attempt, outcome, response, estimated_prompt_tokens, request_start):
+    """Пишет попытку запроса в журнал расхода квоты (токены берутся из usage_metadata ответа; source_chapter - см. UsageLedger.record)."""
+    usage_ledger = get_usage_ledger()
+    if not usage_ledger:
+        return
+    try:
+        model_name = get_response_model(response) if response is not None else config.MODEL_NAME
+        usage_ledger.record(chapter, pass_name, model_name, request_key, attempt + 1, outcome,
+                            get_usage_counts(response), estimated_prompt_tokens, time.time() - request_start, source_chapter)
+    except Exception:
+        logging.exception("Не удалось записать расход квоты в журнал.")
 
-# --- Основная функция перевода ---
 
-import os
-import json
-import time
-import logging
-import re
-import google.generativeai as genai 
-from google.api_core import exceptions as google_exceptions 
-from collections import deque
-import tiktoken 
+def log_response_cache_stats():
+    """Пишет в лог статистику кэша ответов API (если кэш открывался)."""
+    response_cache = lazy_stores.get("response_cache")
+    if response_cache:
+        stats = response_cache.stats()
+        logging.info(f"Кэш API: попаданий {stats['hits']}, промахов {stats['misses']} ({stats['hit_rate']:.0%}), "
+                     f"записей {stats['entries']}, {stats['size_bytes'] / 1024 / 1024:.1f} МБ.")
 
-import config
-from utils.file_utils import ensure_dir_exists, save_glossary 
-from utils.rag_utils import initialize_rag, index_all_chapters, find_relevant_chunks
 
-# --- Настройка логирования ---
-log_file_path = config.LOG_FILE
-ensure_dir_exists(config.LOG_DIR)
-# Закрываем предыдущие обработчики, если они есть
-for handler in logging.root.handlers[:]:
-    logging.root.removeHandler(handler)
-logging.basicConfig(
-    level=getattr(logging, config.LOG_LEVEL.upper(), logging.INFO),
-    format='%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file_path, encoding='utf-8', mode='a'),
-        logging.StreamHandler()
-    ]
-)
+def log_backend_router_stats():
+    """Пишет в лог, сколько запросов и ответов 429 пришлось на каждый бэкенд маршрутизатора."""
+    if backend_router:
+        for name, stats in backend_router.stats().items():
+            logging.info(f"Бэкенд {name}: запросов {stats['requests']}, 429: {stats['rate_limited']}, "
+                         f"ошибок {stats['errors']}, скорость {stats['rate_fraction']:.0%} от лимита.")
 
-# --- Инициализация API клиента Google и токенизатора ---
-client = None
-tokenizer = None
-try:
-    if not config.GOOGLE_API_KEY:
-        raise ValueError("API ключ Google AI не найден в .env или config.py")
-    genai.configure(api_key=config.GOOGLE_API_KEY)
-    # Создаем модель (клиент создается при вызове generate_content)
-    client = genai.GenerativeModel(config.MODEL_NAME)
-    logging.info(f"Клиент API Google Gemini инициализирован для модели: {config.MODEL_NAME}")
-except Exception as e:
-    logging.exception("Ошибка инициализации API клиента Google Gemini.")
-    client = None
-
-try:
-    # Используем tiktoken для примерной оценки, т.к. Google API не предоставляет точный подсчет заранее
-    tokenizer = tiktoken.get_encoding("cl100k_base")
-    logging.info("Токенизатор tiktoken (cl100k_base) инициализирован для примерной оценки.")
-except Exception:
-    logging.warning("Не удалось инициализировать tiktoken. Подсчет токенов будет грубым.")
-    tokenizer = None
-
-# --- Инициализация RAG ---
-RAG_INITIALIZED = initialize_rag()
 
-# --- Вспомогательные функции ---
+def release_context_cache():
+    """Пишет в лог статистику кэша контекста и удаляет его записи у провайдера (если кэш создавался)."""
+    context_cache = lazy_stores.get("context_cache")
+    if context_cache:
+        stats = context_cache.stats()
+        logging.info(f"Кэш контекста: создано {stats['created']}, переиспользовано {stats['reused']}, "
+                     f"истекло {stats['expired']}, ошибок {stats['failed']}.")
+        context_cache.clear()
 
-def count_tokens(text):
-    """Подсчитывает токены в тексте (примерно)."""
-    if tokenizer:
-        try:
-            return len(tokenizer.encode(text))
-        except Exception as e:
-            logging.warning(f"Ошибка tiktoken.encode: {e}. Возвращаем оценку.")
-            return len(text) // 3
-    else:
-        return len(text) // 3 # Грубая оценка
 
-def get_last_n_tokens(text, n_tokens):
-    """Возвращает примерно последние N токенов текста."""
-    if not tokenizer or n_tokens <= 0:
-        estimated_chars = n_tokens * 4
-        return text[-estimated_chars:] if estimated_chars > 0 else ""
-    try:
-        tokens = tokenizer.encode(text)
-        if len(tokens) <= n_tokens:
-            return text
-        else:
-            last_tokens = tokens[-n_tokens:]
-            return tokenizer.decode(last_tokens, errors='ignore')
-    except Exception as e:
-        logging.warning(f"Ошибка get_last_n_tokens (decode/encode): {e}. Возвращаем срез.")
-        estimated_chars = n_tokens * 4
-        return text[-estimated_chars:]
+# Маркер ответа, генерация которого была прервана из-за явного брака (повторяем как брак, а не как ошибку API)
+STREAM_ABORT_MARKER = "[БРАК ПОТОКА:"
+
 
-def call_gemini_api_with_retries(prompt_text):
-    """Отправляет запрос к Google Gemini API с логикой повторных попыток."""
-    if not client:
+def consume_response_stream(response, stream_path, original_length):
+    """
+    Читает потоковый ответ, дописывая текст в stream_path по мере поступления.
+    По ходу генерации проверяет долю китайских иероглифов и наличие абзацев (как is_translation);
+    при явном браке прекращает чтение потока и закрывает его.
+    Возвращает (текст, причина_прерывания или None).
+    """
+    start_time = time.time(); first_chunk_time = None
+    parts = []; chinese_chars = 0; visible_chars = 0; chars_since_break = 0; tail = ""
+    with open(stream_path, 'w', encoding='utf-8') as stream_file:
+        for chunk in response:
+            try:
+                chunk_text = chunk.text
+            except ValueError: # Служебный чанк без текста (например, финальный с finish_reason)
+                continue
+            if not chunk_text:
+                continue
+            if first_chunk_time is None:
+                first_chunk_time = time.time()
+                logging.info(f"   -> Поток: первый фрагмент через {first_chunk_time - start_time:.1f} сек.")
+            parts.append(chunk_text)
+            stream_file.write(chunk_text); stream_file.flush()
+
+            # --- Инкрементальная проверка на брак ---
+            for char in chunk_text:
+                if '\u4e00' <= char <= '\u9fff': chinese_chars += 1
+                if char.strip(): visible_chars += 1
+            combined = tail + chunk_text
+            last_break = max(combined.rfind("\n\n"), combined.rfind("\n \n"))
+            chars_since_break = len(combined) - last_break - 2 if last_break >= 0 else chars_since_break + len(chunk_text)
+            tail = chunk_text[-2:]
+
+            if visible_chars >= config.STREAM_CHECK_MIN_CHARS and chinese_chars / visible_chars > config.STREAM_ABORT_CHINESE_RATIO:
+                close_stream(response)
+                return "".join(parts), f"китайских символов {chinese_chars}/{visible_chars}"
+            if original_length > 500 and chars_since_break > config.STREAM_MAX_CHARS_WITHOUT_BREAK:
+                close_stream(response)
+                return "".join(parts), f"нет абзацев на протяжении {chars_since_break} симв."
+    logging.info(f"   -> Поток завершен за {time.time() - start_time:.1f} сек.")
+    return "".join(parts), None
+
+
+def call_gemini_api_with_retries(prompt_text, use_cache=True, generation_config=None, stream_path=None, original_length=0, prompt_prefix="",
+                                 chapter=None, pass_name="other", validate=None, source_chapter=None):
+    """
+    Отправляет запрос к Google Gemini API с логикой повторных попыток (с кэшем ответов).
+    generation_config - параметры генерации; по умолчанию GENERATION_CONFIG.
+    stream_path - если задан, ответ читается потоком и пишется в этот файл по мере генерации,
+    а явный брак прерывает генерацию (возвращается строка с STREAM_ABORT_MARKER).
+    prompt_prefix - стабильная часть промпта перед prompt_text; при включенном кэше контекста
+    она хранится у провайдера, и в запросе передается только prompt_text.
+    chapter, pass_name - глава и проход (p1, p2, titles...) для журнала расхода квоты;
+    source_chapter - глава(и), к которым относится запрос сегмента или пакета (по ним группируется отчет).
+    validate - проверка текста ответа вызывающим кодом (True - ответ годен). В кэш попадают только
+    ответы, завершенные со STOP и прошедшие проверку; ответ из кэша, не прошедший ее, удаляется из кэша.
+    """
+    response_cache = get_response_cache()
+    usage_ledger = get_usage_ledger()
+    context_cache = get_context_cache()
+    generation_config = generation_config or GENERATION_CONFIG
+    full_prompt_text = prompt_prefix + prompt_text
+    if response_cache and use_cache:
+        cache_keys = [make_cache_key(model_name, generation_config, full_prompt_text) for model_name in get_cache_model_names()]
+        cache_key, cached_text = response_cache.get_first(cache_keys)
+        if cached_text:
+            if validate is None or validate(cached_text):
+                logging.info(" -> Ответ API взят из кэша.")
+                return cached_text
+            logging.warning(" -> Ответ из кэша не прошел проверку: удален из кэша, запрос уходит в API.")
+            response_cache.invalidate(cache_key)
+
+    if not get_client():
         logging.error("Клиент Google API не инициализирован.")
         return None
 
-    generation_config = {"temperature": 0.7}
     safety_settings = [
         {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"}, # Ослабляем фильтры
         {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
@@ -339,50 +508,113 @@ def call_gemini_api_with_retries(prompt_text):
         {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
     ]
 
+    # Оценка размера запроса для TPM: промпт плюс ответ примерно того же размера
+    estimated_prompt_tokens = count_tokens(prompt_prefix) + count_tokens(prompt_text)
+    estimated_request_tokens = estimated_prompt_tokens * 2
+    request_key = get_request_key(generation_config, full_prompt_text) if usage_ledger else None
+
+    rate_limiter = get_rate_limiter()
+    use_context_cache = context_cache and prompt_prefix and count_tokens(prompt_prefix) >= config.CONTEXT_CACHE_MIN_TOKENS
+
+    first_failure_at = None # Начало первой неудачной попытки (для задержки восстановления)
     for attempt in range(config.MAX_RETRIES + 1):
+        failure_kind = None; wait_time = 0; attempt_start = request_start = time.time()
         try:
+            retry_stats.on_limiter_wait(rate_limiter.acquire(estimated_request_tokens))
+            # Префикс из кэша провайдера (если доступен), иначе промпт уходит целиком.
+            # Клиент берется заново на каждую попытку: запись могла истечь во время пауз между попытками
+            request_client, request_prompt = get_client(), full_prompt_text
+            if use_context_cache:
+                cached_client = context_cache.get_client(prompt_prefix)
+                if cached_client:
+                    request_client, request_prompt = cached_client, prompt_text
+            retry_stats.on_attempt(); request_start = time.time()
             logging.debug(f"Попытка Google API №{attempt + 1}/{config.MAX_RETRIES + 1}...")
-            response = client.generate_content(
-                prompt_text,
-                generation_config=generation_config,
-                safety_settings=safety_settings,
-                request_options={'timeout': config.API_TIMEOUT}
-            )
-
-            # Проверка ответа Gemini
-            if hasattr(response, 'text') and response.text:
-                 logging.debug(f"Google API ответ успешно получен: {response.text[:100]}...")
-                 return response.text
+            if stream_path:
+                response = request_client.generate_content(
+                    request_prompt,
+                    generation_config=generation_config,
+                    safety_settings=safety_settings,
+                    request_options={'timeout': config.API_TIMEOUT},
+                    stream=True
+                )
+                try:
+                    response_text, abort_reason = consume_response_stream(response, stream_path, original_length)
+                except BaseException:
+                    close_stream(response) # Обрыв посреди потока: соединение не должно висеть
+                    raise
+                if abort_reason:
+                    logging.warning(f"Генерация прервана досрочно (брак): {abort_reason}.")
+                    record_usage(chapter, source_chapter, pass_name, request_key, attempt, 'aborted', response, estimated_prompt_tokens, request_start)
+                    retry_stats.on_call_finished(True, time.time() - first_failure_at if first_failure_at else None)
+                    return f"{STREAM_ABORT_MARKER} {abort_reason}]"
+            else:
+                response = request_client.generate_content(
+                    request_prompt,
+                    generation_config=generation_config,
+                    safety_settings=safety_settings,
+                    request_options={'timeout': config.API_TIMEOUT}
+                )
+                response_text = response.text if hasattr(response, 'text') else None
+
+            # Проверка ответа Gemini (ответ, обрезанный по MAX_TOKENS, повторяем как пустой)
+            finish_reason = get_finish_reason(response)
+            if response_text and finish_reason != "MAX_TOKENS":
+                 logging.debug(f"Google API ответ успешно получен: {response_text[:100]}...")
+                 rate_limiter.on_success() # Только для принятого ответа (не для пустого и не для прерванного потока)
+                 # Кэшируем только полный ответ, принятый вызывающим кодом (обрезанный или брак - нет)
+                 if response_cache and use_cache and finish_reason == "STOP" and (validate is None or validate(response_text)):
+                     # Ключ - по модели, которая ответила: ответ другой модели не вернется из кэша без маршрутизатора
+                     response_cache.put(make_cache_key(get_response_model(response), generation_config, full_prompt_text), response_text)
+                 record_usage(chapter, source_chapter, pass_name, request_key, attempt, 'ok', response, estimated_prompt_tokens, request_start)
+                 calibrate_token_estimator(prompt_prefix, prompt_text, response)
+                 retry_stats.on_call_finished(True, time.time() - first_failure_at if first_failure_at else None)
+                 return response_text
             else:
-                 block_reason = "Неизвестно"; finish_reason = "Неизвестно"
+                 block_reason = "Неизвестно"; finish_reason = finish_reason or "Неизвестно"
                  if hasattr(response, 'prompt_feedback') and response.prompt_feedback: block_reason = response.prompt_feedback.block_reason
-                 if hasattr(response, 'candidates') and response.candidates and hasattr(response.candidates[0],'finish_reason'): finish_reason = response.candidates[0].finish_reason
 
-                 logging.warning(f"Google API вернул пустой/неполный ответ (Попытка {attempt + 1}). Причина: {block_reason}/{finish_reason}. Ответ: {response}")
+                 logging.warning(f"Google API вернул пустой/неполный ответ (Попытка {attempt + 1}). Причина: {block_reason}/{finish_reason}. "
+                                 f"Получено символов: {len(response_text or '')}.")
+                 is_fatal = finish_reason not in ["FINISH_REASON_UNSPECIFIED", "STOP", "MAX_TOKENS"] # Обрезанный ответ (MAX_TOKENS) повторяем
+                 record_usage(chapter, source_chapter, pass_name, request_key, attempt, 'blocked' if is_fatal else 'empty', response, estimated_prompt_tokens, request_start)
                  
                  # Если заблокировано или другая фатальная причина - не повторяем
-                 if finish_reason not in ["FINISH_REASON_UNSPECIFIED", "STOP", "MAX_TOKENS"]: # MAX_TOKENS тоже считаем успехом (частичным)
+                 if is_fatal:
                       error_message = f"Ответ заблокирован/прерван ({block_reason}/{finish_reason})"
                       logging.error(error_message)
+                      retry_stats.on_failure('blocked'); retry_stats.on_call_finished(False)
                       # Возвращаем маркер ошибки, чтобы основной цикл мог это обработать
                       return f"[ОШИБКА ПЕРЕВОДА: {error_message}]" 
                  
                  # Иначе (неизвестная причина или просто пустой текст) - повторяем
+                 retry_stats.on_failure('empty'); first_failure_at = first_failure_at or attempt_start
                  if attempt >= config.MAX_RETRIES: logging.error("Достигнут лимит попыток для пустого/неполного ответа."); break
-                 wait_time = 2 ** (attempt + 1); logging.info(f"Повтор через {wait_time} сек..."); time.sleep(wait_time); continue
+                 wait_time = 2 ** (attempt + 1); logging.info(f"Повтор через {wait_time} сек..."); backoff_sleep(wait_time); continue
 
         except google_exceptions.ResourceExhausted as e:
-            wait_time = 2 ** (attempt + 1); logging.warning(f"RateLimit Google API (Попытка {attempt + 1}): {e}. Повтор через {wait_time} сек."); time.sleep(wait_time)
+            failure_kind = 'rate_limit'
+            logging.warning(f"RateLimit Google API (Попытка {attempt + 1}): {e}. Повтор после паузы ограничителя."); rate_limiter.on_rate_limited()
         except (google_exceptions.RetryError, google_exceptions.DeadlineExceeded, TimeoutError) as e:
-             wait_time = 2 ** attempt; logging.warning(f"Сетевая/Таймаут Google API (Попытка {attempt + 1}): {e}. Повтор через {wait_time} сек."); time.sleep(wait_time)
+             failure_kind = 'timeout'
+             wait_time = 2 ** attempt; logging.warning(f"Сетевая/Таймаут Google API (Попытка {attempt + 1}): {e}. Повтор через {wait_time} сек.")
         except google_exceptions.InvalidArgument as e:
-             logging.error(f"Неправильный аргумент Google API (Попытка {attempt + 1}): {e}"); return f"[ОШИБКА ПЕРЕВОДА: Неправильный аргумент API]"
+             logging.error(f"Неправильный аргумент Google API (Попытка {attempt + 1}): {e}")
+             retry_stats.on_failure('invalid_argument'); retry_stats.on_call_finished(False)
+             record_usage(chapter, source_chapter, pass_name, request_key, attempt, 'invalid_argument', None, estimated_prompt_tokens, request_start)
+             return f"[ОШИБКА ПЕРЕВОДА: Неправильный аргумент API]"
         except Exception as e:
+            failure_kind = 'error'
             logging.exception(f"Неожиданная ошибка Google API (Попытка {attempt + 1}):")
-            wait_time = 5; time.sleep(wait_time)
+            wait_time = 5
+        if failure_kind:
+            retry_stats.on_failure(failure_kind); first_failure_at = first_failure_at or attempt_start
+            record_usage(chapter, source_chapter, pass_name, request_key, attempt, failure_kind, None, estimated_prompt_tokens, request_start)
+            if wait_time: backoff_sleep(wait_time)
 
         if attempt >= config.MAX_RETRIES: logging.error("Не удалось получить ответ от Google API после всех попыток."); break
             
+    retry_stats.on_call_finished(False)
     return None # Возвращаем None, если все попытки не удались
 
 
@@ -403,11 +635,32 @@ def load_glossary():
     except Exception as e: logging.error(f"Ошибка загрузки глоссария: {e}"); return {}
 
 
-def format_glossary_for_prompt(glossary_data):
-    """Форматирует глоссарий для вставки в промпт."""
-    if not glossary_data:
+def find_glossary_terms(glossary_data, scope_text):
+    """Термины глоссария, встречающиеся в scope_text (по алфавиту, чтобы промпт был стабильным)."""
+    glossary_matcher.sync(glossary_data)
+    return sorted(term for term in glossary_matcher.find(scope_text) if term in glossary_data)
+
+
+def select_glossary_terms(glossary_data, scope_text=None):
+    """
+    Термины глоссария для промпта: если задан scope_text (глава и ее контекст) и включен
+    config.GLOSSARY_FILTER_ENABLED - только встречающиеся в этом тексте, иначе все.
+    """
+    if scope_text is not None and config.GLOSSARY_FILTER_ENABLED:
+        return find_glossary_terms(glossary_data, scope_text)
+    return list(glossary_data.keys())
+
+
+def format_glossary_terms(glossary_data, terms):
+    """Форматирует выбранные термины глоссария для вставки в промпт."""
+    if not terms:
         return "Нет записей."
-    return "Ключевые термины и имена:\n" + "\n".join([f"- {k}: {v}" for k, v in glossary_data.items()])
+    return "Ключевые термины и имена:\n" + "\n".join([f"- {k}: {glossary_data[k]}" for k in terms])
+
+
+def format_glossary_for_prompt(glossary_data, scope_text=None):
+    """Форматирует глоссарий (или только термины из scope_text) для вставки в промпт."""
+    return format_glossary_terms(glossary_data, select_glossary_terms(glossary_data, scope_text))
 
 
 def parse_api_response_for_glossary(response_text):
@@ -437,6 +690,7 @@ def update_glossary(current_glossary, candidates):
         if original not in current_glossary:
             if original != proposed: # Не добавляем транслитерацию
                 current_glossary[original] = proposed
+                glossary_matcher.add(original)
                 added_count += 1; glossary_changed = True
                 logging.info(f" -> Глоссарий+: '{original}': '{proposed}'")
             else: logging.debug(f" -> Пропущено добавление (транслит): '{original}'")
@@ -459,6 +713,13 @@ def extract_translation_from_response(response_text):
      return translation.strip()
  
  
+def is_complete_p1_response(response_text, p1_mode):
+    """Ответ P1 разбирается полностью: есть блок кандидатов, а в режиме 'full' - и черновой перевод."""
+    if not re.search(r"\[GLOSSARY_CANDIDATES_START\].*?\[GLOSSARY_CANDIDATES_END\]", response_text, re.DOTALL | re.IGNORECASE):
+        return False
+    return p1_mode == 'glossary_only' or bool(extract_translation_from_response(response_text))
+
+
 # --- Новая функция для проверки качества перевода ---
 def is_translation(text, original_text_length, min_paragraphs=3, chinese_char_threshold=0.05):
     """
@@ -505,153 +766,336 @@ def is_translation(text, original_text_length, min_paragraphs=3, chinese_char_th
 
     return False # Брак не обнаружен
 
-# --- Основная функция перевода ---
-def translate_chapters():
+# --- RAG контекст ---
+def build_rag_context(query_text, exclude_chapter):
+    """Ищет релевантные фрагменты прошлых глав и форматирует их для промпта ("" если RAG недоступен)."""
+    if not (config.RAG_NUM_RESULTS > 0 and is_rag_ready()):
+        return ""
+    chunks_data = find_relevant_chunks(query_text, config.RAG_NUM_RESULTS, exclude_chapter=exclude_chapter)
+    if not chunks_data:
+        return ""
+    logging.info(f" -> RAG: найдено {len(chunks_data)} чанков.")
+    return "\n\n".join([f"### Контекст из {chunk['source']} (Сходство: {1-chunk['distance']:.2f}):\n{chunk['text']}\n###" for chunk in chunks_data])
+
+
+# --- Контекст недавних глав ---
+def build_recent_context_parts(prev_ctx_list, available_for_recent):
     """
-    Итеративно переводит главы (двухпроходная система с Google Gemini).
+    Собирает блоки контекста недавних глав: полная N-1 (или ее конец, если не влезает),
+    концы N-2 и N-3 по config.PREVIOUS_CHUNK_TOKENS, не превышая available_for_recent токенов.
+    Возвращает (список блоков в порядке N-1, N-2, N-3; использовано токенов).
     """
-    logging.info("--- Начало Фазы 2: Перевод глав (Двухпроходный с Google Gemini и RAG) ---")
-    ensure_dir_exists(config.TRANSLATED_CHAPTERS_DIR)
+    recent_context_parts = deque(); used_tokens = 0
+    # --- Блоки N-3 и N-2: только концы глав ---
+    for back in (3, 2):
+        if len(prev_ctx_list) >= back:
+            fn, txt = prev_ctx_list[-back]
+            chunk_tk = min(config.PREVIOUS_CHUNK_TOKENS, available_for_recent - used_tokens)
+            if chunk_tk > 50:
+                chunk = get_last_n_tokens(txt, chunk_tk); ctk = count_tokens(chunk)
+                if used_tokens + ctk <= available_for_recent:
+                    recent_context_parts.appendleft(f"### Недавний контекст (конец N-{back}: {fn}):\n{chunk}\n###"); used_tokens += ctk
+    # --- Блок N-1: полная глава или ее конец ---
+    if len(prev_ctx_list) >= 1:
+        fn, txt = prev_ctx_list[-1]; tk = count_tokens(txt)
+        if used_tokens + tk <= available_for_recent: # Полная глава
+            recent_context_parts.appendleft(f"### Недавний контекст (полная N-1: {fn}):\n{txt}\n###"); used_tokens += tk
+        else: # Конец главы
+            chunk_tk = min(config.PREVIOUS_CHUNK_TOKENS, available_for_recent - used_tokens)
+            if chunk_tk > 50:
+                chunk = get_last_n_tokens(txt, chunk_tk); ctk = count_tokens(chunk)
+                if used_tokens + ctk <= available_for_recent:
+                    recent_context_parts.appendleft(f"### Недавний контекст (конец N-1: {fn}):\n{chunk}\n###"); used_tokens += ctk
+    return list(recent_context_parts), used_tokens
+
+
+# --- Краткие содержания предыдущих глав ---
+def read_original_chapter(filename):
+    """Текст оригинала главы ('' при ошибке чтения)."""
+    try:
+        with open(os.path.join(config.ORIGINAL_CHAPTERS_DIR, filename), 'r', encoding=config.INPUT_FILE_ENCODING) as f:
+            return f.read()
+    except Exception as e:
+        logging.error(f"Ошибка чтения {filename} для контекста: {e}")
+        return ""
 
-    if config.RAG_ENABLED:
-        if RAG_INITIALIZED:
-            index_all_chapters(force_reindex=False)
+
+def get_original_chapter_order(refresh=False):
+    """Отсортированный список оригиналов глав (папка читается один раз за запуск)."""
+    global original_chapter_order
+    if original_chapter_order is None or refresh:
+        original_chapter_order = sorted(f for f in os.listdir(config.ORIGINAL_CHAPTERS_DIR) if f.endswith(".txt"))
+    return original_chapter_order
+
+
+def build_chapter_summary_prompt(filename, chapter_text):
+    return f"""**ИНСТРУКЦИЯ:**
+Кратко перескажи на русском языке главу китайской веб-новеллы [ГЛАВА_ДЛЯ_КРАТКОГО_СОДЕРЖАНИЯ] (не больше {config.SUMMARY_CHAPTER_MAX_WORDS} слов):
+ключевые события, кто что сделал, как изменились отношения и положение персонажей, какие сюжетные линии остались открытыми.
+Имена собственные и термины оставляй в оригинале (иероглифами). Выведи только пересказ.
+
+[ГЛАВА_ДЛЯ_КРАТКОГО_СОДЕРЖАНИЯ: {filename}]
+{chapter_text}
+[/ГЛАВА_ДЛЯ_КРАТКОГО_СОДЕРЖАНИЯ]
+"""
+
+
+def build_story_summary_prompt(story_summary, filename, chapter_summary):
+    return f"""**ИНСТРУКЦИЯ:**
+Обнови краткое содержание истории [КРАТКОЕ_СОДЕРЖАНИЕ_ИСТОРИИ] с учетом следующей главы [КРАТКОЕ_СОДЕРЖАНИЕ_ГЛАВЫ].
+Новое содержание - не больше {config.SUMMARY_STORY_MAX_WORDS} слов на русском языке: давние события сжимай сильнее недавних,
+сохраняй главных персонажей, их цели и отношения, незакрытые сюжетные линии.
+Имена собственные и термины оставляй в оригинале (иероглифами). Выведи только новое содержание.
+
+[КРАТКОЕ_СОДЕРЖАНИЕ_ИСТОРИИ]
+{story_summary}
+[/КРАТКОЕ_СОДЕРЖАНИЕ_ИСТОРИИ]
+
+[КРАТКОЕ_СОДЕРЖАНИЕ_ГЛАВЫ: {filename}]
+{chapter_summary}
+[/КРАТКОЕ_СОДЕРЖАНИЕ_ГЛАВЫ]
+"""
+
+
+def request_summary(prompt_text, filename, pass_name):
+    """Запрос краткого содержания; None при ошибке API."""
+    response = call_gemini_api_with_retries(prompt_text, generation_config=SUMMARY_GENERATION_CONFIG, chapter=filename, pass_name=pass_name)
+    if not response or "[ОШИБКА ПЕРЕВОДА:" in response:
+        logging.warning(f" -> Не удалось получить краткое содержание ({pass_name}) для {filename}.")
+        return None
+    return response.strip()
+
+
+def get_chapter_summary(filename, chapter_text):
+    """Краткое содержание главы: из хранилища или одним запросом к API (один раз на главу)."""
+    summary_store = get_summary_store()
+    summary = summary_store.get(KIND_CHAPTER, filename)
+    if summary:
+        return summary
+    with summary_store.lock_for(KIND_CHAPTER, filename):
+        summary = summary_store.get(KIND_CHAPTER, filename)
+        if summary is None:
+            summary = request_summary(build_chapter_summary_prompt(filename, chapter_text), filename, "summary")
+            if summary:
+                summary_store.put(KIND_CHAPTER, filename, summary)
+        return summary
+
+
+def get_story_summary(last_filename):
+    """
+    Накопленное краткое содержание истории по главу last_filename включительно.
+    Берется последняя сохраненная версия не дальше SUMMARY_STORY_CATCHUP_CHAPTERS глав назад
+    и дополняется содержаниями следующих глав по одной. None, если содержания еще нет.
+    Шаг для каждой главы выполняется под ее lock_for(KIND_STORY, ...): параллельные главы не запрашивают
+    одно и то же обновление дважды, а ждут и берут сохраненную версию. Шаги разных глав не блокируют друг друга.
+    """
+    summary_store = get_summary_store()
+    order = get_original_chapter_order()
+    if last_filename not in order:
+        order = get_original_chapter_order(refresh=True)
+        if last_filename not in order:
+            return None
+    target = order.index(last_filename)
+    stored = summary_store.filenames(KIND_STORY)
+    story = None; start = max(0, target - config.SUMMARY_STORY_CATCHUP_CHAPTERS + 1)
+    for i in range(target, start - 1, -1):
+        if order[i] in stored:
+            story = summary_store.get(KIND_STORY, order[i]); start = i + 1
+            break
+    for filename in order[start:target + 1]:
+        with summary_store.lock_for(KIND_STORY, filename):
+            stored_story = summary_store.get(KIND_STORY, filename)
+            if stored_story:
+                story = stored_story # Уже дополнено параллельным потоком
+                continue
+            chapter_text = read_original_chapter(filename)
+            chapter_summary = get_chapter_summary(filename, chapter_text) if chapter_text.strip() else None
+            if not chapter_summary:
+                continue
+            if story is not None:
+                updated_story = request_summary(build_story_summary_prompt(story, filename, chapter_summary), filename, "story_summary")
+                if not updated_story:
+                    continue # Глава не попадет в содержание истории, но цепочка не прерывается
+                story = updated_story
+            else:
+                story = chapter_summary
+            summary_store.put(KIND_STORY, filename, story)
+    return story
+
+
+def build_summary_context_parts(prev_ctx_list, available_for_recent):
+    """
+    Контекст в режиме 'summary': накопленное содержание истории до окна недавних глав,
+    краткие содержания N-3..N-1 и конец N-1 (config.PREVIOUS_CHUNK_TOKENS), не больше available_for_recent токенов.
+    Если места не хватает, сначала отбрасывается содержание истории, затем содержания дальних глав.
+    Глава без краткого содержания (сбой API, часть сегментированной главы) представлена своим концом.
+    Возвращает (список блоков в хронологическом порядке; использовано токенов).
+    """
+    recent = prev_ctx_list[-3:]
+    if not recent:
+        return [], 0
+    order = set(get_original_chapter_order())
+    blocks = [] # (приоритет, позиция, текст)
+    fn, txt = recent[-1]
+    if config.PREVIOUS_CHUNK_TOKENS > 0:
+        blocks.append((0, len(recent) + 1, f"### Недавний контекст (конец N-1: {fn}):\n{get_last_n_tokens(txt, config.PREVIOUS_CHUNK_TOKENS)}\n###"))
+    for back, (fn, txt) in enumerate(reversed(recent), start=1):
+        summary = get_chapter_summary(fn, txt) if fn in order else None
+        if summary:
+            blocks.append((back, len(recent) - back + 1, f"### Краткое содержание (N-{back}: {fn}):\n{summary}\n###"))
+        elif back > 1:
+            blocks.append((back, len(recent) - back + 1, f"### Недавний контекст (конец N-{back}: {fn}):\n{get_last_n_tokens(txt, config.PREVIOUS_CHUNK_TOKENS)}\n###"))
+    first_known = next((fn for fn, _ in recent if fn in order), None)
+    first_index = get_original_chapter_order().index(first_known) if first_known else 0
+    if first_index > 0:
+        story = get_story_summary(get_original_chapter_order()[first_index - 1])
+        if story:
+            blocks.append((len(recent) + 1, 0, f"### Краткое содержание истории (до {first_known}):\n{story}\n###"))
+
+    selected = []; used_tokens = 0
+    for _, position, block in sorted(blocks):
+        block_tokens = count_tokens(block)
+        if used_tokens + block_tokens <= available_for_recent:
+            selected.append((position, block)); used_tokens += block_tokens
+    return [block for _, block in sorted(selected)], used_tokens
+
+
+# --- Упаковка контекста в бюджет промпта ---
+def pack_prompt_context(budget_tokens, rag_context_str, prev_ctx_list):
+    """
+    Заполняет бюджет контекста за один проход: RAG (если помещается целиком), затем недавние главы.
+    Вызывается один раз на главу, результат общий для P1 и P2.
+    Возвращает (список блоков контекста, использовано токенов).
+    """
+    summary_store = get_summary_store()
+    context_parts = []; context_tokens = 0
+    if rag_context_str:
+        rag_tokens = count_tokens(rag_context_str)
+        if rag_tokens <= budget_tokens:
+            context_parts.append(rag_context_str); context_tokens += rag_tokens
+            logging.info(f" -> RAG: +{rag_tokens} т.")
         else:
-            logging.error("RAG включен, но не удалось инициализировать. Перевод без RAG.")
+            logging.warning(" -> RAG не поместился в бюджет промпта.")
+    if summary_store:
+        recent_parts, recent_tokens = build_summary_context_parts(prev_ctx_list, budget_tokens - context_tokens)
     else:
-        logging.info("RAG отключен.")
+        recent_parts, recent_tokens = build_recent_context_parts(prev_ctx_list, budget_tokens - context_tokens)
+    context_parts.extend(recent_parts); context_tokens += recent_tokens
+    return context_parts, context_tokens
+
+
+# --- Чекпойнты первого прохода ---
+def get_glossary_version(glossary_data):
+    """Короткий хэш содержимого глоссария (версия, с которой выполнялся P1)."""
+    payload = json.dumps(glossary_data, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:12]
 
-    glossary_data = load_glossary()
 
+def get_checkpoint_path(filename):
+    return os.path.join(config.CHECKPOINT_DIR, filename.replace(".txt", "_p1.json"))
+
+
+def load_p1_checkpoint(filename):
+    """Загружает чекпойнт P1 главы или возвращает None."""
+    checkpoint_path = get_checkpoint_path(filename)
+    if not os.path.exists(checkpoint_path):
+        return None
     try:
-        original_files = sorted([f for f in os.listdir(config.ORIGINAL_CHAPTERS_DIR) if f.endswith(".txt")])
-        logging.info(f"Найдено {len(original_files)} оригинальных глав.")
-    except FileNotFoundError:
-        logging.error(f"Папка с оригинальными главами не найдена: {config.ORIGINAL_CHAPTERS_DIR}")
-        return False
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('p1_response'):
+            return checkpoint
     except Exception as e:
-        logging.error(f"Ошибка чтения папки оригиналов: {e}")
-        return False
+        logging.warning(f"Поврежден чекпойнт P1 {checkpoint_path}: {e}. Игнорируем.")
+    return None
 
-    previous_chapters_context_queue = deque(maxlen=4) # Храним (filename, text)
-    total_chapters = len(original_files); processed_count = 0; chapters_with_api_errors = []; chapters_with_брак = []
 
-    chapter_index = 0
-    while chapter_index < len(original_files): # Используем while для возможности повтора
-        filename = original_files[chapter_index]
-        chapter_number = chapter_index + 1
-        original_filepath = os.path.join(config.ORIGINAL_CHAPTERS_DIR, filename)
-        translated_filename = filename.replace(".txt", "_ru.txt")
-        translated_filepath = os.path.join(config.TRANSLATED_CHAPTERS_DIR, translated_filename)
-
-        logging.info(f"--- Обработка главы {chapter_number}/{total_chapters}: {filename} ---")
-
-        # --- Проверка на существование перевода ---
-        if os.path.exists(translated_filepath):
-            logging.info(f" -> Пропуск: {translated_filename} уже существует.")
-            try: # Загружаем оригинал для контекста следующих глав
-                 with open(original_filepath, 'r', encoding=config.INPUT_FILE_ENCODING) as f: text = f.read()
-                 if not any(entry[0] == filename for entry in previous_chapters_context_queue):
-                      previous_chapters_context_queue.append((filename, text))
-                      logging.debug(f" -> Добавлен текст пропущенной главы '{filename}' в контекст.")
-            except Exception as e:
-                 logging.error(f"Ошибка чтения {filename} для контекста: {e}")
-            chapter_index += 1 # Переходим к следующей главе
-            continue
+def save_p1_checkpoint(filename, response_p1, glossary_candidates, glossary_version):
+    """Сохраняет ответ P1, разобранных кандидатов и версию глоссария (атомарно)."""
+    job_queue = get_job_queue()
+    ensure_dir_exists(config.CHECKPOINT_DIR)
+    checkpoint_path = get_checkpoint_path(filename)
+    checkpoint = {
+        "filename": filename,
+        "p1_response": response_p1,
+        "glossary_candidates": glossary_candidates,
+        "glossary_version": glossary_version,
+        "p1_mode": config.P1_MODE,
+        "created": time.time(),
+    }
+    try:
+        tmp_path = checkpoint_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, checkpoint_path)
+    except Exception as e:
+        logging.error(f"Не удалось сохранить чекпойнт P1 {checkpoint_path}: {e}")
+        return
+    if job_queue and filename in job_queue_claimed:
+        job_queue.mark_p1_done(filename)
 
-        # --- Чтение текущей главы ---
-        try:
-            with open(original_filepath, 'r', encoding=config.INPUT_FILE_ENCODING) as f:
-                current_chapter_text = f.read().strip()
-            if not current_chapter_text:
-                logging.warning(f" -> Файл главы {filename} пуст. Пропуск.")
-                chapter_index += 1
-                continue
-            original_length = len(current_chapter_text) # Запоминаем длину оригинала
-            logging.debug(f" -> Текст главы '{filename}' прочитан ({original_length} симв).")
-        except Exception as e:
-            logging.error(f"Ошибка чтения файла главы {filename}: {e}")
-            chapter_index += 1
-            continue
 
-        # --- Переменная для результата перевода ---
-        final_translated_text = None
-        api_error_occurred = False
-
-        # --- Цикл попыток перевода (включая повторы из-за брака) ---
-        translation_attempts = 0
-        max_translation_attempts = 2 # Сколько раз пытаться перевести главу, если получаем брак
-
-        while translation_attempts < max_translation_attempts:
-            translation_attempts += 1
-            logging.info(f" -> Попытка перевода №{translation_attempts}/{max_translation_attempts} для главы {filename}...")
-            api_error_occurred = False # Сбрасываем флаг ошибки API для новой попытки
-
-            # === Проход 1: Черновой перевод и кандидаты ===
-            logging.info(f"   -> Проход 1 (Попытка {translation_attempts}): Запрос...")
-            formatted_glossary_p1 = format_glossary_for_prompt(glossary_data)
-            glossary_tokens_p1 = count_tokens(formatted_glossary_p1)
-            current_chapter_tokens = count_tokens(current_chapter_text)
-            available_tokens_p1 = config.MAX_PROMPT_TOKENS - current_chapter_tokens - glossary_tokens_p1 - 2000 # Запас
-
-            context_parts_p1 = []; context_tokens_p1 = glossary_tokens_p1; rag_context_str_p1 = ""
-            if config.RAG_ENABLED and RAG_INITIALIZED and config.RAG_NUM_RESULTS > 0:
-                chunks_data = find_relevant_chunks(current_chapter_text, config.RAG_NUM_RESULTS, exclude_chapter=filename)
-                if chunks_data:
-                    rag_context_str_p1 = "\n\n".join([f"### Контекст из {chunk['source']} (Сходство: {1-chunk['distance']:.2f}):\n{chunk['text']}\n###" for chunk in chunks_data])
-                    rag_tokens = count_tokens(rag_context_str_p1)
-                    if context_tokens_p1 + rag_tokens <= available_tokens_p1:
-                        context_parts_p1.append(rag_context_str_p1)
-                        context_tokens_p1 += rag_tokens
-                        logging.info(f" -> RAG (P1): +{len(chunks_data)} чанков, {rag_tokens} т.")
-                    else:
-                        logging.warning(" -> RAG не поместился (P1).")
-                        rag_context_str_p1 = ""
-
-            prev_ctx_list = list(previous_chapters_context_queue); recent_ctx_parts_p1 = deque()
-            # --- Блок N-3 ---
-            if len(prev_ctx_list) >= 3:
-                 fn, txt = prev_ctx_list[-3]
-                 chunk_tk = min(config.PREVIOUS_CHUNK_TOKENS, available_tokens_p1-context_tokens_p1)
-                 if chunk_tk > 50:
-                      chunk = get_last_n_tokens(txt, chunk_tk)
-                      ctk = count_tokens(chunk) # Определяем ctk здесь
-                      if context_tokens_p1 + ctk <= available_tokens_p1: # Используем определенный ctk
-                           recent_ctx_parts_p1.appendleft(f"### Недавний контекст (конец N-3: {fn}):\n{chunk}\n###")
-                           context_tokens_p1 += ctk
-            # --- Блок N-2 ---
-            if len(prev_ctx_list) >= 2:
-                 fn, txt = prev_ctx_list[-2]
-                 chunk_tk = min(config.PREVIOUS_CHUNK_TOKENS, available_tokens_p1-context_tokens_p1)
-                 if chunk_tk > 50:
-                      chunk = get_last_n_tokens(txt, chunk_tk)
-                      ctk = count_tokens(chunk) # Определяем ctk здесь
-                      if context_tokens_p1 + ctk <= available_tokens_p1: # Используем определенный ctk
-                           recent_ctx_parts_p1.appendleft(f"### Недавний контекст (конец N-2: {fn}):\n{chunk}\n###")
-                           context_tokens_p1 += ctk
-            # --- Блок N-1 ---
-            if len(prev_ctx_list) >= 1:
-                fn, txt = prev_ctx_list[-1]
-                tk = count_tokens(txt)
-                if context_tokens_p1 + tk <= available_tokens_p1:
-                     recent_ctx_parts_p1.appendleft(f"### Недавний контекст (полная N-1: {fn}):\n{txt}\n###")
-                     context_tokens_p1 += tk
-                else: # Полная не влезла, пробуем конец
-                    chunk_tk = min(config.PREVIOUS_CHUNK_TOKENS, available_tokens_p1-context_tokens_p1)
-                    if chunk_tk > 50:
-                         # fn, txt = prev_ctx_list[-1] # fn и txt уже определены выше
-                         chunk = get_last_n_tokens(txt, chunk_tk)
-                         ctk = count_tokens(chunk) # Определяем ctk здесь
-                         if context_tokens_p1 + ctk <= available_tokens_p1: # Используем определенный ctk
-                              recent_ctx_parts_p1.appendleft(f"### Недавний контекст (конец N-1: {fn}):\n{chunk}\n###")
-                              context_tokens_p1 += ctk
-
-            context_parts_p1.extend(list(recent_ctx_parts_p1))
-
-            full_prompt_p1 = f"""**ИНСТРУКЦИЯ:**
-Ты — эксперт-переводчик китайских веб-новелл на русский язык. Твои задачи:
+def remove_p1_checkpoint(filename):
+    checkpoint_path = get_checkpoint_path(filename)
+    try:
+        if os.path.exists(checkpoint_path): os.remove(checkpoint_path)
+    except OSError as e:
+        logging.warning(f"Не удалось удалить чекпойнт P1 {checkpoint_path}: {e}")
+
+
+# --- Первый проход: черновой перевод и кандидаты в глоссарий ---
+def build_glossary_only_prompt(filename, current_chapter_text, known_terms):
+    """
+    Короткий промпт P1 (режим 'glossary_only'): только извлечение новых терминов, без перевода главы.
+    Вместо полного глоссария передаются лишь уже известные оригиналы, чтобы их не предлагали повторно.
+    """
+    known_terms_str = "、".join(known_terms) if known_terms else "Нет."
+    return f"""**ИНСТРУКЦИЯ:**
+Ты — эксперт-переводчик китайских веб-новелл на русский язык. НЕ переводи главу.
+Найди в тексте [ТЕКУЩАЯ_ГЛАВА] КЛЮЧЕВЫЕ термины, которых нет в [ИЗВЕСТНЫЕ_ТЕРМИНЫ]:
+*   Имена собственные (людей, организаций, мест).
+*   Названия специфических техник, артефактов, концепций, титулов, фракций.
+*   НЕ включай общие слова, прилагательные, глаголы, если они не являются частью устойчивого термина.
+Для каждого термина предложи наиболее подходящий русский перевод.
+Выведи ТОЛЬКО блок ниже, без пояснений:
+
+[GLOSSARY_CANDIDATES_START]
+(Пары 'ОригиналТермин: ПредложенныйРусскийПеревод', каждая на новой строке. Если новых терминов нет, оставь секцию пустой.)
+[GLOSSARY_CANDIDATES_END]
+
+[ИЗВЕСТНЫЕ_ТЕРМИНЫ]
+{known_terms_str}
+[/ИЗВЕСТНЫЕ_ТЕРМИНЫ]
+
+[ТЕКУЩАЯ_ГЛАВА: {filename}]
+{current_chapter_text}
+[/ТЕКУЩАЯ_ГЛАВА]
+"""
+
+
+def build_shared_prompt_prefix(formatted_glossary, context_parts):
+    """
+    Стабильный префикс промптов P1/P2 главы: глоссарий и контекст.
+    Собирается один раз на главу и идет первым, поэтому его можно кэшировать на стороне провайдера,
+    а в каждом запросе передавать только переменный суффикс (инструкция и текст главы).
+    """
+    return f"""**СПРАВОЧНЫЕ ДАННЫЕ ДЛЯ ПЕРЕВОДА:**
+
+**[ГЛОССАРИЙ] (Обязателен к использованию):**
+{formatted_glossary}
+
+**[ПРЕДЫДУЩИЙ_КОНТЕКСТ] (RAG и недавние главы):**
+{"".join(context_parts)}
+
+"""
+
+
+def build_first_pass_prompt(filename, current_chapter_text):
+    """Суффикс промпта P1 (режим 'full'): черновой перевод главы + кандидаты в глоссарий."""
+    return f"""**ИНСТРУКЦИЯ:**
+Ты — эксперт-переводчик китайских веб-новелл на русский язык. Используй [ГЛОССАРИЙ] и [ПРЕДЫДУЩИЙ_КОНТЕКСТ] выше. Твои задачи:
 1.  **Выполни точный и литературный перевод** текста из секции [ТЕКУЩАЯ_ГЛАВА]. Сохраняй стиль оригинала.
-2.  **Проанализируй ОРИГИНАЛЬНЫЙ текст** в [ТЕКУЩАЯ_ГЛАВА] и **предложи КЛЮЧЕВЫЕ термины** для добавления в глоссарий. Включай только:
+2.  **Проанализируй ОРИГИНАЛЬНЫЙ текст** в [ТЕКУЩАЯ_ГЛАВА] и **предложи КЛЮЧЕВЫЕ термины** для добавления в глоссарий (термины из [ГЛОССАРИЙ] повторно не предлагай). Включай только:
     *   Имена собственные (людей, организаций, мест).
     *   Названия специфических техник, артефактов, концепций, титулов, фракций.
     *   НЕ включай общие слова, прилагательные, глаголы, если они не являются частью устойчивого термина.
@@ -666,152 +1110,838 @@ def translate_chapters():
 (Здесь список кандидатов в формате 'ОригиналТермин: ПредложенныйРусскийПеревод', каждая пара на новой строке. Если кандидатов нет, оставь эту секцию пустой.)
 [GLOSSARY_CANDIDATES_END]
 
-**ИСПОЛЬЗУЙ ЭТИ ДАННЫЕ ДЛЯ ПЕРЕВОДА И АНАЛИЗА:**
+**ТЕКСТ ДЛЯ ПЕРЕВОДА И АНАЛИЗА:**
+[ТЕКУЩАЯ_ГЛАВА: {filename}]
+{current_chapter_text}
+[/ТЕКУЩАЯ_ГЛАВА]
+
+**РЕЗУЛЬТАТ:**
+"""
+
 
-**ТЕКУЩИЙ ГЛОССАРИЙ (используй для перевода и избегай повторного предложения):**
-{formatted_glossary_p1}
+def estimate_prompt_tokens(prefix_tokens, prompt_builder, *sections):
+    """
+    Размер промпта по частям: префикс + шаблон суффикса + его секции.
+    Все слагаемые берутся из кэша подсчетов, поэтому весь промпт повторно не кодируется.
+    """
+    template_tokens = count_tokens(prompt_builder(*[""] * len(sections)))
+    return prefix_tokens + template_tokens + sum(count_tokens(section) for section in sections)
 
-**ПРЕДЫДУЩИЙ КОНТЕКСТ (RAG и недавние главы):**
-{"".join(context_parts_p1)}
 
-**ТЕКСТ ДЛЯ ПЕРЕВОДА И АНАЛИЗА:**
+def run_first_pass(filename, current_chapter_text, glossary_data, prompt_prefix, prefix_tokens, prefix_glossary_version, translation_attempts,
+                   source_filename=None):
+    """
+    Собирает промпт P1 и отправляет его в API.
+    prompt_prefix/prefix_tokens - общий префикс главы (build_shared_prompt_prefix),
+    prefix_glossary_version - версия глоссария, с которой собран префикс.
+    source_filename - исходная глава сегмента (для журнала расхода квоты).
+    Возвращает (ответ P1, версия глоссария) или (None, None) при ошибке API.
+    """
+    logging.info(f"   -> Проход 1 [{filename}] (Попытка {translation_attempts}, режим {config.P1_MODE}): Запрос...")
+    if config.P1_MODE == 'glossary_only':
+        with glossary_lock:
+            # Повторно не предлагаются только термины, которые есть в самой главе
+            known_terms = select_glossary_terms(glossary_data, current_chapter_text)
+            glossary_version = get_glossary_version(glossary_data)
+        full_prompt_p1 = build_glossary_only_prompt(filename, current_chapter_text, known_terms)
+        logging.info(f"   -> Промпт P1 (только глоссарий) [{filename}]: {count_tokens(full_prompt_p1)} т.")
+        response_p1 = call_gemini_api_with_retries(full_prompt_p1, generation_config=P1_GLOSSARY_GENERATION_CONFIG,
+                                                   chapter=filename, pass_name="p1_glossary", source_chapter=source_filename,
+                                                   validate=lambda text: is_complete_p1_response(text, 'glossary_only'))
+        if not response_p1 or "[ОШИБКА ПЕРЕВОДА:" in response_p1:
+            return None, None
+        return response_p1, glossary_version
+
+    prompt_suffix_p1 = build_first_pass_prompt(filename, current_chapter_text)
+    final_prompt_tokens_p1 = estimate_prompt_tokens(prefix_tokens, build_first_pass_prompt, filename, current_chapter_text)
+    logging.info(f"   -> Промпт P1 [{filename}] (Попытка {translation_attempts}): {final_prompt_tokens_p1} т.")
+    final_prompt_tokens_p1 = count_tokens_near_budget(final_prompt_tokens_p1, config.MAX_PROMPT_TOKENS, prompt_prefix, prompt_suffix_p1)
+    if final_prompt_tokens_p1 > config.MAX_PROMPT_TOKENS: logging.warning(" -> Промпт P1 ПРЕВЫШАЕТ лимит!")
+
+    response_p1 = call_gemini_api_with_retries(prompt_suffix_p1, prompt_prefix=prompt_prefix, chapter=filename, pass_name="p1", source_chapter=source_filename,
+                                               validate=lambda text: is_complete_p1_response(text, 'full'))
+    if not response_p1 or "[ОШИБКА ПЕРЕВОДА:" in response_p1:
+        return None, None
+    return response_p1, prefix_glossary_version
+
+
+# --- Второй проход: финальный перевод ---
+def build_second_pass_prompt(filename, glossary_additions, current_chapter_text):
+    """
+    Суффикс промпта P2: финальный перевод главы с обязательным глоссарием.
+    glossary_additions - термины, добавленные в глоссарий после сборки префикса ("" если таких нет).
+    """
+    additions_section = f"""**[ГЛОССАРИЙ] - ДОПОЛНЕНИЯ (Обязательны к использованию):**
+{glossary_additions}
+
+""" if glossary_additions else ""
+    return f"""**ИНСТРУКЦИЯ:**
+Ты — профессиональный переводчик китайских веб-новелл на русский язык. Твоя задача - максимально точно перевести текст из секции [ТЕКУЩАЯ_ГЛАВА].
+*   **СТРОГО следуй переводам** имен и терминов, указанным в [ГЛОССАРИЙ]. Не придумывай другие переводы для них.
+*   Используй [ПРЕДЫДУЩИЙ_КОНТЕКСТ] для понимания сюжета и стиля.
+*   **Не добавляй информацию**, которой нет в [ТЕКУЩАЯ_ГЛАВА].
+*   **В ответе предоставь ТОЛЬКО финальный русский перевод** текста из [ТЕКУЩАЯ_ГЛАВА], без каких-либо пояснений, заголовков или маркеров секций.
+
+{additions_section}**ТЕКСТ ДЛЯ ПЕРЕВОДА:**
 [ТЕКУЩАЯ_ГЛАВА: {filename}]
 {current_chapter_text}
 [/ТЕКУЩАЯ_ГЛАВА]
 
-**РЕЗУЛЬТАТ:**
+**ФИНАЛЬНЫЙ ПЕРЕВОД:**
 """
-            final_prompt_tokens_p1 = count_tokens(full_prompt_p1)
-            logging.info(f"   -> Промпт P1 (Попытка {translation_attempts}): {final_prompt_tokens_p1} т.")
-            if final_prompt_tokens_p1 > config.MAX_PROMPT_TOKENS: logging.warning(" -> Промпт P1 ПРЕВЫШАЕТ лимит!")
 
-            response_p1 = call_gemini_api_with_retries(full_prompt_p1)
-            if not response_p1 or "[ОШИБКА ПЕРЕВОДА:" in response_p1:
+
+# --- Перевод одной главы ---
+def translate_single_chapter(filename, current_chapter_text, prev_ctx_list, glossary_data, stream_path=None, source_filename=None,
+                             persist_glossary=True):
+    """
+    Переводит одну главу (два прохода + повтор при браке).
+    Ответ P1 сохраняется в чекпойнт, поэтому повтор/возобновление начинается сразу с P2.
+    prev_ctx_list - снимок контекста [(filename, text), ...] предыдущих глав (N-3..N-1).
+    glossary_data - общий глоссарий; чтение/изменение только под glossary_lock.
+    stream_path - файл, куда P2 пишет перевод по мере генерации (None - без потоковой генерации).
+    source_filename - для сегмента главы: имя исходной главы (сегменты повторно не делятся).
+    persist_glossary - сохранять новые термины в файл глоссария (False - только в переданный glossary_data).
+    Возвращает (статус, текст): статус 'ok', 'api_error' или 'брак'.
+    """
+    original_length = len(current_chapter_text) # Запоминаем длину оригинала
+    current_chapter_tokens = count_tokens(current_chapter_text)
+    if config.SEGMENTATION_ENABLED and source_filename is None:
+        current_chapter_tokens = count_tokens_near_budget(current_chapter_tokens, config.SEGMENT_MAX_TOKENS, current_chapter_text)
+
+    if config.SEGMENTATION_ENABLED and source_filename is None and current_chapter_tokens > config.SEGMENT_MAX_TOKENS:
+        return translate_segmented_chapter(filename, current_chapter_text, prev_ctx_list, glossary_data, persist_glossary)
+
+    # --- Контекст не зависит от попытки и прохода: ищем и упаковываем один раз ---
+    rag_context_str = build_rag_context(current_chapter_text, source_filename or filename)
+    # Термины ищутся в главе и во всем доступном контексте (надмножество того, что попадет в промпт)
+    glossary_scope_text = "\n".join([current_chapter_text, rag_context_str] + [txt for _, txt in prev_ctx_list])
+    with glossary_lock:
+        prefix_terms = select_glossary_terms(glossary_data, glossary_scope_text)
+        formatted_glossary = format_glossary_terms(glossary_data, prefix_terms)
+        prefix_glossary_version = get_glossary_version(glossary_data)
+    glossary_tokens = count_tokens(formatted_glossary)
+    # Запас покрывает текст инструкций и рост глоссария между P1 и P2
+    context_budget = config.MAX_PROMPT_TOKENS - current_chapter_tokens - glossary_tokens - config.PROMPT_RESERVE_TOKENS
+    context_parts, _ = pack_prompt_context(context_budget, rag_context_str, prev_ctx_list)
+    # Общий префикс P1/P2 и всех попыток; новые термины после P1 идут в суффикс P2
+    prompt_prefix = build_shared_prompt_prefix(formatted_glossary, context_parts)
+    prefix_tokens = count_tokens(prompt_prefix)
+    prefix_terms = set(prefix_terms)
+
+    # --- Переменная для результата перевода ---
+    final_translated_text = None
+    api_error_occurred = False
+
+    # --- Цикл попыток перевода (включая повторы из-за брака) ---
+    translation_attempts = 0
+    max_translation_attempts = 2 # Сколько раз пытаться перевести главу, если получаем брак
+
+    while translation_attempts < max_translation_attempts:
+        translation_attempts += 1
+        logging.info(f" -> Попытка перевода №{translation_attempts}/{max_translation_attempts} для главы {filename}...")
+        api_error_occurred = False # Сбрасываем флаг ошибки API для новой попытки
+
+        # === Проход 1: Черновой перевод и кандидаты (или чекпойнт) ===
+        checkpoint = load_p1_checkpoint(filename)
+        if checkpoint:
+            logging.info(f"   -> Проход 1 [{filename}]: взят из чекпойнта (глоссарий {checkpoint.get('glossary_version')}).")
+            response_p1 = checkpoint['p1_response']
+            glossary_candidates = checkpoint.get('glossary_candidates') or {}
+            glossary_version = checkpoint.get('glossary_version')
+            p1_mode = checkpoint.get('p1_mode', 'full')
+        else:
+            response_p1, glossary_version = run_first_pass(filename, current_chapter_text, glossary_data, prompt_prefix, prefix_tokens, prefix_glossary_version, translation_attempts,
+                                                           source_filename)
+            if not response_p1:
                 logging.error(f"Не получен валидный ответ P1 для {filename} (Попытка {translation_attempts}). Пропуск главы."); api_error_occurred = True; break
+            glossary_candidates = parse_api_response_for_glossary(response_p1)
+            save_p1_checkpoint(filename, response_p1, glossary_candidates, glossary_version)
+            p1_mode = config.P1_MODE
 
+        draft_translation = None
+        if p1_mode != 'glossary_only':
             draft_translation = extract_translation_from_response(response_p1)
-            glossary_candidates = parse_api_response_for_glossary(response_p1)
             if not draft_translation: logging.warning(f"Не извлечен черновой перевод P1: {response_p1[:200]}...")
+        with glossary_lock:
             glossary_updated = update_glossary(glossary_data, glossary_candidates)
-            if glossary_updated:
-                if not save_glossary(glossary_data, config.GLOSSARY_FILE): logging.error("Крит. ошибка: Не сохранен глоссарий!");
-                formatted_glossary_p2 = format_glossary_for_prompt(glossary_data)
+            if glossary_updated and persist_glossary:
+                if not save_glossary_shared(glossary_data): logging.error("Крит. ошибка: Не сохранен глоссарий!");
+            # Глоссарий не менялся с момента P1 (ни этой главой, ни параллельными)?
+            glossary_unchanged = get_glossary_version(glossary_data) == glossary_version
+            # Термины, добавленные после сборки префикса (этой главой или параллельными)
+            added_terms = [term for term in select_glossary_terms(glossary_data, glossary_scope_text) if term not in prefix_terms]
+            glossary_additions = format_glossary_terms(glossary_data, added_terms) if added_terms else ""
+
+        # === Быстрый путь: черновик P1 уже сделан с тем же глоссарием ===
+        if config.SINGLE_PASS_IF_GLOSSARY_UNCHANGED and draft_translation and glossary_unchanged:
+            if not is_translation(draft_translation, original_length):
+                logging.info(f" -> Глоссарий не изменился, черновик P1 прошел проверку: P2 для {filename} пропущен.")
+                final_translated_text = draft_translation
+                break
+            logging.info(f" -> Черновик P1 для {filename} не прошел проверку на брак, выполняем P2.")
+
+        # === Проход 2: Финальный перевод ===
+        logging.info(f"   -> Проход 2 [{filename}] (Попытка {translation_attempts}): Запрос...")
+        prompt_suffix_p2 = build_second_pass_prompt(filename, glossary_additions, current_chapter_text)
+        final_prompt_tokens_p2 = estimate_prompt_tokens(prefix_tokens, build_second_pass_prompt, filename, glossary_additions, current_chapter_text)
+        logging.info(f"   -> Промпт P2 [{filename}] (Попытка {translation_attempts}): {final_prompt_tokens_p2} т.")
+        final_prompt_tokens_p2 = count_tokens_near_budget(final_prompt_tokens_p2, config.MAX_PROMPT_TOKENS, prompt_prefix, prompt_suffix_p2)
+        if final_prompt_tokens_p2 > config.MAX_PROMPT_TOKENS: logging.warning(" -> Промпт P2 ПРЕВЫШАЕТ лимит!")
+
+        final_translated_text = call_gemini_api_with_retries(prompt_suffix_p2, stream_path=stream_path, original_length=original_length, prompt_prefix=prompt_prefix,
+                                                            chapter=filename, pass_name="p2", source_chapter=source_filename,
+                                                            validate=lambda text: not is_translation(text, original_length))
+
+        # --- Проверка на брак ---
+        if final_translated_text and final_translated_text.startswith(STREAM_ABORT_MARKER):
+            logging.warning(f" -> Генерация P2 для {filename} прервана из-за брака (Попытка {translation_attempts}). Повтор...")
+            retry_stats.on_rejected()
+            final_translated_text = None
+        elif final_translated_text and "[ОШИБКА ПЕРЕВОДА:" not in final_translated_text:
+            if is_translation(final_translated_text, original_length):
+                logging.warning(f" -> Обнаружен брак в переводе главы {filename} (Попытка {translation_attempts}). Повтор...")
+                invalidate_cached_response(prompt_prefix + prompt_suffix_p2)
+                final_translated_text = None # Сбрасываем результат, чтобы цикл повторился
             else:
-                formatted_glossary_p2 = formatted_glossary_p1
-
-            # === Проход 2: Финальный перевод ===
-            logging.info(f"   -> Проход 2 (Попытка {translation_attempts}): Запрос...")
-            glossary_tokens_p2 = count_tokens(formatted_glossary_p2)
-            available_tokens_p2 = config.MAX_PROMPT_TOKENS - current_chapter_tokens - glossary_tokens_p2 - 1000
-            context_parts_p2 = []; context_tokens_p2 = glossary_tokens_p2; rag_tokens_to_add_p2 = 0
-            if rag_context_str_p1:
-                 rag_tokens_check=count_tokens(rag_context_str_p1);
-                 if context_tokens_p2+rag_tokens_check<=available_tokens_p2: context_parts_p2.append(rag_context_str_p1); context_tokens_p2+=rag_tokens_check; rag_tokens_to_add_p2=rag_tokens_check; logging.info(f" -> RAG (P2): +{rag_tokens_to_add_p2} т.")
-                 else: logging.warning(" -> RAG не поместился (P2).")
-            else: logging.info(" -> RAG не добавлялся (P2).")
-            temp_prev_chapters_p2=list(previous_chapters_context_queue); recent_context_parts_p2=deque(); available_for_recent=available_tokens_p2-context_tokens_p2
-            # --- Блок N-3 для P2 (ИСПРАВЛЕН) ---
-            if len(temp_prev_chapters_p2)>=3:
-                 fn,txt=temp_prev_chapters_p2[-3];
-                 chunk_tk=min(config.PREVIOUS_CHUNK_TOKENS,available_for_recent);
-                 if chunk_tk>50:
-                     chunk=get_last_n_tokens(txt,chunk_tk); ctk=count_tokens(chunk);
-                     if ctk<=available_for_recent: # Проверка внутри
-                          recent_context_parts_p2.appendleft(f"### Недавний контекст (конец N-3: {fn}):\n{chunk}\n###"); available_for_recent-=ctk
-            # --- Блок N-2 для P2 (ИСПРАВЛЕН) ---
-            if len(temp_prev_chapters_p2)>=2:
-                 fn,txt=temp_prev_chapters_p2[-2];
-                 chunk_tk=min(config.PREVIOUS_CHUNK_TOKENS,available_for_recent);
-                 if chunk_tk>50:
-                     chunk=get_last_n_tokens(txt,chunk_tk); ctk=count_tokens(chunk);
-                     if ctk<=available_for_recent: # Проверка внутри
-                          recent_context_parts_p2.appendleft(f"### Недавний контекст (конец N-2: {fn}):\n{chunk}\n###"); available_for_recent-=ctk
-            # --- Блок N-1 для P2 (ИСПРАВЛЕН) ---
-            if len(temp_prev_chapters_p2)>=1:
-                fn,txt=temp_prev_chapters_p2[-1]; tk=count_tokens(txt);
-                if tk<=available_for_recent: # Полная глава
-                    recent_context_parts_p2.appendleft(f"### Недавний контекст (полная N-1: {fn}):\n{txt}\n###"); available_for_recent-=tk
-                else: # Конец главы
-                    chunk_tk=min(config.PREVIOUS_CHUNK_TOKENS,available_for_recent);
-                    if chunk_tk>50:
-                         # fn и txt уже определены из блока if len >= 1
-                         chunk=get_last_n_tokens(txt,chunk_tk); ctk=count_tokens(chunk);
-                         if ctk<=available_for_recent: # Проверка внутри
-                              recent_context_parts_p2.appendleft(f"### Недавний контекст (конец N-1: {fn}):\n{chunk}\n###"); available_for_recent-=ctk
-            context_parts_p2.extend(list(recent_context_parts_p2))
-
-            full_prompt_p2 = f"""**ИНСТРУКЦИЯ:**
-Ты — профессиональный переводчик китайских веб-новелл на русский язык. Твоя задача - максимально точно перевести текст из секции [ТЕКУЩАЯ_ГЛАВА].
+                logging.info(f" -> Проверка на брак пройдена (Попытка {translation_attempts}).")
+                break # Брак не обнаружен, выходим из цикла попыток
+        elif not final_translated_text: # Если API вернул None после всех ретраев
+             logging.error(f"Не получен финальный перевод P2 для {filename} (Попытка {translation_attempts}).")
+             api_error_occurred = True
+             break # Выходим из цикла попыток
+        else: # Если API вернул маркер ошибки
+             logging.error(f"Ошибка API при финальном переводе P2 для {filename}: {final_translated_text}")
+             api_error_occurred = True
+             break # Выходим из цикла попыток
+        # --- Конец проверки на брак ---
+
+    if api_error_occurred:
+        return 'api_error', None
+    if final_translated_text:
+        return 'ok', final_translated_text
+    logging.error(f"Не удалось получить качественный перевод для {filename} после {max_translation_attempts} попыток (брак). Глава пропущена.")
+    return 'брак', None
+
+
+# --- Перевод больших глав по сегментам ---
+def split_into_segments(text, max_tokens):
+    """
+    Делит текст главы на сегменты по границам абзацев, каждый не больше max_tokens (примерно).
+    Абзац длиннее лимита целиком становится отдельным сегментом.
+    """
+    paragraphs = [p.strip() for p in re.split(r'\n\s*\n+', text) if p.strip()]
+    segments = []; current_parts = []; current_tokens = 0
+    for paragraph in paragraphs:
+        paragraph_tokens = count_tokens(paragraph)
+        if current_parts and current_tokens + paragraph_tokens > max_tokens:
+            segments.append("\n\n".join(current_parts))
+            current_parts = []; current_tokens = 0
+        current_parts.append(paragraph)
+        current_tokens += paragraph_tokens
+    if current_parts:
+        segments.append("\n\n".join(current_parts))
+    return segments
+
+
+def translate_segmented_chapter(filename, current_chapter_text, prev_ctx_list, glossary_data, persist_glossary=True):
+    """
+    Переводит большую главу по сегментам параллельно (до config.MAX_CONCURRENT_SEGMENTS одновременно).
+    Каждый сегмент проходит обычный двухпроходный перевод с общим глоссарием и контекстом предыдущих глав;
+    вместо N-1 для сегмента подставляется оригинал предыдущего сегмента той же главы.
+    Результаты склеиваются по порядку. Возвращает (статус, текст) как translate_single_chapter.
+    """
+    segments = split_into_segments(current_chapter_text, config.SEGMENT_MAX_TOKENS)
+    if len(segments) <= 1:
+        return translate_single_chapter(filename, current_chapter_text, prev_ctx_list, glossary_data, source_filename=filename,
+                                        persist_glossary=persist_glossary)
+
+    logging.info(f" -> Глава {filename} разделена на {len(segments)} сегментов (до {config.SEGMENT_MAX_TOKENS} т.).")
+    base_name = os.path.splitext(filename)[0]
+    segment_ids = [f"{base_name}_seg{i + 1:02d}.txt" for i in range(len(segments))]
+    with ThreadPoolExecutor(max_workers=max(1, config.MAX_CONCURRENT_SEGMENTS), thread_name_prefix="segment") as executor:
+        futures = []
+        for i, (segment_id, segment_text) in enumerate(zip(segment_ids, segments)):
+            segment_ctx = list(prev_ctx_list)
+            if i > 0:
+                segment_ctx = (segment_ctx + [(f"{filename}, часть {i}", segments[i - 1])])[-3:]
+            futures.append(executor.submit(translate_single_chapter, segment_id, segment_text, segment_ctx, glossary_data, None, filename,
+                                           persist_glossary))
+        results = [future.result() for future in futures]
+
+    for i, (status, _) in enumerate(results):
+        if status != 'ok':
+            logging.error(f" -> Сегмент {i + 1}/{len(segments)} главы {filename} не переведен ({status}).")
+            return status, None
+    for segment_id in segment_ids:
+        remove_p1_checkpoint(segment_id)
+    return 'ok', "\n\n".join(text.strip() for _, text in results)
+
+
+# --- Пакетный перевод коротких глав ---
+def build_pack_prompt(pack_chapters):
+    """Суффикс промпта P2 для пакета коротких глав с явными разделителями для каждой главы (префикс общий)."""
+    chapters_section = "\n\n".join(f"[ТЕКУЩАЯ_ГЛАВА: {fn}]\n{text}\n[/ТЕКУЩАЯ_ГЛАВА]" for fn, text in pack_chapters)
+    return f"""**ИНСТРУКЦИЯ:**
+Ты — профессиональный переводчик китайских веб-новелл на русский язык. Твоя задача - максимально точно перевести КАЖДУЮ главу из секции [ГЛАВЫ_ДЛЯ_ПЕРЕВОДА] по отдельности.
 *   **СТРОГО следуй переводам** имен и терминов, указанным в [ГЛОССАРИЙ]. Не придумывай другие переводы для них.
 *   Используй [ПРЕДЫДУЩИЙ_КОНТЕКСТ] для понимания сюжета и стиля.
-*   **Не добавляй информацию**, которой нет в [ТЕКУЩАЯ_ГЛАВА].
-*   **В ответе предоставь ТОЛЬКО финальный русский перевод** текста из [ТЕКУЩАЯ_ГЛАВА], без каких-либо пояснений, заголовков или маркеров секций.
+*   **Не добавляй информацию**, которой нет в главах, и не объединяй главы.
+*   **Выведи перевод каждой главы СТРОГО между маркерами** [ПЕРЕВОД_ГЛАВЫ: имя_файла] и [/ПЕРЕВОД_ГЛАВЫ], в том же порядке, без пояснений и заголовков.
 
-**ИСПОЛЬЗУЙ ЭТИ ДАННЫЕ:**
+**ГЛАВЫ_ДЛЯ_ПЕРЕВОДА:**
+{chapters_section}
 
-**ГЛОССАРИЙ (Обязателен к использованию):**
-{formatted_glossary_p2}
+**ФИНАЛЬНЫЙ ПЕРЕВОД:**
+"""
 
-**ПРЕДЫДУЩИЙ КОНТЕКСТ:**
-{"".join(context_parts_p2)}
 
-**ТЕКСТ ДЛЯ ПЕРЕВОДА:**
-[ТЕКУЩАЯ_ГЛАВА: {filename}]
-{current_chapter_text}
-[/ТЕКУЩАЯ_ГЛАВА]
+def split_pack_response(response_text, filenames):
+    """Разбирает ответ на пакет: {имя_файла: перевод} для найденных глав."""
+    translations = {}
+    for fn in filenames:
+        match = re.search(r"\[ПЕРЕВОД_ГЛАВЫ:\s*" + re.escape(fn) + r"\s*\](.*?)\[/ПЕРЕВОД_ГЛАВЫ\]", response_text, re.DOTALL)
+        if match and match.group(1).strip():
+            translations[fn] = match.group(1).strip()
+    return translations
 
-**ФИНАЛЬНЫЙ ПЕРЕВОД:**
-"""
-            final_prompt_tokens_p2 = count_tokens(full_prompt_p2)
-            logging.info(f"   -> Промпт P2 (Попытка {translation_attempts}): {final_prompt_tokens_p2} т.")
-            if final_prompt_tokens_p2 > config.MAX_PROMPT_TOKENS: logging.warning(" -> Промпт P2 ПРЕВЫШАЕТ лимит!")
-
-            final_translated_text = call_gemini_api_with_retries(full_prompt_p2)
-
-            # --- Проверка на брак ---
-            if final_translated_text and "[ОШИБКА ПЕРЕВОДА:" not in final_translated_text:
-                if is_translation(final_translated_text, original_length):
-                    logging.warning(f" -> Обнаружен брак в переводе главы {filename} (Попытка {translation_attempts}). Повтор...")
-                    final_translated_text = None # Сбрасываем результат, чтобы цикл повторился
-                    time.sleep(config.DELAY_BETWEEN_REQUESTS * 2) # Увеличим паузу
-                else:
-                    logging.info(f" -> Проверка на брак пройдена (Попытка {translation_attempts}).")
-                    break # Брак не обнаружен, выходим из цикла попыток
-            elif not final_translated_text: # Если API вернул None после всех ретраев
-                 logging.error(f"Не получен финальный перевод P2 для {filename} (Попытка {translation_attempts}).")
-                 api_error_occurred = True
-                 break # Выходим из цикла попыток
-            else: # Если API вернул маркер ошибки
-                 logging.error(f"Ошибка API при финальном переводе P2 для {filename}: {final_translated_text}")
-                 api_error_occurred = True
-                 break # Выходим из цикла попыток
-            # --- Конец проверки на брак ---
-
-        # --- Обработка результата после цикла попыток ---
-        if api_error_occurred:
-             chapters_with_api_errors.append(filename)
-        elif final_translated_text:
+
+def translate_chapter_pack(pack_chapters, prev_ctx_list, glossary_data):
+    """
+    Переводит пакет подряд идущих коротких глав одним запросом на проход.
+    P1 для пакета всегда выполняется в режиме 'glossary_only' (по всем главам сразу), P2 - одним промптом
+    с разделителями глав. Глава, перевод которой не найден в ответе или не прошел проверку на брак,
+    переводится отдельно через translate_single_chapter.
+    Возвращает список (статус, текст) в порядке глав.
+    """
+    filenames = [fn for fn, _ in pack_chapters]
+    pack_id = f"{os.path.splitext(filenames[0])[0]}_pack{len(filenames)}.txt"
+    logging.info(f" -> Пакет из {len(filenames)} коротких глав: {filenames[0]} ... {filenames[-1]}")
+    combined_text = "\n\n".join(f"[ГЛАВА: {fn}]\n{text}" for fn, text in pack_chapters)
+    translations = {}
+
+    # === Проход 1: кандидаты в глоссарий по всему пакету (или чекпойнт) ===
+    checkpoint = load_p1_checkpoint(pack_id)
+    if checkpoint:
+        glossary_candidates = checkpoint.get('glossary_candidates') or {}
+        logging.info(f"   -> Проход 1 пакета {pack_id}: взят из чекпойнта.")
+    else:
+        with glossary_lock:
+            known_terms = select_glossary_terms(glossary_data, combined_text)
+            glossary_version = get_glossary_version(glossary_data)
+        response_p1 = call_gemini_api_with_retries(build_glossary_only_prompt(pack_id, combined_text, known_terms), generation_config=P1_GLOSSARY_GENERATION_CONFIG,
+                                                   chapter=pack_id, pass_name="pack_p1", source_chapter=", ".join(filenames),
+                                                   validate=lambda text: is_complete_p1_response(text, 'glossary_only'))
+        if response_p1 and "[ОШИБКА ПЕРЕВОДА:" not in response_p1:
+            glossary_candidates = parse_api_response_for_glossary(response_p1)
+            save_p1_checkpoint(pack_id, response_p1, glossary_candidates, glossary_version)
+        else:
+            logging.error(f"Не получен ответ P1 для пакета {pack_id}. Главы будут переведены по отдельности.")
+            glossary_candidates = None
+
+    if glossary_candidates is not None:
+        rag_context_str = build_rag_context(combined_text, filenames)
+        glossary_scope_text = "\n".join([combined_text, rag_context_str] + [txt for _, txt in prev_ctx_list])
+        with glossary_lock:
+            if update_glossary(glossary_data, glossary_candidates):
+                if not save_glossary_shared(glossary_data): logging.error("Крит. ошибка: Не сохранен глоссарий!");
+            formatted_glossary = format_glossary_for_prompt(glossary_data, glossary_scope_text)
+
+        # === Проход 2: перевод всех глав пакета одним запросом ===
+        pack_tokens = count_tokens(combined_text)
+        glossary_tokens = count_tokens(formatted_glossary)
+        context_budget = config.MAX_PROMPT_TOKENS - pack_tokens - glossary_tokens - config.PROMPT_RESERVE_TOKENS
+        context_parts, _ = pack_prompt_context(context_budget, rag_context_str, prev_ctx_list)
+
+        prompt_prefix = build_shared_prompt_prefix(formatted_glossary, context_parts)
+        prompt_suffix = build_pack_prompt(pack_chapters)
+        logging.info(f"   -> Промпт P2 пакета {pack_id}: {count_tokens(prompt_prefix) + count_tokens(prompt_suffix)} т.")
+        response_p2 = call_gemini_api_with_retries(prompt_suffix, prompt_prefix=prompt_prefix, chapter=pack_id, pass_name="pack_p2",
+                                                   source_chapter=", ".join(filenames),
+                                                   validate=lambda text: len(split_pack_response(text, filenames)) == len(filenames))
+        if response_p2 and "[ОШИБКА ПЕРЕВОДА:" not in response_p2:
+            translations = split_pack_response(response_p2, filenames)
+        else:
+            logging.error(f"Не получен ответ P2 для пакета {pack_id}. Главы будут переведены по отдельности.")
+
+    # --- Проверка каждой главы и перевод отдельно при неудаче ---
+    results = []
+    ctx_list = list(prev_ctx_list)
+    for fn, text in pack_chapters:
+        translation = translations.get(fn)
+        if translation and not is_translation(translation, len(text)):
+            results.append(('ok', translation))
+        else:
+            logging.warning(f" -> Глава {fn} из пакета не извлечена или с браком. Переводим отдельно.")
+            results.append(translate_single_chapter(fn, text, ctx_list[-3:], glossary_data))
+        ctx_list.append((fn, text))
+    remove_p1_checkpoint(pack_id)
+    return results
+
+
+# --- Основная функция перевода ---
+# --- План перевода без запросов к API ---
+# Типичная длина списка новых терминов в ответе P1, токенов
+PLAN_GLOSSARY_OUTPUT_TOKENS = 300
+
+
+def add_planned_request(plan, pass_name, prompt_tokens, output_tokens):
+    stats = plan["passes"].setdefault(pass_name, {"requests": 0, "prompt_tokens": 0, "output_tokens": 0})
+    stats["requests"] += 1
+    stats["prompt_tokens"] += prompt_tokens
+    stats["output_tokens"] += output_tokens
+
+
+def estimate_planned_context_tokens(chapter_text, prev_ctx_list, budget_tokens):
+    """
+    Токены контекста главы без запросов к API и поиска в RAG: RAG_NUM_RESULTS абзацев средней длины,
+    недавние главы как в build_recent_context_parts или краткие содержания полной длины (режим 'summary').
+    """
+    summary_store = get_summary_store()
+    rag_tokens = 0
+    if config.RAG_ENABLED and config.RAG_NUM_RESULTS > 0 and prev_ctx_list: # RAG для плана не загружается
+        paragraphs = [p for p in re.split(r'\n\s*\n+', chapter_text) if p.strip()]
+        rag_tokens = min(budget_tokens, config.RAG_NUM_RESULTS * (count_tokens(chapter_text) // max(1, len(paragraphs)) + 20))
+    if summary_store:
+        words = len(prev_ctx_list[-3:]) * config.SUMMARY_CHAPTER_MAX_WORDS + (config.SUMMARY_STORY_MAX_WORDS if len(prev_ctx_list) > 3 else 0)
+        recent_tokens = count_tokens(" ".join(["слово"] * words)) + (config.PREVIOUS_CHUNK_TOKENS if prev_ctx_list else 0)
+        return rag_tokens + max(0, min(recent_tokens, budget_tokens - rag_tokens))
+    _, recent_tokens = build_recent_context_parts(prev_ctx_list, budget_tokens - rag_tokens)
+    return rag_tokens + recent_tokens
+
+
+def plan_prompt_prefix_tokens(scope_text, source_tokens, prev_ctx_list, glossary_data):
+    """Размер общего префикса P1/P2 (глоссарий по области поиска терминов и контекст) для плана."""
+    glossary_tokens = count_tokens(format_glossary_for_prompt(glossary_data, scope_text))
+    context_budget = config.MAX_PROMPT_TOKENS - source_tokens - glossary_tokens - config.PROMPT_RESERVE_TOKENS
+    return (count_tokens(build_shared_prompt_prefix("", [])) + glossary_tokens
+            + estimate_planned_context_tokens(scope_text, prev_ctx_list, context_budget))
+
+
+def plan_summaries(plan, filename, chapter_text, has_story):
+    """Запросы кратких содержаний главы (если их еще нет в хранилище)."""
+    summary_store = get_summary_store()
+    if not summary_store or summary_store.get(KIND_CHAPTER, filename):
+        return
+    summary_tokens = count_tokens(" ".join(["слово"] * config.SUMMARY_CHAPTER_MAX_WORDS))
+    story_tokens = count_tokens(" ".join(["слово"] * config.SUMMARY_STORY_MAX_WORDS))
+    add_planned_request(plan, "summary", count_tokens(build_chapter_summary_prompt(filename, chapter_text)), summary_tokens)
+    if has_story:
+        add_planned_request(plan, "story_summary", count_tokens(build_story_summary_prompt("", filename, "")) + story_tokens + summary_tokens, story_tokens)
+
+
+def plan_single_chapter(plan, filename, chapter_text, prev_ctx_list, glossary_data, source_filename=None):
+    """Запросы P1/P2 главы (или ее сегментов) по той же логике сборки промптов, что и translate_single_chapter."""
+    chapter_tokens = count_tokens(chapter_text)
+    if config.SEGMENTATION_ENABLED and source_filename is None:
+        chapter_tokens = count_tokens_near_budget(chapter_tokens, config.SEGMENT_MAX_TOKENS, chapter_text)
+        if chapter_tokens > config.SEGMENT_MAX_TOKENS:
+            segments = split_into_segments(chapter_text, config.SEGMENT_MAX_TOKENS)
+            if len(segments) > 1:
+                for i, segment_text in enumerate(segments):
+                    segment_ctx = list(prev_ctx_list) if i == 0 else (list(prev_ctx_list) + [(f"{filename}, часть {i}", segments[i - 1])])[-3:]
+                    plan_single_chapter(plan, f"{os.path.splitext(filename)[0]}_seg{i + 1:02d}.txt", segment_text, segment_ctx, glossary_data, filename)
+                return
+    scope_text = "\n".join([chapter_text] + [txt for _, txt in prev_ctx_list])
+    prefix_tokens = plan_prompt_prefix_tokens(scope_text, chapter_tokens, prev_ctx_list, glossary_data)
+    output_tokens = int(chapter_tokens * config.PLAN_OUTPUT_TOKENS_PER_SOURCE_TOKEN)
+    if config.P1_MODE == 'glossary_only':
+        add_planned_request(plan, "p1_glossary", count_tokens(build_glossary_only_prompt(filename, chapter_text, [])), PLAN_GLOSSARY_OUTPUT_TOKENS)
+    else:
+        add_planned_request(plan, "p1", estimate_prompt_tokens(prefix_tokens, build_first_pass_prompt, filename, chapter_text),
+                            output_tokens + PLAN_GLOSSARY_OUTPUT_TOKENS)
+    add_planned_request(plan, "p2", estimate_prompt_tokens(prefix_tokens, build_second_pass_prompt, filename, "", chapter_text), output_tokens)
+
+
+def plan_chapter_pack(plan, pack_chapters, prev_ctx_list, glossary_data):
+    """Запросы пакета коротких глав: P1 'glossary_only' и P2 одним промптом на пакет."""
+    pack_id = f"{os.path.splitext(pack_chapters[0][0])[0]}_pack{len(pack_chapters)}.txt"
+    combined_text = "\n\n".join(f"[ГЛАВА: {fn}]\n{text}" for fn, text in pack_chapters)
+    pack_tokens = count_tokens(combined_text)
+    add_planned_request(plan, "pack_p1", count_tokens(build_glossary_only_prompt(pack_id, combined_text, [])), PLAN_GLOSSARY_OUTPUT_TOKENS)
+    scope_text = "\n".join([combined_text] + [txt for _, txt in prev_ctx_list])
+    prefix_tokens = plan_prompt_prefix_tokens(scope_text, pack_tokens, prev_ctx_list, glossary_data)
+    add_planned_request(plan, "pack_p2", prefix_tokens + count_tokens(build_pack_prompt(pack_chapters)),
+                        int(pack_tokens * config.PLAN_OUTPUT_TOKENS_PER_SOURCE_TOKEN))
+
+
+def estimate_plan_wall_time(plan):
+    """
+    Ожидаемое время перевода, сек.: наибольшее из ограничений RPM, TPM (ограничитель резервирует
+    промпт * 2 токенов на запрос) и суммарной длительности запросов, деленной на MAX_CONCURRENT_CHAPTERS.
+    Скорость генерации берется из журнала расхода квоты, если в нем есть данные.
+    """
+    output_tps = config.PLAN_OUTPUT_TOKENS_PER_SECOND
+    usage_ledger = get_usage_ledger() if os.path.exists(config.USAGE_LEDGER_FILE) else None # Журнал для плана не создается
+    if usage_ledger:
+        answered = [stats for pass_name, stats in usage_ledger.summary()["passes"].items() if pass_name != RETRY_PASS]
+        observed_tokens = sum(stats["candidates_tokens"] for stats in answered)
+        observed_seconds = sum(stats["seconds"] for stats in answered) - config.PLAN_REQUEST_OVERHEAD_SECONDS * sum(stats["requests"] for stats in answered)
+        if observed_tokens and observed_seconds > 0:
+            output_tps = observed_tokens / observed_seconds
+    rate_limit_rpm, rate_limit_tpm = get_rate_limits()
+    requests = sum(stats["requests"] for stats in plan["passes"].values())
+    prompt_tokens = sum(stats["prompt_tokens"] for stats in plan["passes"].values())
+    output_tokens = sum(stats["output_tokens"] for stats in plan["passes"].values())
+    bounds = {
+        "rpm": requests / rate_limit_rpm * 60,
+        "tpm": prompt_tokens * 2 / rate_limit_tpm * 60,
+        "latency": (requests * config.PLAN_REQUEST_OVERHEAD_SECONDS + output_tokens / output_tps) / max(1, config.MAX_CONCURRENT_CHAPTERS),
+    }
+    bottleneck = max(bounds, key=bounds.get)
+    return {"seconds": bounds[bottleneck], "bottleneck": bottleneck, "bounds_seconds": bounds, "output_tokens_per_second": output_tps}
+
+
+def plan_translation():
+    """
+    План Фазы 2 без запросов к API: ожидающие главы, число запросов, токены промпта и ответа по проходам,
+    оценка стоимости (config.USAGE_PRICES_PER_MILLION) и времени при настроенных лимитах.
+    Повторяет выбор глав, пакетов, сегментов и сборку контекста translate_chapters; глоссарий берется текущий,
+    поэтому его рост по ходу перевода, повторы и попадания в кэш ответов не учитываются.
+    """
+    glossary_data = load_glossary()
+    original_files = sorted(f for f in os.listdir(config.ORIGINAL_CHAPTERS_DIR) if f.endswith(".txt"))
+    finished_chapters = get_finished_chapters(original_files, record=False) # План ничего не записывает
+    plan = {"chapters_total": len(original_files), "chapters_pending": 0, "passes": {}}
+    context_queue = deque(maxlen=4)
+    pending_pack = []; pending_pack_tokens = 0; pending_pack_ctx = []
+
+    def flush_pack():
+        nonlocal pending_pack, pending_pack_tokens
+        if len(pending_pack) == 1:
+            plan_single_chapter(plan, pending_pack[0][0], pending_pack[0][1], pending_pack_ctx, glossary_data)
+        elif pending_pack:
+            plan_chapter_pack(plan, pending_pack, pending_pack_ctx, glossary_data)
+        pending_pack = []; pending_pack_tokens = 0
+
+    for filename in original_files:
+        if filename in finished_chapters:
+            flush_pack()
+            context_queue.append((filename, None))
+            continue
+        chapter_text = read_original_chapter(filename).strip()
+        if not chapter_text:
+            continue
+        plan["chapters_pending"] += 1
+        plan_summaries(plan, filename, chapter_text, bool(context_queue))
+        if config.PACKING_ENABLED:
+            chapter_tokens = count_tokens(chapter_text)
+            if chapter_tokens <= config.PACK_MAX_CHAPTER_TOKENS:
+                if pending_pack and (pending_pack_tokens + chapter_tokens > config.PACK_TOKEN_BUDGET or len(pending_pack) >= config.PACK_MAX_CHAPTERS):
+                    flush_pack()
+                if not pending_pack:
+                    pending_pack_ctx = load_context_snapshot(context_queue)
+                pending_pack.append((filename, chapter_text)); pending_pack_tokens += chapter_tokens
+                context_queue.append((filename, chapter_text))
+                continue
+            flush_pack()
+        plan_single_chapter(plan, filename, chapter_text, load_context_snapshot(context_queue), glossary_data)
+        context_queue.append((filename, chapter_text))
+    flush_pack()
+
+    plan["requests"] = sum(stats["requests"] for stats in plan["passes"].values())
+    plan["prompt_tokens"] = sum(stats["prompt_tokens"] for stats in plan["passes"].values())
+    plan["output_tokens"] = sum(stats["output_tokens"] for stats in plan["passes"].values())
+    plan["cost"] = estimate_cost(config.USAGE_PRICES_PER_MILLION, config.MODEL_NAME, plan["prompt_tokens"], plan["output_tokens"], 0)
+    plan["wall_time"] = estimate_plan_wall_time(plan)
+    rate_limit_rpm, rate_limit_tpm = get_rate_limits()
+    plan["rate_limits"] = {"rpm": rate_limit_rpm, "tpm": rate_limit_tpm, "max_concurrent_chapters": config.MAX_CONCURRENT_CHAPTERS}
+    return plan
+
+
+# --- Возобновление перевода ---
+def get_finished_chapters(original_files, record=True):
+    """
+    Главы, которые не нужно переводить: перевод уже есть в папке переводов (один listdir, файлы не читаются)
+    или оригинал пуст по манифесту. Найденные переводы, которых нет в манифесте, отмечаются в нем
+    (record=False - только чтение, например для плана).
+    """
+    try:
+        translated_files = set(os.listdir(config.TRANSLATED_CHAPTERS_DIR))
+    except FileNotFoundError:
+        translated_files = set()
+    finished = {filename for filename in original_files if filename.replace(".txt", "_ru.txt") in translated_files}
+    # Только для чтения манифест открывается, если он уже есть (план не создает файлов)
+    chapter_manifest = get_chapter_manifest() if record or os.path.exists(config.CHAPTER_MANIFEST_FILE) else None
+    if not chapter_manifest:
+        return finished
+    statuses = chapter_manifest.statuses()
+    unrecorded = [filename for filename in finished if statuses.get(filename) != STATUS_DONE]
+    if unrecorded and record:
+        chapter_manifest.mark_done(unrecorded)
+    return finished | {filename for filename, status in statuses.items() if status == STATUS_EMPTY}
+
+
+def set_chapter_status(filename, status):
+    """Записывает статус главы в манифест (если он включен) и снимает аренду главы в очереди."""
+    chapter_manifest = get_chapter_manifest()
+    job_queue = get_job_queue()
+    if chapter_manifest:
+        chapter_manifest.set_status(filename, status)
+    if job_queue and filename in job_queue_claimed:
+        job_queue_claimed.discard(filename)
+        if status in (STATUS_DONE, STATUS_EMPTY):
+            job_queue.complete(filename)
+        else:
+            job_queue.fail(filename)
+
+
+def claim_chapter(filename, glossary_data):
+    """
+    Берет главу в аренду в очереди; False - главу переводит другой процесс (или она уже переведена).
+    Перед арендой в glossary_data добавляются термины, которые другие процессы успели записать в общий глоссарий.
+    """
+    job_queue = get_job_queue()
+    if not job_queue:
+        return True
+    with glossary_lock:
+        with job_queue.exclusive():
+            merge_shared_glossary(glossary_data)
+    if not job_queue.claim(filename):
+        return False
+    job_queue_claimed.add(filename)
+    return True
+
+
+def release_chapter(filename):
+    """Возвращает главу в очередь, не переведя ее."""
+    job_queue = get_job_queue()
+    if job_queue and filename in job_queue_claimed:
+        job_queue_claimed.discard(filename)
+        job_queue.release(filename)
+
+
+def merge_shared_glossary(glossary_data):
+    """
+    Добавляет в glossary_data термины других процессов из общего файла глоссария
+    (вызывать под glossary_lock и job_queue.exclusive()). Возвращает глоссарий, прочитанный с диска.
+    """
+    on_disk = load_glossary()
+    from_others = {term: value for term, value in on_disk.items() if term not in glossary_data}
+    for term, value in from_others.items():
+        glossary_data[term] = value
+        glossary_matcher.add(term)
+    if from_others:
+        logging.info(f"[Очередь] Из общего глоссария получено терминов других процессов: {len(from_others)}.")
+    return on_disk
+
+
+def save_glossary_shared(glossary_data):
+    """
+    Сохраняет глоссарий (вызывать под glossary_lock). С очередью глав файл общий для нескольких процессов:
+    под блокировкой очереди глоссарий перечитывается с диска, термины других процессов добавляются
+    в glossary_data, термины этого процесса - в файл, чтобы не затереть чужие.
+    """
+    job_queue = get_job_queue()
+    if not job_queue:
+        return save_glossary(glossary_data, config.GLOSSARY_FILE)
+    with job_queue.exclusive():
+        merged = merge_shared_glossary(glossary_data)
+        merged.update(glossary_data)
+        return save_glossary(merged, config.GLOSSARY_FILE)
+
+
+def load_context_snapshot(context_queue):
+    """
+    Снимок очереди контекста предыдущих глав. Тексты уже переведенных глав кладутся в очередь как None
+    и читаются только здесь, поэтому при возобновлении читаются оригиналы не больше 4 последних глав.
+    """
+    for i, (filename, text) in enumerate(context_queue):
+        if text is None:
+            context_queue[i] = (filename, read_original_chapter(filename))
+            logging.debug(f" -> Добавлен текст пропущенной главы '{filename}' в контекст.")
+    return [(filename, text) for filename, text in context_queue if text]
+
+
+def translate_chapters():
+    """
+    Переводит главы (двухпроходная система с Google Gemini).
+    До config.MAX_CONCURRENT_CHAPTERS глав обрабатываются одновременно в пуле потоков;
+    результаты записываются строго в порядке глав.
+    """
+    chapter_manifest = get_chapter_manifest()
+    job_queue = get_job_queue()
+    logging.info("--- Начало Фазы 2: Перевод глав (Двухпроходный с Google Gemini и RAG) ---")
+    ensure_dir_exists(config.TRANSLATED_CHAPTERS_DIR)
+
+    if config.RAG_ENABLED:
+        if is_rag_ready():
+            index_all_chapters(force_reindex=False, manifest=chapter_manifest)
+        else:
+            logging.error("RAG включен, но не удалось инициализировать. Перевод без RAG.")
+    else:
+        logging.info("RAG отключен.")
+
+    glossary_data = load_glossary()
+
+    try:
+        original_files = sorted([f for f in os.listdir(config.ORIGINAL_CHAPTERS_DIR) if f.endswith(".txt")])
+        logging.info(f"Найдено {len(original_files)} оригинальных глав.")
+    except FileNotFoundError:
+        logging.error(f"Папка с оригинальными главами не найдена: {config.ORIGINAL_CHAPTERS_DIR}")
+        return False
+    except Exception as e:
+        logging.error(f"Ошибка чтения папки оригиналов: {e}")
+        return False
+
+    max_workers = max(1, config.MAX_CONCURRENT_CHAPTERS)
+    logging.info(f"Одновременно переводимых глав: до {max_workers}.")
+
+    # --- Возобновление: сразу к первой непереведенной главе ---
+    finished_chapters = get_finished_chapters(original_files)
+    first_pending = next((i for i, filename in enumerate(original_files) if filename not in finished_chapters), len(original_files))
+    if first_pending:
+        logging.info(f"Возобновление: {first_pending} глав уже переведено, начинаем с главы {first_pending + 1}.")
+    if job_queue:
+        job_queue.add(original_files, done=finished_chapters)
+        job_queue.start_heartbeat(config.JOB_HEARTBEAT_SECONDS)
+    skipped_by_queue = 0
+
+    # Контекст N-1/N-2/N-3 строится из ОРИГИНАЛОВ предыдущих глав, поэтому снимок
+    # очереди можно сделать в момент постановки главы в работу, не дожидаясь перевода предыдущих.
+    previous_chapters_context_queue = deque(maxlen=4) # Храним (filename, text); text None - прочитать при снимке
+    for filename in original_files[max(0, first_pending - 4):first_pending]:
+        previous_chapters_context_queue.append((filename, None))
+    total_chapters = len(original_files); processed_count = 0; chapters_with_api_errors = []; chapters_with_брак = []
+    in_flight = deque() # ([(filename, translated_filepath), ...], future) в порядке глав
+    pending_pack = []; pending_pack_tokens = 0; pending_pack_ctx = [] # Накопление коротких глав для пакета
+
+    def write_results(chapter_entries, future):
+        """Дожидается результата задачи (глава или пакет) и сохраняет главы (строго по порядку)."""
+        try:
+            results = future.result()
+            if len(chapter_entries) == 1: results = [results]
+        except Exception:
+            logging.exception(f"Непредвиденная ошибка при переводе глав {[fn for fn, _ in chapter_entries]}")
+            results = [('api_error', None)] * len(chapter_entries)
+        for (filename, translated_filepath), (status, final_translated_text) in zip(chapter_entries, results):
+            write_result(filename, translated_filepath, status, final_translated_text)
+
+    def write_result(filename, translated_filepath, status, final_translated_text):
+        nonlocal processed_count
+        translated_filename = os.path.basename(translated_filepath)
+        partial_filepath = translated_filepath + ".part"
+        if os.path.exists(partial_filepath):
+            try: os.remove(partial_filepath)
+            except OSError as e: logging.warning(f"Не удалось удалить {partial_filepath}: {e}")
+
+        if status == 'api_error':
+            chapters_with_api_errors.append(filename)
+            set_chapter_status(filename, STATUS_API_ERROR)
+        elif status == 'ok':
             try:
-                with open(translated_filepath, 'w', encoding='utf-8') as f: f.write(final_translated_text.strip())
+                # Запись через временный файл: другие процессы очереди видят только готовый перевод
+                tmp_filepath = translated_filepath + ".tmp"
+                with open(tmp_filepath, 'w', encoding='utf-8') as f: f.write(final_translated_text.strip())
+                os.replace(tmp_filepath, translated_filepath)
                 logging.info(f" -> Финальный перевод сохранен в: {translated_filename}")
-                previous_chapters_context_queue.append((filename, current_chapter_text))
+                remove_p1_checkpoint(filename)
+                set_chapter_status(filename, STATUS_DONE)
                 processed_count += 1
-            except IOError as e: logging.error(f"Ошибка записи перевода {translated_filename}: {e}")
-        else: # Если все попытки не дали результата (из-за брака)
-             logging.error(f"Не удалось получить качественный перевод для {filename} после {max_translation_attempts} попыток (брак). Глава пропущена.")
-             chapters_with_брак.append(filename)
+            except IOError as e:
+                logging.error(f"Ошибка записи перевода {translated_filename}: {e}")
+                release_chapter(filename)
+        else:
+            chapters_with_брак.append(filename)
+            set_chapter_status(filename, STATUS_REJECTED)
+
+    def submit(chapter_entries, task, *args):
+        """Ставит задачу в пул, предварительно ограничивая число задач "в полете"."""
+        while len(in_flight) >= max_workers:
+            write_results(*in_flight.popleft())
+        in_flight.append((chapter_entries, executor.submit(task, *args)))
+
+    def flush_pack():
+        """Отправляет накопленные короткие главы (одна глава уходит обычным путем)."""
+        nonlocal pending_pack, pending_pack_tokens
+        if len(pending_pack) == 1:
+            filename, text, translated_filepath = pending_pack[0]
+            stream_path = translated_filepath + ".part" if config.STREAMING_ENABLED else None
+            submit([(filename, translated_filepath)], translate_single_chapter, filename, text, pending_pack_ctx, glossary_data, stream_path)
+        elif pending_pack:
+            submit([(fn, path) for fn, _, path in pending_pack], translate_chapter_pack,
+                   [(fn, text) for fn, text, _ in pending_pack], pending_pack_ctx, glossary_data)
+        pending_pack = []; pending_pack_tokens = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chapter") as executor:
+        for chapter_index, filename in enumerate(original_files[first_pending:], start=first_pending):
+            chapter_number = chapter_index + 1
+            original_filepath = os.path.join(config.ORIGINAL_CHAPTERS_DIR, filename)
+            translated_filename = filename.replace(".txt", "_ru.txt")
+            translated_filepath = os.path.join(config.TRANSLATED_CHAPTERS_DIR, translated_filename)
+
+            logging.info(f"--- Обработка главы {chapter_number}/{total_chapters}: {filename} ---")
+
+            # --- Проверка на существование перевода ---
+            if filename in finished_chapters:
+                logging.info(f" -> Пропуск: {translated_filename} уже существует.")
+                flush_pack() # Пакет - только из подряд идущих глав
+                # Оригинал для контекста следующих глав прочитается, только если попадет в их снимок
+                previous_chapters_context_queue.append((filename, None))
+                continue
+
+            # --- Очередь: главу мог взять другой процесс ---
+            if not claim_chapter(filename, glossary_data):
+                logging.info(f" -> Пропуск: {filename} переводится другим процессом (или исчерпаны попытки).")
+                skipped_by_queue += 1
+                flush_pack()
+                previous_chapters_context_queue.append((filename, None))
+                continue
+
+            # --- Чтение текущей главы ---
+            try:
+                with open(original_filepath, 'r', encoding=config.INPUT_FILE_ENCODING) as f:
+                    current_chapter_text = f.read().strip()
+                if not current_chapter_text:
+                    logging.warning(f" -> Файл главы {filename} пуст. Пропуск.")
+                    set_chapter_status(filename, STATUS_EMPTY)
+                    continue
+                logging.debug(f" -> Текст главы '{filename}' прочитан ({len(current_chapter_text)} симв).")
+            except Exception as e:
+                logging.error(f"Ошибка чтения файла главы {filename}: {e}")
+                release_chapter(filename)
+                continue
 
-        logging.debug(f"Пауза {config.DELAY_BETWEEN_REQUESTS} сек...")
-        time.sleep(config.DELAY_BETWEEN_REQUESTS)
-        chapter_index += 1 # Переходим к следующей главе
-        # --- КОНЕЦ ЦИКЛА WHILE ПО ГЛАВАМ ---
+            # --- Короткие главы копим в пакет ---
+            if config.PACKING_ENABLED:
+                chapter_tokens = count_tokens(current_chapter_text)
+                if chapter_tokens <= config.PACK_MAX_CHAPTER_TOKENS:
+                    if pending_pack and (pending_pack_tokens + chapter_tokens > config.PACK_TOKEN_BUDGET or len(pending_pack) >= config.PACK_MAX_CHAPTERS):
+                        flush_pack()
+                    if not pending_pack:
+                        pending_pack_ctx = load_context_snapshot(previous_chapters_context_queue)
+                    pending_pack.append((filename, current_chapter_text, translated_filepath)); pending_pack_tokens += chapter_tokens
+                    previous_chapters_context_queue.append((filename, current_chapter_text))
+                    continue
+                flush_pack()
+
+            prev_ctx_list = load_context_snapshot(previous_chapters_context_queue)
+            stream_path = translated_filepath + ".part" if config.STREAMING_ENABLED else None
+            submit([(filename, translated_filepath)], translate_single_chapter, filename, current_chapter_text, prev_ctx_list, glossary_data, stream_path)
+            previous_chapters_context_queue.append((filename, current_chapter_text))
+            # --- КОНЕЦ ЦИКЛА ПО ГЛАВАМ ---
+
+        flush_pack()
+        while in_flight:
+            write_results(*in_flight.popleft())
 
     # --- ЗАВЕРШЕНИЕ ФАЗЫ 2 ---
     logging.info(f"--- Завершение Фазы 2: Перевод глав (Google Gemini). Успешно: {processed_count}/{total_chapters} ---")
     if chapters_with_api_errors: logging.warning(f"Главы с ошибками API: {chapters_with_api_errors}")
     if chapters_with_брак: logging.warning(f"Главы с обнаруженным браком (пропущены): {chapters_with_брак}")
-    save_glossary(glossary_data, config.GLOSSARY_FILE)
+    if job_queue:
+        job_queue.stop_heartbeat()
+        counts, leased = job_queue.counts()
+        logging.info(f"[Очередь] Пропущено глав, взятых другими процессами: {skipped_by_queue}. "
+                     f"Состояние очереди: {counts}, в аренде: {leased or 'нет'}.")
+    log_response_cache_stats()
+    log_retry_stats()
+    log_backend_router_stats()
+    release_context_cache()
+    save_token_calibration()
+    with glossary_lock:
+        save_glossary_shared(glossary_data)
     return total_chapters > 0 and (processed_count > 0 or not (chapters_with_api_errors or chapters_with_брак)) # Успех, если нет непереведенных из-за ошибок
 
 # if __name__ == "__main__":
-#     translate_chapters()
\ No newline at end of file
+#     translate_chapters()
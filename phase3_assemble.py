@@ -8,24 +8,8 @@ from ebooklib import epub
 # BeautifulSoup здесь может не понадобиться, так как мы работаем с текстом
 import config
 from utils.file_utils import ensure_dir_exists, sanitize_filename
-# --- Импортируем функцию вызова API из phase2_translate ---
-# Это немного нарушает модульность, но для простоты пока так.
-# В идеале, API-вызовы должны быть в отдельном utils модуле.
-from phase2_translate import call_gemini_api_with_retries, count_tokens
-
-# Настройка логирования
-# ... (остается как было) ...
-log_file_path = config.LOG_FILE
-ensure_dir_exists(config.LOG_DIR)
-for handler in logging.root.handlers[:]: logging.root.removeHandler(handler)
-logging.basicConfig(
-    level=getattr(logging, config.LOG_LEVEL.upper(), logging.INFO),
-    format='%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file_path, encoding='utf-8', mode='a'),
-        logging.StreamHandler()
-    ]
-)
+# Функции вызова API берутся из phase2_translate; модуль импортируется только при переводе названий
+# (см. translate_chapter_titles_batch), чтобы сборка EPUB без перевода названий не загружала клиент API.
 
 def extract_original_title_from_filename(filename_cn):
     """Извлекает "чистое" оригинальное название главы из имени файла."""
@@ -44,6 +28,7 @@ def translate_chapter_titles_batch(titles_cn_list):
     """
     if not titles_cn_list:
         return {}
+    from phase2_translate import call_gemini_api_with_retries, count_tokens
 
     logging.info(f"Пакетный перевод {len(titles_cn_list)} названий глав...")
 
@@ -90,7 +75,7 @@ def translate_chapter_titles_batch(titles_cn_list):
         return {title_cn: title_cn for title_cn in titles_cn_list}
 
     # Вызываем API
-    response_text = call_gemini_api_with_retries(full_prompt)
+    response_text = call_gemini_api_with_retries(full_prompt, pass_name="titles")
     translated_titles_map = {}
 
     if response_text and "[ОШИБКА ПЕРЕВОДА:" not in response_text:
@@ -156,6 +141,39 @@ def translate_chapter_titles_batch(titles_cn_list):
     return translated_titles_map
 
 
+def load_title_translations():
+    """Сохраненные переводы названий глав {оригинал: перевод} (config.TITLE_TRANSLATIONS_FILE)."""
+    if not os.path.exists(config.TITLE_TRANSLATIONS_FILE):
+        return {}
+    try:
+        with open(config.TITLE_TRANSLATIONS_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logging.warning(f"Не удалось загрузить переводы названий {config.TITLE_TRANSLATIONS_FILE}: {e}")
+        return {}
+
+
+def translate_new_chapter_titles(titles_cn_list):
+    """
+    Переводы названий: сохраненные берутся из TITLE_TRANSLATIONS_FILE, в API уходят только новые.
+    Названия, оставшиеся без перевода (ошибка API), не сохраняются и запрашиваются в следующий раз.
+    """
+    known_titles = load_title_translations()
+    new_titles = [title for title in titles_cn_list if title.strip() and title not in known_titles]
+    if new_titles:
+        logging.info(f"Названий глав с сохраненным переводом: {len(titles_cn_list) - len(new_titles)}, новых: {len(new_titles)}.")
+        translated = translate_chapter_titles_batch(new_titles)
+        known_titles.update({title: translation for title, translation in translated.items() if translation != title})
+        try:
+            tmp_path = config.TITLE_TRANSLATIONS_FILE + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(known_titles, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, config.TITLE_TRANSLATIONS_FILE)
+        except Exception as e:
+            logging.warning(f"Не удалось сохранить переводы названий: {e}")
+    return {title: known_titles.get(title, title) for title in titles_cn_list}
+
+
 def prepare_chapters_with_titles(original_titles_map, translated_titles_map):
     """
     Создает новые файлы глав с добавленным переведенным названием в начало.
@@ -163,7 +181,7 @@ def prepare_chapters_with_titles(original_titles_map, translated_titles_map):
     """
     logging.info("Подготовка глав с переведенными названиями...")
     ensure_dir_exists(config.TRANSLATED_CHAPTERS_WITH_TITLES_DIR)
-    processed_count = 0
+    processed_count = 0; unchanged_count = 0
 
     for original_filename, original_title_text in original_titles_map.items():
         translated_chapter_filepath = os.path.join(config.TRANSLATED_CHAPTERS_DIR, original_filename.replace(".txt", "_ru.txt"))
@@ -174,14 +192,22 @@ def prepare_chapters_with_titles(original_titles_map, translated_titles_map):
             continue
 
         try:
-            with open(translated_chapter_filepath, 'r', encoding='utf-8') as f_in:
-                chapter_content_ru = f_in.read()
-
             # Получаем переведенное название (или используем оригинальное, если перевод не удался)
             translated_title = translated_titles_map.get(original_title_text, original_title_text)
             # Убираем возможные номера и маркеры из переведенного названия для чистоты
             clean_display_title = re.sub(r"^\d+[、.\s]+", "", translated_title).strip()
 
+            # Файл уже подготовлен после последнего перевода главы и с тем же названием - не переписываем
+            if os.path.exists(output_filepath_with_title) and os.path.getmtime(output_filepath_with_title) >= os.path.getmtime(translated_chapter_filepath):
+                with open(output_filepath_with_title, 'r', encoding='utf-8') as f_prepared:
+                    prepared_head = "".join(f_prepared.readline() for _ in range(3))
+                if clean_display_title.lower() in prepared_head.lower():
+                    unchanged_count += 1
+                    continue
+
+            with open(translated_chapter_filepath, 'r', encoding='utf-8') as f_in:
+                chapter_content_ru = f_in.read()
+
 
             # Проверяем, не содержится ли уже заголовок (очень простая проверка)
             first_few_lines = "\n".join(chapter_content_ru.splitlines()[:3])
@@ -199,7 +225,7 @@ def prepare_chapters_with_titles(original_titles_map, translated_titles_map):
         except Exception as e:
             logging.error(f"Ошибка при подготовке файла {original_filename} с заголовком: {e}")
 
-    logging.info(f"Подготовлено {processed_count} файлов глав с добавленными названиями.")
+    logging.info(f"Подготовлено {processed_count} файлов глав с добавленными названиями (без изменений: {unchanged_count}).")
     return config.TRANSLATED_CHAPTERS_WITH_TITLES_DIR
 
 
@@ -273,8 +299,8 @@ def assemble_epub():
         }
         titles_cn_list = list(original_titles_map.values())
 
-        # 2. Переводим названия глав
-        translated_titles_map_by_original_text = translate_chapter_titles_batch(titles_cn_list)
+        # 2. Переводим названия глав (только новые, остальные - из сохраненных переводов)
+        translated_titles_map_by_original_text = translate_new_chapter_titles(titles_cn_list)
 
         # Создаем карту filename -> translated_title
         filename_to_translated_title = {
@@ -0,0 +1,89 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.context_cache import ContextCacheBase
+
+
+class FakeContextCache(ContextCacheBase):
+    """Кэш с фиктивным провайдером: считает создания и удаления, может падать или задерживать создание."""
+
+    def __init__(self, ttl_seconds=60, max_entries=10, create_delay=0.0, fail=False):
+        super().__init__(ttl_seconds, max_entries)
+        self.create_delay = create_delay
+        self.fail = fail
+        self.created_prefixes = []
+        self.deleted = []
+        self.fake_lock = threading.Lock()
+
+    def _create(self, prefix_text):
+        time.sleep(self.create_delay)
+        if self.fail:
+            raise RuntimeError("provider error")
+        with self.fake_lock:
+            self.created_prefixes.append(prefix_text)
+        return f"client:{prefix_text}", f"handle:{prefix_text}"
+
+    def _delete(self, handle):
+        self.deleted.append(handle)
+
+
+class ContextCacheTest(unittest.TestCase):
+
+    def test_create_and_reuse(self):
+        cache = FakeContextCache()
+        self.assertEqual(cache.get_client("a"), "client:a")
+        self.assertEqual(cache.get_client("a"), "client:a")
+        self.assertEqual(cache.created_prefixes, ["a"])
+        self.assertEqual(cache.stats(), {"created": 1, "reused": 1, "expired": 0, "failed": 0, "active": 1})
+
+    def test_evicts_least_recently_used(self):
+        cache = FakeContextCache(max_entries=2)
+        cache.get_client("a"); cache.get_client("b")
+        cache.get_client("a")
+        cache.get_client("c")
+        self.assertEqual(cache.deleted, ["handle:b"])
+        self.assertEqual(cache.stats()["active"], 2)
+
+    def test_expired_entries_are_deleted(self):
+        cache = FakeContextCache(ttl_seconds=0)
+        cache.get_client("a")
+        cache.get_client("a")
+        self.assertEqual(cache.created_prefixes, ["a", "a"])
+        self.assertEqual(cache.deleted, ["handle:a"])
+        self.assertEqual(cache.stats()["expired"], 1)
+
+    def test_failed_create_returns_none(self):
+        cache = FakeContextCache(fail=True)
+        self.assertIsNone(cache.get_client("a"))
+        self.assertEqual(cache.stats()["failed"], 1)
+        cache.fail = False
+        self.assertEqual(cache.get_client("a"), "client:a") # Ошибка не запоминается: следующий запрос создает заново
+
+    def test_same_prefix_created_once_in_parallel(self):
+        cache = FakeContextCache(create_delay=0.2)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(executor.map(cache.get_client, ["a"] * 8))
+        self.assertEqual(clients, ["client:a"] * 8)
+        self.assertEqual(cache.created_prefixes, ["a"])
+        self.assertEqual(cache.stats()["reused"], 7)
+
+    def test_different_prefixes_created_in_parallel(self):
+        cache = FakeContextCache(create_delay=0.2)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(cache.get_client, ["a", "b", "c", "d"]))
+        self.assertLess(time.monotonic() - start, 0.6) # Создания не ждут друг друга под общей блокировкой
+        self.assertEqual(sorted(cache.created_prefixes), ["a", "b", "c", "d"])
+
+    def test_clear_deletes_all_entries(self):
+        cache = FakeContextCache()
+        cache.get_client("a"); cache.get_client("b")
+        cache.clear()
+        self.assertEqual(sorted(cache.deleted), ["handle:a", "handle:b"])
+        self.assertEqual(cache.stats()["active"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
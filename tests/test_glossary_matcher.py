@@ -0,0 +1,66 @@
+import random
+import unittest
+
+from utils.glossary_matcher import GlossaryMatcher
+
+
+def find_naive(terms, text):
+    return {term for term in terms if term in text}
+
+
+class GlossaryMatcherTest(unittest.TestCase):
+
+    def test_overlapping_terms(self):
+        matcher = GlossaryMatcher(["he", "she", "his", "hers"])
+        self.assertEqual(matcher.find("ushers"), {"he", "she", "hers"})
+        self.assertEqual(matcher.find("this"), {"his"})
+        self.assertEqual(matcher.find("xyz"), set())
+
+    def test_nested_cjk_terms(self):
+        matcher = GlossaryMatcher(["林远", "林远山", "远山", "青云宗"])
+        self.assertEqual(matcher.find("林远山走进了青云宗。"), {"林远", "林远山", "远山", "青云宗"})
+        self.assertEqual(matcher.find("林远来了"), {"林远"})
+
+    def test_repeated_occurrences_reported_once(self):
+        matcher = GlossaryMatcher(["剑"])
+        self.assertEqual(matcher.find("剑剑剑"), {"剑"})
+
+    def test_add_after_find_rebuilds_links(self):
+        matcher = GlossaryMatcher(["abc"])
+        self.assertEqual(matcher.find("xbcd"), set())
+        self.assertTrue(matcher.add("bcd"))
+        self.assertFalse(matcher.add("bcd"))
+        self.assertFalse(matcher.add(""))
+        self.assertEqual(matcher.find("abcd"), {"abc", "bcd"})
+
+    def test_sync_adds_only_new_keys(self):
+        matcher = GlossaryMatcher(["a"])
+        glossary = {"a": "А", "bb": "Бб"}
+        self.assertEqual(matcher.sync(glossary), 1)
+        self.assertEqual(matcher.sync(glossary), 0)
+        self.assertEqual(matcher.find("abb"), {"a", "bb"})
+
+    def test_sync_with_same_size_but_different_keys(self):
+        """Автомат общий для нескольких словарей: новый ключ добавляется, даже если размеры совпали."""
+        matcher = GlossaryMatcher()
+        matcher.sync({"Alpha": "Альфа", "Beta": "Бета"})
+        self.assertEqual(matcher.sync({"Alpha": "Альфа", "Gamma": "Гамма"}), 1)
+        self.assertEqual(matcher.find("Gamma Alpha"), {"Alpha", "Gamma"})
+
+    def test_matches_naive_search(self):
+        """Результат совпадает с проверкой каждого термина через `in` на случайных текстах."""
+        rng = random.Random(42)
+        alphabet = "abc林远山"
+        for _ in range(50):
+            terms = {"".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, 30))}
+            text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 200)))
+            matcher = GlossaryMatcher()
+            for term in terms:
+                matcher.add(term)
+                if rng.random() < 0.3:
+                    matcher.find(text) # Поиск между добавлениями: ссылки пересчитываются лениво
+            self.assertEqual(matcher.find(text), find_naive(terms, text))
+
+
+if __name__ == "__main__":
+    unittest.main()
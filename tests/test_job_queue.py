@@ -0,0 +1,93 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from utils.job_queue import JobQueue, JOB_PENDING, JOB_P1_DONE, JOB_P2_DONE, JOB_FAILED
+
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp_dir, "queue", "jobs.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def make_queue(self, worker_id, **kwargs):
+        """Отдельное соединение на исполнителя - как у разных процессов с общей базой."""
+        queue = JobQueue(self.db_path, worker_id=worker_id, **kwargs)
+        self.addCleanup(queue.close)
+        return queue
+
+    def state(self, queue, filename):
+        return queue.conn.execute("SELECT state FROM jobs WHERE filename = ?", (filename,)).fetchone()[0]
+
+    def test_add_is_idempotent_and_marks_done(self):
+        queue = self.make_queue("w1")
+        queue.add(["a.txt", "b.txt"])
+        queue.add(["a.txt", "b.txt", "c.txt"], done=["b.txt"])
+        counts, leased = queue.counts()
+        self.assertEqual(counts, {JOB_PENDING: 2, JOB_P2_DONE: 1})
+        self.assertEqual(leased, {})
+        self.assertFalse(queue.claim("b.txt"))
+
+    def test_claim_is_exclusive_between_workers(self):
+        first, second = self.make_queue("w1"), self.make_queue("w2")
+        first.add(["a.txt"])
+        self.assertTrue(first.claim("a.txt"))
+        self.assertFalse(second.claim("a.txt"))
+        self.assertEqual(first.counts()[1], {"w1": 1})
+
+    def test_expired_lease_is_taken_over(self):
+        first, second = self.make_queue("w1", lease_seconds=-1), self.make_queue("w2")
+        first.add(["a.txt"])
+        self.assertTrue(first.claim("a.txt"))
+        self.assertTrue(second.claim("a.txt"))
+        self.assertFalse(first.complete("a.txt")) # Аренда потеряна: результат первого не записывается
+        self.assertTrue(second.complete("a.txt"))
+        self.assertEqual(self.state(second, "a.txt"), JOB_P2_DONE)
+
+    def test_states_and_release(self):
+        queue = self.make_queue("w1")
+        queue.add(["a.txt"])
+        self.assertTrue(queue.claim("a.txt"))
+        self.assertTrue(queue.mark_p1_done("a.txt"))
+        self.assertEqual(self.state(queue, "a.txt"), JOB_P1_DONE)
+        queue.release("a.txt")
+        self.assertTrue(self.make_queue("w2").claim("a.txt")) # Глава вернулась в очередь с состоянием p1_done
+
+    def test_failed_chapter_retried_until_max_attempts(self):
+        queue = self.make_queue("w1", max_attempts=2)
+        queue.add(["a.txt"])
+        for _ in range(2):
+            self.assertTrue(queue.claim("a.txt"))
+            self.assertTrue(queue.fail("a.txt"))
+        self.assertFalse(queue.claim("a.txt"))
+        self.assertEqual(queue.counts()[0], {JOB_FAILED: 1})
+        self.assertEqual(queue.reset_failed(), 1)
+        self.assertTrue(queue.claim("a.txt"))
+
+    def test_heartbeat_extends_unfinished_leases(self):
+        queue = self.make_queue("w1", lease_seconds=-1)
+        queue.add(["a.txt", "b.txt"])
+        queue.claim("a.txt"); queue.claim("b.txt")
+        queue.complete("b.txt")
+        queue.lease_seconds = 300
+        self.assertEqual(queue.heartbeat(), 1)
+        self.assertFalse(self.make_queue("w2").claim("a.txt"))
+
+    def test_exclusive_blocks_other_writers(self):
+        first, second = self.make_queue("w1"), self.make_queue("w2")
+        first.add(["a.txt"])
+        second.conn.execute("PRAGMA busy_timeout = 0")
+        with first.exclusive():
+            with self.assertRaises(sqlite3.OperationalError):
+                second.claim("a.txt")
+        self.assertTrue(second.claim("a.txt"))
+
+
+if __name__ == "__main__":
+    unittest.main()
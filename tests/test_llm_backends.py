@@ -0,0 +1,180 @@
+import unittest
+from unittest import mock
+
+from google.api_core import exceptions as google_exceptions
+
+from utils.llm_backends import (BackendRouter, BackendStream, BackendResponse, OpenAICompatibleBackend, RoutedBackend,
+                                create_backend_router)
+from utils.rate_limiter import AdaptiveRateLimiter
+
+
+class FakeClient:
+    """Клиент с заданным поведением: 'ok', '429' (до ответа), 'stream_429' (429 после первого фрагмента потока) или 'error'."""
+
+    def __init__(self, behavior="ok", text="ok"):
+        self.behavior = behavior
+        self.text = text
+        self.calls = 0
+        self.closed = False
+
+    def generate_content(self, prompt_text, stream=False, **kwargs):
+        self.calls += 1
+        if self.behavior == "429" and not stream:
+            raise google_exceptions.ResourceExhausted("429")
+        if self.behavior == "error":
+            raise google_exceptions.ServiceUnavailable("503")
+        if not stream:
+            return BackendResponse(self.text)
+        return BackendStream(self._chunks())
+
+    def _chunks(self):
+        try:
+            if self.behavior == "429":
+                raise google_exceptions.ResourceExhausted("429")
+            yield BackendResponse(self.text[:1], "FINISH_REASON_UNSPECIFIED")
+            if self.behavior == "stream_429":
+                raise google_exceptions.ResourceExhausted("429")
+            yield BackendResponse(self.text[1:], "STOP")
+        finally:
+            self.closed = True
+
+
+def make_router(*clients):
+    backends = [RoutedBackend(f"b{i}", client, AdaptiveRateLimiter(600, 10 ** 6, jitter=0.0, initial_burst=10))
+                for i, client in enumerate(clients)]
+    return BackendRouter(backends, len)
+
+
+class BackendRouterTest(unittest.TestCase):
+
+    def test_requires_backends(self):
+        with self.assertRaises(ValueError):
+            BackendRouter([], len)
+
+    def test_round_robin(self):
+        first, second = FakeClient(text="a"), FakeClient(text="b")
+        router = make_router(first, second)
+        self.assertEqual([router.generate_content("p").text for _ in range(4)], ["a", "b", "a", "b"])
+        self.assertEqual(router.stats()["b0"]["requests"], 2)
+
+    def test_failover_on_rate_limit(self):
+        limited, healthy = FakeClient("429"), FakeClient(text="ok")
+        router = make_router(limited, healthy)
+        self.assertEqual(router.generate_content("p").text, "ok")
+        stats = router.stats()
+        self.assertEqual(stats["b0"]["rate_limited"], 1)
+        self.assertEqual(stats["b0"]["rate_fraction"], 0.5)
+        self.assertEqual(stats["b1"]["requests"], 1)
+
+    def test_all_backends_rate_limited(self):
+        router = make_router(FakeClient("429"), FakeClient("429"))
+        with self.assertRaises(google_exceptions.ResourceExhausted):
+            router.generate_content("p")
+
+    def test_other_errors_are_not_retried(self):
+        failing, healthy = FakeClient("error"), FakeClient()
+        router = make_router(failing, healthy)
+        with self.assertRaises(google_exceptions.ServiceUnavailable):
+            router.generate_content("p")
+        self.assertEqual(router.stats()["b0"]["errors"], 1)
+        self.assertEqual(healthy.calls, 0)
+
+    def test_stream_failover_before_first_chunk(self):
+        limited, healthy = FakeClient("429"), FakeClient(text="ab")
+        router = make_router(limited, healthy)
+        stream = router.generate_content("p", stream=True)
+        self.assertEqual("".join(chunk.text for chunk in stream), "ab")
+        self.assertEqual(stream.candidates[0].finish_reason, "STOP")
+        self.assertEqual(router.stats()["b0"]["rate_limited"], 1)
+        self.assertEqual(router.stats()["b1"]["requests"], 1)
+
+    def test_stream_rate_limit_after_first_chunk_is_raised(self):
+        router = make_router(FakeClient("stream_429", text="ab"), FakeClient(text="cd"))
+        chunks = []
+        with self.assertRaises(google_exceptions.ResourceExhausted):
+            for chunk in router.generate_content("p", stream=True):
+                chunks.append(chunk.text)
+        self.assertEqual(chunks, ["a"]) # Часть ответа уже отдана: переключение исказило бы текст
+        self.assertEqual(router.stats()["b0"]["rate_limited"], 1)
+
+    def test_closing_stream_closes_backend_stream(self):
+        client = FakeClient(text="ab")
+        stream = make_router(client).generate_content("p", stream=True)
+        next(iter(stream))
+        stream.close()
+        self.assertTrue(client.closed)
+
+    def test_model_names(self):
+        router = make_router(FakeClient(), FakeClient(), FakeClient())
+        router.backends[1].model_name = router.backends[2].model_name = "other/model"
+        self.assertEqual(router.model_names(), [None, "other/model"])
+
+    def test_total_limits(self):
+        self.assertEqual(make_router(FakeClient(), FakeClient()).total_limits(), (1200, 2 * 10 ** 6))
+
+
+class OpenAICompatibleBackendTest(unittest.TestCase):
+
+    def make_backend(self, http_response):
+        backend = OpenAICompatibleBackend("http://localhost/v1", "key", "other/model")
+        backend.session.post = mock.Mock(return_value=http_response)
+        return backend
+
+    def test_response_carries_model_and_usage(self):
+        http_response = mock.Mock(status_code=200)
+        http_response.json.return_value = {
+            "choices": [{"message": {"content": "ответ"}, "finish_reason": "length"}],
+            "usage": {"prompt_tokens": 7, "completion_tokens": 3, "total_tokens": 10},
+        }
+        response = self.make_backend(http_response).generate_content("p", generation_config={"max_output_tokens": 5})
+        self.assertEqual((response.text, response.model_name), ("ответ", "other/model"))
+        self.assertEqual(response.candidates[0].finish_reason, "MAX_TOKENS")
+        self.assertEqual(response.usage_metadata.prompt_token_count, 7)
+
+    def test_stream_carries_model(self):
+        http_response = mock.Mock(status_code=200)
+        http_response.iter_lines.return_value = [
+            b'data: {"choices": [{"delta": {"content": "a"}}]}',
+            b'data: {"choices": [{"delta": {"content": "b"}, "finish_reason": "stop"}]}',
+            b"data: [DONE]",
+        ]
+        stream = self.make_backend(http_response).generate_content("p", stream=True)
+        self.assertEqual("".join(chunk.text for chunk in stream), "ab")
+        self.assertEqual((stream.model_name, stream.candidates[0].finish_reason), ("other/model", "STOP"))
+        http_response.close.assert_called_once()
+
+    def test_rate_limit_status(self):
+        with self.assertRaises(google_exceptions.ResourceExhausted):
+            self.make_backend(mock.Mock(status_code=429, text="slow down")).generate_content("p")
+
+
+class CreateBackendRouterTest(unittest.TestCase):
+
+    def test_skips_backends_without_client_or_key(self):
+        router = create_backend_router([
+            {"name": "gemini", "type": "gemini"},
+            {"name": "nokey", "type": "openai", "base_url": "http://localhost", "model": "m", "api_key": ""},
+            {"name": "keys", "type": "openai", "base_url": "http://localhost", "model": "m", "api_key": "k1, k2", "rpm": 5},
+        ], None, len)
+        self.assertEqual([backend.name for backend in router.backends], ["keys#1", "keys#2"])
+        self.assertEqual(router.model_names(), ["m"])
+        self.assertEqual(router.total_limits()[0], 10)
+
+    def test_no_backends(self):
+        with self.assertRaises(ValueError):
+            create_backend_router([{"name": "gemini", "type": "gemini"}], None, len)
+
+    def test_mock_backend_inherits_mock_settings(self):
+        router = create_backend_router(
+            [{"name": "m1", "type": "mock"}, {"name": "m2", "type": "mock", "latency": 0.7}], None, len,
+            limiter_kwargs={"initial_burst": 4},
+            mock_settings={"latency": 0.01, "prompt_tokens_per_second": 1, "output_tokens_per_second": 2, "seed": None})
+        first, second = (backend.client for backend in router.backends)
+        self.assertEqual((first.latency, first.prompt_tokens_per_second, first.output_tokens_per_second, first.seed),
+                         (0.01, 1, 2, 0))
+        self.assertEqual(second.latency, 0.7)
+        self.assertEqual(router.backends[0].limiter.request_allowance, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+
+from utils.rate_limiter import AdaptiveRateLimiter, UnlimitedRateLimiter
+
+
+class AdaptiveRateLimiterTest(unittest.TestCase):
+
+    def make_limiter(self, rpm=60, tpm=10 ** 6, **kwargs):
+        kwargs.setdefault("jitter", 0.0)
+        return AdaptiveRateLimiter(rpm, tpm, **kwargs)
+
+    def test_single_request_without_burst(self):
+        """Без initial_burst без ожидания уходит только первый запрос."""
+        limiter = self.make_limiter()
+        self.assertEqual(limiter.try_acquire(), (True, 0.0))
+        acquired, wait_time = limiter.try_acquire()
+        self.assertFalse(acquired)
+        self.assertAlmostEqual(wait_time, 1.0, delta=0.05) # 60 RPM - один запрос в секунду
+
+    def test_initial_burst(self):
+        limiter = self.make_limiter(initial_burst=3)
+        self.assertTrue(all(limiter.try_acquire()[0] for _ in range(3)))
+        self.assertFalse(limiter.try_acquire()[0])
+
+    def test_initial_burst_capped_by_rpm(self):
+        limiter = self.make_limiter(rpm=2, initial_burst=10)
+        self.assertEqual(limiter.request_allowance, 2.0)
+
+    def test_tokens_per_minute(self):
+        """Запрос, не укладывающийся в TPM, ждет пополнения ведра токенов."""
+        limiter = self.make_limiter(rpm=600, tpm=6000, initial_burst=10)
+        self.assertTrue(limiter.try_acquire(tokens=5000)[0])
+        acquired, wait_time = limiter.try_acquire(tokens=2000)
+        self.assertFalse(acquired)
+        self.assertAlmostEqual(wait_time, 10.0, delta=0.1) # не хватает 1000 токенов при 100 токенах/с
+
+    def test_request_larger_than_quota_passes_with_full_bucket(self):
+        limiter = self.make_limiter(tpm=1000)
+        self.assertTrue(limiter.try_acquire(tokens=5000)[0])
+
+    def test_rate_limited_decreases_rate_and_pauses(self):
+        limiter = self.make_limiter(initial_burst=5, cooldown_seconds=2.0)
+        limiter.on_rate_limited()
+        self.assertEqual(limiter.rate_fraction, 0.5)
+        acquired, wait_time = limiter.try_acquire()
+        self.assertFalse(acquired)
+        self.assertGreaterEqual(wait_time, 1.9)
+
+    def test_rate_fraction_not_below_minimum(self):
+        limiter = self.make_limiter(min_fraction=0.2, cooldown_seconds=0.0)
+        for _ in range(10):
+            limiter.on_rate_limited()
+        self.assertEqual(limiter.rate_fraction, 0.2)
+
+    def test_success_increases_rate_additively(self):
+        limiter = self.make_limiter(increase_after=3, increase_step=0.1, cooldown_seconds=0.0)
+        limiter.on_rate_limited()
+        for _ in range(2):
+            limiter.on_success()
+        self.assertEqual(limiter.rate_fraction, 0.5)
+        limiter.on_success()
+        self.assertAlmostEqual(limiter.rate_fraction, 0.6)
+        for _ in range(100):
+            limiter.on_success()
+        self.assertEqual(limiter.rate_fraction, 1.0)
+
+    def test_acquire_waits_and_reports_wait_time(self):
+        limiter = self.make_limiter(rpm=1200) # один запрос в 0.05 с
+        self.assertEqual(limiter.acquire(), 0.0)
+        self.assertGreater(limiter.acquire(), 0.0)
+
+
+class UnlimitedRateLimiterTest(unittest.TestCase):
+
+    def test_never_waits(self):
+        limiter = UnlimitedRateLimiter()
+        limiter.on_rate_limited()
+        self.assertEqual(limiter.try_acquire(tokens=10 ** 9), (True, 0.0))
+        self.assertEqual(limiter.acquire(), 0.0)
+        limiter.on_success()
+
+
+if __name__ == "__main__":
+    unittest.main()
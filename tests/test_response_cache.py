@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from utils.response_cache import ResponseCache, make_cache_key
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.clock = iter(range(1, 10 ** 6)) # Монотонные метки last_access без зависимости от разрешения часов
+        patcher = mock.patch("utils.response_cache.time.time", side_effect=lambda: float(next(self.clock)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def make_cache(self, max_bytes=10 ** 6):
+        cache = ResponseCache(os.path.join(self.tmp_dir, "cache", "responses.sqlite"), max_bytes)
+        self.addCleanup(cache.conn.close)
+        return cache
+
+    def test_key_depends_on_model_config_and_prompt(self):
+        key = make_cache_key("model", {"temperature": 0.5}, "prompt")
+        self.assertEqual(key, make_cache_key("model", {"temperature": 0.5}, "prompt"))
+        self.assertNotEqual(key, make_cache_key("other", {"temperature": 0.5}, "prompt"))
+        self.assertNotEqual(key, make_cache_key("model", {"temperature": 0.7}, "prompt"))
+        self.assertNotEqual(key, make_cache_key("model", {"temperature": 0.5}, "prompt!"))
+
+    def test_get_put_and_stats(self):
+        cache = self.make_cache()
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", "ответ")
+        self.assertEqual(cache.get("a"), "ответ")
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 1, 1))
+        self.assertEqual(stats["size_bytes"], len("ответ".encode("utf-8")))
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_get_first_counts_one_lookup(self):
+        cache = self.make_cache()
+        cache.put("b", "ответ b")
+        self.assertEqual(cache.get_first(["a", "b"]), ("b", "ответ b"))
+        self.assertEqual(cache.get_first(["a", "c"]), (None, None))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_invalidate(self):
+        cache = self.make_cache()
+        cache.put("a", "брак")
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+
+    def test_evicts_least_recently_used(self):
+        cache = self.make_cache(max_bytes=350)
+        for key in "abc":
+            cache.put(key, "x" * 100)
+        cache.get("a") # "a" использован недавно, дольше всего не использовался "b"
+        cache.put("d", "x" * 100)
+        self.assertIsNone(cache.get("b"))
+        for key in "acd":
+            self.assertIsNotNone(cache.get(key))
+
+    def test_eviction_shrinks_below_ninety_percent(self):
+        cache = self.make_cache(max_bytes=1000)
+        for i in range(10):
+            cache.put(str(i), "x" * 100)
+        cache.put("new", "x" * 100)
+        self.assertLessEqual(cache.stats()["size_bytes"], 900)
+        self.assertIsNone(cache.get("0"))
+        self.assertIsNotNone(cache.get("new"))
+
+    def test_running_size_matches_table(self):
+        cache = self.make_cache(max_bytes=1000)
+        cache.put("a", "x" * 100)
+        cache.put("a", "x" * 300) # Замена записи: учитывается разница размеров
+        cache.put("b", "x" * 200)
+        cache.invalidate("b")
+        cache.invalidate("missing")
+        for i in range(10):
+            cache.put(str(i), "x" * 150)
+        self.assertEqual(cache.total_bytes, cache.stats()["size_bytes"])
+        self.assertLessEqual(cache.total_bytes, 1000)
+
+    def test_persists_between_instances(self):
+        cache = self.make_cache()
+        cache.put("a", "ответ")
+        cache.conn.close()
+        reopened = self.make_cache()
+        self.assertEqual(reopened.get("a"), "ответ")
+        self.assertEqual(reopened.total_bytes, len("ответ".encode("utf-8")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from utils.token_estimator import CHAR_CLASSES, DEFAULT_RATIOS, TokenEstimator, classify_char, solve_linear_system
+
+
+class TokenEstimatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.calibration_file = os.path.join(self.tmp_dir, "calibration", "tokens.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_classify_char(self):
+        self.assertEqual([classify_char(char) for char in "林，Яz \n1é"],
+                         ["cjk", "cjk", "cyrillic", "latin", "whitespace", "whitespace", "other", "latin"])
+
+    def test_solve_linear_system(self):
+        solution = solve_linear_system([[2.0, 1.0], [1.0, 3.0]], [3.0, 5.0])
+        self.assertAlmostEqual(solution[0], 0.8)
+        self.assertAlmostEqual(solution[1], 1.4)
+        self.assertIsNone(solve_linear_system([[1.0, 2.0], [2.0, 4.0]], [1.0, 2.0]))
+
+    def test_default_estimate(self):
+        estimator = TokenEstimator()
+        self.assertEqual(estimator.estimate(""), 0)
+        self.assertEqual(estimator.class_counts("林远 ab"), (2, 0, 2, 1, 0))
+        self.assertEqual(estimator.estimate("林" * 100), round(100 * DEFAULT_RATIOS["cjk"]))
+
+    def test_calibration_converges_to_observed_ratios(self):
+        true_ratios = {"cjk": 1.2, "cyrillic": 0.4, "latin": 0.3, "whitespace": 0.1, "other": 0.6}
+        estimator = TokenEstimator(prior_samples=1)
+        texts = ["林" * (50 + i) + "Я" * (30 + 2 * i % 7) + "ab " * (i % 5 + 1) + "1," * (i % 3) for i in range(200)]
+        for text in texts:
+            counts = estimator.class_counts(text)
+            estimator.observe(counts, round(sum(count * true_ratios[name] for name, count in zip(CHAR_CLASSES, counts))))
+        self.assertAlmostEqual(estimator.ratios["cjk"], 1.2, delta=0.05)
+        self.assertAlmostEqual(estimator.ratios["cyrillic"], 0.4, delta=0.05)
+
+    def test_ignores_empty_observations(self):
+        estimator = TokenEstimator()
+        estimator.observe((0, 0, 0, 0, 0), 10)
+        estimator.observe((10, 0, 0, 0, 0), 0)
+        self.assertEqual(estimator.samples, 0)
+
+    def test_calibration_saved_and_loaded(self):
+        estimator = TokenEstimator(self.calibration_file, save_every=2)
+        estimator.observe((100, 0, 0, 0, 0), 150)
+        self.assertFalse(os.path.exists(self.calibration_file))
+        estimator.observe((200, 0, 0, 0, 0), 300)
+        self.assertTrue(os.path.exists(self.calibration_file))
+        loaded = TokenEstimator(self.calibration_file)
+        self.assertEqual(loaded.samples, 2)
+        self.assertEqual(loaded.ratios, estimator.ratios)
+
+    def test_broken_calibration_file_falls_back_to_defaults(self):
+        os.makedirs(os.path.dirname(self.calibration_file))
+        with open(self.calibration_file, 'w', encoding='utf-8') as f:
+            f.write("{")
+        self.assertEqual(TokenEstimator(self.calibration_file).ratios, DEFAULT_RATIOS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+from utils.token_estimator import TokenEstimator
+from utils.token_utils import TokenCounter
+
+
+class TokenCounterTest(unittest.TestCase):
+
+    def test_count_with_estimator_is_memoized(self):
+        counter = TokenCounter(None, estimator=TokenEstimator())
+        self.assertEqual(counter.count(""), 0)
+        self.assertEqual(counter.count("林" * 100), 70)
+        self.assertEqual(counter.count("林" * 100), 70)
+        self.assertEqual(counter.hits, 1)
+
+    def test_count_without_tokenizer_or_estimator(self):
+        self.assertEqual(TokenCounter(None).count("x" * 30), 10)
+
+    def test_last_n_tokens_with_estimator(self):
+        counter = TokenCounter(None, estimator=TokenEstimator())
+        text = "a" * 10 + "林" * 100
+        self.assertEqual(counter.last_n_tokens(text, 7), "林" * 10)
+        self.assertEqual(counter.last_n_tokens(text, 1000), text)
+
+    def test_last_n_tokens_tiny_budget_is_not_whole_text(self):
+        """Окно меньше одного символа (больше токена на символ): возвращается хвост, а не весь текст."""
+        estimator = TokenEstimator()
+        estimator.ratios["cjk"] = 2.0
+        counter = TokenCounter(None, estimator=estimator)
+        text = "林" * 1000
+        self.assertEqual(counter.last_n_tokens(text, 1), "林")
+        self.assertEqual(counter.last_n_tokens(text, 0), "")
+
+    def test_last_n_tokens_without_tokenizer(self):
+        counter = TokenCounter(None)
+        self.assertEqual(counter.last_n_tokens("abcdefghij", 2), "cdefghij")
+        self.assertEqual(counter.last_n_tokens("abcdefghij", 0), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
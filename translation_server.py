@@ -0,0 +1,168 @@
+"""
+Локальный HTTP-сервис перевода фрагментов (анонсы, экстры) тем же пайплайном, что и главы:
+глоссарий, контекст RAG, два прохода и проверка на брак. Клиент API, токенизатор, модель эмбеддингов
+и глоссарий загружаются один раз при запуске.
+
+    python translation_server.py
+    curl -X POST localhost:8765/translate -d '{"text": "...", "context": ["текст предыдущей главы"]}'
+    curl localhost:8765/metrics
+
+POST /translate  {"text": оригинал, "context": [тексты предыдущих глав, необязательно]}
+                 -> {"status": "ok", "translation": ..., "seconds": ...}
+GET  /metrics    задержка, пропускная способность, запросы по статусам, статистика повторов
+GET  /health     готовность сервиса
+"""
+import os
+import copy
+import glob
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import config
+import phase2_translate
+from utils.service_metrics import ServiceMetrics
+
+metrics = ServiceMetrics()
+translation_slots = None # Семафор: не больше SERVICE_MAX_CONCURRENT переводов одновременно
+glossary_data = {}
+glossary_mtime = None
+
+
+def refresh_glossary():
+    """Перечитывает глоссарий, если файл изменился (например, его дополнил пакетный перевод)."""
+    global glossary_mtime
+    try:
+        mtime = os.path.getmtime(config.GLOSSARY_FILE)
+    except OSError:
+        return
+    if mtime == glossary_mtime:
+        return
+    loaded = phase2_translate.load_glossary()
+    with phase2_translate.glossary_lock:
+        # Обновление на месте: параллельные запросы держат ссылку на тот же словарь
+        glossary_data.update(loaded)
+        glossary_mtime = mtime
+
+
+def translate_snippet(text, context_texts):
+    """
+    Переводит фрагмент как главу без предыдущих глав (или с переданным контекстом).
+    Имя "главы" - хэш текста: по нему исключаются фрагменты из RAG.
+    Перевод идет с копией глоссария: термины из фрагмента не попадают в общий глоссарий романа.
+    Временные чекпойнты P1 (фрагмента и его сегментов) удаляются при любом исходе.
+    """
+    refresh_glossary()
+    with phase2_translate.glossary_lock:
+        snippet_glossary = copy.deepcopy(glossary_data)
+    snippet_name = f"snippet-{hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]}.txt"
+    prev_ctx_list = [(f"context-{i}.txt", context_text) for i, context_text in enumerate(context_texts)]
+    try:
+        return phase2_translate.translate_single_chapter(snippet_name, text, prev_ctx_list, snippet_glossary,
+                                                         persist_glossary=False)
+    finally:
+        segment_pattern = os.path.splitext(snippet_name)[0] + "_seg*.txt"
+        for checkpoint_path in glob.glob(phase2_translate.get_checkpoint_path(segment_pattern)):
+            phase2_translate.remove_p1_checkpoint(os.path.basename(checkpoint_path).replace("_p1.json", ".txt"))
+        phase2_translate.remove_p1_checkpoint(snippet_name)
+
+
+class TranslationHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, code, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"[Сервис] {self.address_string()} {format % args}")
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            data = metrics.summary()
+            data["retries"] = phase2_translate.retry_stats.summary()
+            self.send_json(200, data)
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok", "rag": bool(phase2_translate.RAG_INITIALIZED), "glossary_terms": len(glossary_data)})
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/translate":
+            self.send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            text = (request.get("text") or "").strip()
+            context_texts = request.get("context") or []
+        except (ValueError, AttributeError) as e:
+            metrics.on_rejected("bad_request")
+            self.send_json(400, {"error": f"неверный JSON: {e}"})
+            return
+        if not isinstance(context_texts, list) or not all(isinstance(item, str) for item in context_texts):
+            metrics.on_rejected("bad_request")
+            self.send_json(400, {"error": "поле context должно быть списком строк"})
+            return
+        if not text or len(text) > config.SERVICE_MAX_TEXT_CHARS:
+            metrics.on_rejected("bad_request")
+            self.send_json(400, {"error": f"поле text пусто или длиннее {config.SERVICE_MAX_TEXT_CHARS} символов"})
+            return
+        if not metrics.try_enqueue(config.SERVICE_MAX_QUEUE):
+            metrics.on_rejected("overloaded")
+            self.send_json(503, {"error": "очередь переводов заполнена, повторите позже"})
+            return
+
+        with translation_slots:
+            metrics.on_started()
+            start = time.time(); status = 'api_error'; translation = None
+            try:
+                status, translation = translate_snippet(text, context_texts)
+            except Exception:
+                logging.exception("[Сервис] Непредвиденная ошибка перевода фрагмента.")
+            finally:
+                seconds = time.time() - start
+                metrics.on_finished(status, seconds, len(text), len(translation or ""))
+        if status == 'ok':
+            self.send_json(200, {"status": status, "translation": translation.strip(), "seconds": seconds})
+        else:
+            self.send_json(502, {"status": status, "error": "перевод не получен (ошибка API или брак)", "seconds": seconds})
+
+
+def main():
+    global translation_slots
+    parser = argparse.ArgumentParser(description="Локальный HTTP-сервис перевода фрагментов с глоссарием и RAG.")
+    parser.add_argument('--host', default=config.SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=config.SERVICE_PORT)
+    args = parser.parse_args()
+
+    phase2_translate.setup_logging()
+    translation_slots = threading.BoundedSemaphore(max(1, config.SERVICE_MAX_CONCURRENT))
+    warm_start = time.time()
+    phase2_translate.warm_up()
+    refresh_glossary()
+    logging.info(f"[Сервис] Ресурсы загружены за {time.time() - warm_start:.1f} с (RAG: {bool(phase2_translate.RAG_INITIALIZED)}, "
+                 f"терминов глоссария: {len(glossary_data)}).")
+    server = ThreadingHTTPServer((args.host, args.port), TranslationHandler)
+    server.daemon_threads = True
+    logging.info(f"[Сервис] Слушаем http://{args.host}:{args.port} (переводов одновременно: {config.SERVICE_MAX_CONCURRENT}).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("[Сервис] Остановлено пользователем.")
+    finally:
+        server.server_close()
+        phase2_translate.save_token_calibration()
+        phase2_translate.release_context_cache()
+
+
+if __name__ == "__main__":
+    main()
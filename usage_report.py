@@ -0,0 +1,69 @@
+"""
+Сводка журнала расхода квоты API (config.USAGE_LEDGER_FILE): токены, стоимость и время по главам
+и распределение квоты по проходам (P1, P2, повторы, названия).
+
+    python usage_report.py
+    python usage_report.py --top 20 --json usage.json
+"""
+import os
+import json
+import argparse
+
+import config
+from utils.usage_ledger import UsageLedger, RETRY_PASS
+
+
+def format_row(name, stats):
+    return (f"{name:<40} {stats['requests']:>6} {stats['prompt_tokens']:>10} {stats['cached_tokens']:>9} "
+            f"{stats['candidates_tokens']:>9} {stats['cost']:>9.4f} {stats['seconds']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сводка расхода квоты API по главам и проходам.")
+    parser.add_argument('--ledger', default=config.USAGE_LEDGER_FILE, help="Файл журнала (SQLite)")
+    parser.add_argument('--top', type=int, default=0, help="Показать только N самых дорогих глав (0 - все)")
+    parser.add_argument('--json', help="Сохранить сводку в JSON")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.ledger):
+        print(f"Журнал не найден: {args.ledger}")
+        return
+    ledger = UsageLedger(args.ledger)
+    summary = ledger.summary(config.USAGE_PRICES_PER_MILLION)
+    ledger.close()
+
+    chapters = sorted(summary["chapters"].items(), key=lambda item: item[0])
+    if args.top:
+        chapters = sorted(chapters, key=lambda item: -item[1]["cost"])[:args.top]
+    header = f"{'':<40} {'Запр.':>6} {'Промпт':>10} {'Из кэша':>9} {'Ответ':>9} {'Стоим.$':>9} {'Сек.':>8}"
+    print("=== Расход по главам ===")
+    print(header)
+    for chapter, stats in chapters:
+        print(format_row(chapter, stats))
+
+    passes = summary["passes"]
+    total_tokens = sum(stats["prompt_tokens"] + stats["candidates_tokens"] for stats in passes.values())
+    print("\n=== Куда уходит квота (проходы; retries - неудачные попытки и брак) ===")
+    print(header + f" {'Доля':>6}")
+    for pass_name, stats in sorted(passes.items(), key=lambda item: -(item[1]["prompt_tokens"] + item[1]["candidates_tokens"])):
+        share = (stats["prompt_tokens"] + stats["candidates_tokens"]) / total_tokens if total_tokens else 0.0
+        print(format_row(pass_name, stats) + f" {share:>6.0%}")
+
+    total = {key: sum(stats[key] for stats in passes.values())
+             for key in ("requests", "prompt_tokens", "cached_tokens", "candidates_tokens", "estimated_prompt_tokens", "cost", "seconds")}
+    print(format_row("ИТОГО", total))
+    # Насколько локальная оценка (tiktoken) расходится с подсчетом провайдера (по ответам с usage_metadata)
+    answered = [stats for pass_name, stats in passes.items() if pass_name != RETRY_PASS]
+    answered_prompt_tokens = sum(stats["prompt_tokens"] for stats in answered)
+    if answered_prompt_tokens:
+        estimated = sum(stats["estimated_prompt_tokens"] for stats in answered)
+        print(f"\nОценка токенов промпта локальным токенизатором: {estimated} ({estimated / answered_prompt_tokens:.2f} от usage_metadata).")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"Сводка сохранена: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import os
+import time
+import sqlite3
+import threading
+
+# Статусы глав: переведена, пустой оригинал, ошибка API, брак
+STATUS_DONE = "done"
+STATUS_EMPTY = "empty"
+STATUS_API_ERROR = "api_error"
+STATUS_REJECTED = "rejected"
+
+
+class ChapterManifest:
+    """
+    Манифест состояния глав в SQLite: статус перевода, число попыток и отметка об индексации в RAG.
+    Позволяет при возобновлении сразу перейти к первой непереведенной главе, не читая оригиналы
+    уже переведенных глав, и не запрашивать у ChromaDB метаданные всех фрагментов.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chapters ("
+            " filename TEXT PRIMARY KEY, status TEXT, attempts INTEGER NOT NULL DEFAULT 0,"
+            " rag_indexed INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def statuses(self):
+        """{глава: статус} для всех глав с известным статусом."""
+        with self.lock:
+            return dict(self.conn.execute("SELECT filename, status FROM chapters WHERE status IS NOT NULL").fetchall())
+
+    def set_status(self, filename, status):
+        """Записывает статус главы (попытки считаются для всех статусов, кроме пустого оригинала)."""
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO chapters (filename, status, attempts, updated) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT(filename) DO UPDATE SET status = excluded.status,"
+                " attempts = attempts + excluded.attempts, updated = excluded.updated",
+                (filename, status, 0 if status == STATUS_EMPTY else 1, time.time())
+            )
+            self.conn.commit()
+
+    def mark_done(self, filenames):
+        """Отмечает главы переведенными без учета попыток (переводы, найденные на диске)."""
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT INTO chapters (filename, status, updated) VALUES (?, ?, ?)"
+                " ON CONFLICT(filename) DO UPDATE SET status = excluded.status, updated = excluded.updated",
+                [(filename, STATUS_DONE, now) for filename in filenames]
+            )
+            self.conn.commit()
+
+    def indexed_chapters(self):
+        """Множество глав, уже проиндексированных в RAG."""
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT filename FROM chapters WHERE rag_indexed = 1")}
+
+    def mark_indexed(self, filenames):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT INTO chapters (filename, rag_indexed, updated) VALUES (?, 1, ?)"
+                " ON CONFLICT(filename) DO UPDATE SET rag_indexed = 1",
+                [(filename, now) for filename in filenames]
+            )
+            self.conn.commit()
+
+    def clear_indexed(self):
+        """Сбрасывает отметки индексации (после удаления коллекции RAG)."""
+        with self.lock:
+            self.conn.execute("UPDATE chapters SET rag_indexed = 0")
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
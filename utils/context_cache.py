@@ -0,0 +1,173 @@
+import time
+import hashlib
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class ContextCacheBase:
+    """
+    Кэш стабильного префикса промпта на стороне провайдера.
+    Префикс (глоссарий и контекст главы) загружается один раз, дальше запросы ссылаются на него
+    и передают только переменный суффикс. Записи живут ttl_seconds, не больше max_entries одновременно.
+    Наследники реализуют _create(prefix_text) -> (клиент, дескриптор) и _delete(дескриптор).
+    Обращения к провайдеру (создание и удаление записей) выполняются вне lock: запрос с новым
+    префиксом не задерживает запросы с другими, а одинаковые префиксы ждут одного создания.
+    """
+
+    def __init__(self, ttl_seconds, max_entries):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # ключ -> {"client", "handle", "expires"}
+        self.pending = {} # ключ -> Future с клиентом для записей, которые сейчас создаются
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.expired = 0
+        self.failed = 0
+
+    @staticmethod
+    def _key(prefix_text):
+        return hashlib.sha256(prefix_text.encode('utf-8')).hexdigest()
+
+    def get_client(self, prefix_text):
+        """
+        Возвращает клиента, у которого префикс уже в кэше провайдера (создает запись при необходимости).
+        None - кэш недоступен, запрос нужно отправить целиком.
+        """
+        key = self._key(prefix_text)
+        with self.lock:
+            stale_handles = self._expire_locked()
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+                self.reused += 1
+            future = self.pending.get(key)
+            is_creator = not entry and future is None
+            if is_creator:
+                future = self.pending[key] = Future()
+        self._delete_all_quietly(stale_handles)
+        if entry:
+            return entry["client"]
+        if not is_creator:
+            # Тот же префикс уже создается другим потоком: ждем его результата (None - создание не удалось)
+            client = future.result()
+            if client:
+                with self.lock:
+                    self.reused += 1
+            return client
+
+        client = None; evicted_handles = []
+        try:
+            client, handle = self._create(prefix_text)
+        except Exception as e:
+            logging.warning(f"[Кэш контекста] Не удалось создать кэш префикса: {e}. Запрос уйдет целиком.")
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+                if client:
+                    self.entries[key] = {"client": client, "handle": handle, "expires": time.monotonic() + self.ttl_seconds}
+                    self.created += 1
+                    while len(self.entries) > self.max_entries:
+                        evicted_handles.append(self.entries.popitem(last=False)[1]["handle"])
+                else:
+                    self.failed += 1
+            future.set_result(client)
+        self._delete_all_quietly(evicted_handles)
+        return client
+
+    def _expire_locked(self):
+        """Убирает записи с истекшим сроком жизни (под lock); возвращает их дескрипторы для удаления у провайдера."""
+        now = time.monotonic()
+        handles = []
+        for key in [key for key, entry in self.entries.items() if entry["expires"] <= now]:
+            handles.append(self.entries.pop(key)["handle"])
+            self.expired += 1
+        return handles
+
+    def _delete_all_quietly(self, handles):
+        for handle in handles:
+            self._delete_quietly(handle)
+
+    def _delete_quietly(self, handle):
+        try:
+            self._delete(handle)
+        except Exception as e:
+            logging.warning(f"[Кэш контекста] Не удалось удалить кэш префикса: {e}")
+
+    def clear(self):
+        """Удаляет все записи (в конце перевода, чтобы не платить за хранение)."""
+        with self.lock:
+            handles = [entry["handle"] for entry in self.entries.values()]
+            self.entries.clear()
+        self._delete_all_quietly(handles)
+
+    def stats(self):
+        """Статистика: создано, переиспользовано, истекло, ошибок создания, активных записей."""
+        with self.lock:
+            return {
+                "created": self.created,
+                "reused": self.reused,
+                "expired": self.expired,
+                "failed": self.failed,
+                "active": len(self.entries),
+            }
+
+    def _create(self, prefix_text):
+        raise NotImplementedError
+
+    def _delete(self, handle):
+        raise NotImplementedError
+
+
+class GeminiContextCache(ContextCacheBase):
+    """Префикс хранится в CachedContent Gemini API; запросы идут через модель, привязанную к кэшу."""
+
+    def __init__(self, model_name, ttl_seconds, max_entries):
+        super().__init__(ttl_seconds, max_entries)
+        self.model_name = model_name
+
+    def _create(self, prefix_text):
+        import google.generativeai as genai
+        from google.generativeai import caching
+        cached_content = caching.CachedContent.create(
+            model=self.model_name,
+            contents=[prefix_text],
+            ttl=datetime.timedelta(seconds=self.ttl_seconds),
+        )
+        logging.info(f"[Кэш контекста] Создан {cached_content.name} (TTL {self.ttl_seconds} сек).")
+        return genai.GenerativeModel.from_cached_content(cached_content=cached_content), cached_content
+
+    def _delete(self, handle):
+        handle.delete()
+
+
+class _PrefixedClient:
+    """Клиент локальной имитации: дописывает сохраненный префикс перед суффиксом запроса."""
+
+    def __init__(self, get_base_client, prefix_text):
+        self.get_base_client = get_base_client
+        self.prefix_text = prefix_text
+
+    def generate_content(self, prompt_text, **kwargs):
+        return self.get_base_client().generate_content(self.prefix_text + prompt_text, **kwargs)
+
+
+class LocalContextCache(ContextCacheBase):
+    """
+    Локальная имитация кэша провайдера для офлайн-проверки: та же логика создания, переиспользования
+    и истечения записей, но префикс просто подставляется в запрос к обычному клиенту.
+    get_base_client - функция, возвращающая текущий клиент API.
+    """
+
+    def __init__(self, get_base_client, ttl_seconds, max_entries):
+        super().__init__(ttl_seconds, max_entries)
+        self.get_base_client = get_base_client
+
+    def _create(self, prefix_text):
+        return _PrefixedClient(self.get_base_client, prefix_text), None
+
+    def _delete(self, handle):
+        pass
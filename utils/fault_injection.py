@@ -0,0 +1,82 @@
+import time
+import random
+import logging
+import threading
+from collections import Counter
+
+from google.api_core import exceptions as google_exceptions
+
+from utils.llm_backends import BackendResponse, BackendStream
+
+# Виды сбоев, которые умеет подмешивать FaultInjectingClient
+FAULT_KINDS = ("rate_limit", "timeout", "empty", "blocked", "truncated", "error")
+
+
+class FaultInjectingClient:
+    """
+    Обертка над клиентом (Gemini, маршрутизатор или имитация), которая с заданной вероятностью
+    подменяет ответ сбоем, чтобы проверить и измерить логику повторов call_gemini_api_with_retries:
+    - rate_limit: ResourceExhausted (429);
+    - timeout: пауза timeout_delay секунд, затем DeadlineExceeded;
+    - empty: пустой ответ без причины завершения;
+    - blocked: пустой ответ с finish_reason SAFETY;
+    - truncated: настоящий ответ, обрезанный до truncate_fraction длины (finish_reason MAX_TOKENS);
+    - error: непредвиденное исключение.
+    rates - {вид: вероятность}; сумма вероятностей не больше 1.
+    """
+
+    def __init__(self, client, rates, timeout_delay=1.0, truncate_fraction=0.3, seed=0):
+        unknown = set(rates) - set(FAULT_KINDS)
+        if unknown:
+            raise ValueError(f"Неизвестные виды сбоев: {sorted(unknown)}")
+        self.client = client
+        self.rates = rates
+        self.timeout_delay = timeout_delay
+        self.truncate_fraction = truncate_fraction
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.injected = Counter()
+
+    def _pick_fault(self):
+        with self.lock:
+            self.requests += 1
+            roll = self.random.random()
+            for kind in FAULT_KINDS:
+                roll -= self.rates.get(kind, 0.0)
+                if roll < 0:
+                    self.injected[kind] += 1
+                    return kind
+        return None
+
+    def generate_content(self, prompt_text, **kwargs):
+        fault = self._pick_fault()
+        if fault:
+            logging.debug(f"[Сбои] Подмешан сбой: {fault}")
+        if fault == "rate_limit":
+            raise google_exceptions.ResourceExhausted("Подмешанный сбой: 429")
+        if fault == "timeout":
+            time.sleep(self.timeout_delay)
+            raise google_exceptions.DeadlineExceeded("Подмешанный сбой: таймаут")
+        if fault == "error":
+            raise RuntimeError("Подмешанный сбой: непредвиденная ошибка")
+        stream = kwargs.get("stream", False)
+        if fault in ("empty", "blocked"):
+            response = BackendResponse("", "FINISH_REASON_UNSPECIFIED" if fault == "empty" else "SAFETY")
+            return BackendStream(iter([response])) if stream else response
+        response = self.client.generate_content(prompt_text, **kwargs)
+        if fault == "truncated":
+            return self._truncate(response, stream)
+        return response
+
+    def _truncate(self, response, stream):
+        """Обрезает ответ (или поток) до truncate_fraction длины; usage_metadata остается от исходного ответа."""
+        text = (response.text or "") if not stream else "".join(chunk.text for chunk in response if getattr(chunk, 'text', None))
+        truncated = BackendResponse(text[:int(len(text) * self.truncate_fraction)], "MAX_TOKENS", model_name=getattr(response, 'model_name', None))
+        truncated.usage_metadata = getattr(response, 'usage_metadata', truncated.usage_metadata)
+        return BackendStream(iter([truncated])) if stream else truncated
+
+    def stats(self):
+        """Сколько запросов прошло через обертку и сколько сбоев каждого вида подмешано."""
+        with self.lock:
+            return {"requests": self.requests, "injected": dict(self.injected)}
@@ -0,0 +1,86 @@
+import threading
+from collections import deque
+
+
+class GlossaryMatcher:
+    """
+    Поиск терминов глоссария в тексте автоматом Ахо-Корасик.
+    Время поиска линейно по длине текста и не зависит от размера глоссария.
+    Новые термины добавляются в бор по одному; суффиксные ссылки пересчитываются
+    один раз при первом поиске после добавления.
+    """
+
+    def __init__(self, terms=()):
+        self.goto = [{}]     # Переходы бора: узел -> {символ: узел}
+        self.fail = [0]      # Суффиксные ссылки
+        self.output = [[]]   # Термины, заканчивающиеся в узле
+        self.out_link = [0]  # Ближайший по суффиксным ссылкам узел с терминами (0 - нет)
+        self.terms = set()
+        self.dirty = False
+        self.lock = threading.Lock()
+        for term in terms:
+            self.add(term)
+
+    def add(self, term):
+        """Добавляет термин в бор. Возвращает True, если термин новый."""
+        with self.lock:
+            if not term or term in self.terms:
+                return False
+            node = 0
+            for ch in term:
+                next_node = self.goto[node].get(ch)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto.append({}); self.fail.append(0); self.output.append([]); self.out_link.append(0)
+                    self.goto[node][ch] = next_node
+                node = next_node
+            self.output[node].append(term)
+            self.terms.add(term)
+            self.dirty = True
+            return True
+
+    def sync(self, glossary_data):
+        """
+        Добавляет ключи глоссария, которых еще нет в автомате. Возвращает число добавленных.
+        Автомат может содержать термины и из других словарей (копии глоссария), поэтому сравниваются ключи, а не размеры.
+        """
+        with self.lock:
+            new_terms = glossary_data.keys() - self.terms
+        return sum(1 for term in new_terms if self.add(term))
+
+    def _build_links(self):
+        """Пересчитывает суффиксные ссылки обходом бора в ширину (под lock)."""
+        queue = deque()
+        for next_node in self.goto[0].values():
+            self.fail[next_node] = 0; self.out_link[next_node] = 0
+            queue.append(next_node)
+        while queue:
+            node = queue.popleft()
+            for ch, next_node in self.goto[node].items():
+                fail_node = self.fail[node]
+                while fail_node and ch not in self.goto[fail_node]:
+                    fail_node = self.fail[fail_node]
+                self.fail[next_node] = self.goto[fail_node].get(ch, 0)
+                target = self.fail[next_node]
+                self.out_link[next_node] = target if self.output[target] else self.out_link[target]
+                queue.append(next_node)
+        self.dirty = False
+
+    def find(self, text):
+        """Возвращает множество терминов, встречающихся в тексте."""
+        with self.lock:
+            if self.dirty:
+                self._build_links()
+            found = set()
+            reported = set() # Узлы, термины которых уже учтены: цепочки ссылок не обходятся повторно
+            node = 0
+            for ch in text:
+                while node and ch not in self.goto[node]:
+                    node = self.fail[node]
+                node = self.goto[node].get(ch, 0)
+                match_node = node if self.output[node] else self.out_link[node]
+                while match_node and match_node not in reported:
+                    reported.add(match_node)
+                    found.update(self.output[match_node])
+                    match_node = self.out_link[match_node]
+            return found
@@ -0,0 +1,175 @@
+import os
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+
+# Состояния задачи-главы: ожидает, выполнен P1 (есть чекпойнт), переведена (P2), ошибка
+JOB_PENDING = "pending"
+JOB_P1_DONE = "p1_done"
+JOB_P2_DONE = "p2_done"
+JOB_FAILED = "failed"
+
+
+def default_worker_id():
+    """Идентификатор процесса-исполнителя: хост и PID."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class JobQueue:
+    """
+    Очередь глав в SQLite для нескольких процессов (в том числе на разных машинах с общей папкой данных).
+    Процесс берет главу в аренду (claim) на lease_seconds; пока глава переводится, фоновый поток
+    продлевает аренду (heartbeat). Если процесс упал, аренда истекает и главу забирает другой процесс
+    (P1 продолжается с чекпойнта). Главы с ошибкой повторяются, пока попыток меньше max_attempts.
+    """
+
+    def __init__(self, db_path, worker_id=None, lease_seconds=300, max_attempts=3):
+        self.db_path = db_path
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.heartbeat_stop = threading.Event()
+        self.heartbeat_thread = None
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        # Журнал rollback (не WAL): WAL не работает на сетевых файловых системах
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " filename TEXT PRIMARY KEY, state TEXT NOT NULL, worker TEXT, lease_expires REAL NOT NULL DEFAULT 0,"
+            " attempts INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL)"
+        )
+
+    def add(self, filenames, done=()):
+        """Добавляет главы, которых еще нет в очереди; главы из done сразу отмечаются переведенными."""
+        now = time.time(); done = set(done)
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO jobs (filename, state, updated) VALUES (?, ?, ?)",
+                [(filename, JOB_P2_DONE if filename in done else JOB_PENDING, now) for filename in filenames]
+            )
+            if done:
+                self.conn.executemany(
+                    "UPDATE jobs SET state = ?, worker = NULL, lease_expires = 0, updated = ? WHERE filename = ? AND state != ?",
+                    [(JOB_P2_DONE, now, filename, JOB_P2_DONE) for filename in done]
+                )
+
+    def claim(self, filename):
+        """
+        Берет главу в аренду. True - глава теперь за этим процессом; False - переведена, исчерпала попытки
+        или арендована другим живым процессом. Одна инструкция UPDATE атомарна для всех процессов.
+        """
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ?"
+                " WHERE filename = ? AND (state IN (?, ?) OR (state = ? AND attempts < ?))"
+                " AND (worker IS NULL OR worker = ? OR lease_expires < ?)",
+                (self.worker_id, now + self.lease_seconds, now, filename, JOB_PENDING, JOB_P1_DONE,
+                 JOB_FAILED, self.max_attempts, self.worker_id, now)
+            )
+            return cursor.rowcount == 1
+
+    def _update(self, filename, state, release):
+        """Меняет состояние главы, если она арендована этим процессом (False - аренда потеряна)."""
+        lease_sql = ", worker = NULL, lease_expires = 0" if release else ""
+        with self.lock:
+            cursor = self.conn.execute(
+                f"UPDATE jobs SET state = ?, updated = ?{lease_sql} WHERE filename = ? AND worker = ?",
+                (state, time.time(), filename, self.worker_id)
+            )
+        if cursor.rowcount != 1:
+            logging.warning(f"[Очередь] Аренда главы {filename} потеряна (истекла и глава передана другому процессу?).")
+            return False
+        return True
+
+    def mark_p1_done(self, filename):
+        """Отмечает выполненный P1 (аренда сохраняется)."""
+        return self._update(filename, JOB_P1_DONE, release=False)
+
+    def complete(self, filename):
+        """Глава переведена: состояние p2_done, аренда снимается."""
+        return self._update(filename, JOB_P2_DONE, release=True)
+
+    def fail(self, filename):
+        """Ошибка перевода: аренда снимается, глава может быть взята снова, пока не исчерпаны попытки."""
+        return self._update(filename, JOB_FAILED, release=True)
+
+    def release(self, filename):
+        """Возвращает главу в очередь без изменения состояния (например, если не удалось прочитать оригинал)."""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET worker = NULL, lease_expires = 0, attempts = MAX(attempts - 1, 0), updated = ?"
+                " WHERE filename = ? AND worker = ?", (time.time(), filename, self.worker_id)
+            )
+
+    def heartbeat(self):
+        """Продлевает аренду всех незавершенных глав этого процесса; возвращает их число."""
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE worker = ? AND state IN (?, ?, ?)",
+                (now + self.lease_seconds, self.worker_id, JOB_PENDING, JOB_P1_DONE, JOB_FAILED)
+            )
+        return cursor.rowcount
+
+    def start_heartbeat(self, interval):
+        """Запускает фоновый поток, продлевающий аренду каждые interval секунд."""
+        if self.heartbeat_thread:
+            return
+        self.heartbeat_stop.clear()
+
+        def run():
+            while not self.heartbeat_stop.wait(interval):
+                try:
+                    self.heartbeat()
+                except sqlite3.Error as e:
+                    logging.warning(f"[Очередь] Не удалось продлить аренду: {e}")
+
+        self.heartbeat_thread = threading.Thread(target=run, name="job-heartbeat", daemon=True)
+        self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        if self.heartbeat_thread:
+            self.heartbeat_stop.set()
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+
+    @contextmanager
+    def exclusive(self):
+        """Блокировка базы очереди на запись - взаимоисключение между процессами (например, для слияния глоссария)."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            finally:
+                self.conn.execute("COMMIT")
+
+    def counts(self):
+        """{состояние: число глав} и число глав в аренде у живых процессов."""
+        now = time.time()
+        with self.lock:
+            counts = dict(self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            leased = self.conn.execute(
+                "SELECT worker, COUNT(*) FROM jobs WHERE worker IS NOT NULL AND lease_expires >= ? GROUP BY worker", (now,)
+            ).fetchall()
+        return counts, dict(leased)
+
+    def reset_failed(self):
+        """Возвращает главы с исчерпанными попытками в очередь; возвращает их число."""
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET state = ?, attempts = 0, worker = NULL, lease_expires = 0, updated = ? WHERE state = ?",
+                (JOB_PENDING, time.time(), JOB_FAILED)
+            )
+        return cursor.rowcount
+
+    def close(self):
+        self.stop_heartbeat()
+        with self.lock:
+            self.conn.close()
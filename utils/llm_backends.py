@@ -0,0 +1,333 @@
+import json
+import time
+import logging
+import threading
+from types import SimpleNamespace
+
+import requests
+from google.api_core import exceptions as google_exceptions
+
+from utils.rate_limiter import AdaptiveRateLimiter
+
+# Причины завершения OpenAI-совместимого API в терминах Gemini (их проверяет call_gemini_api_with_retries)
+FINISH_REASONS = {"stop": "STOP", "length": "MAX_TOKENS", "content_filter": "SAFETY"}
+
+
+class BackendResponse:
+    """
+    Ответ бэкенда в форме ответа google.generativeai: text, candidates[0].finish_reason,
+    prompt_feedback и usage_metadata (prompt_token_count/candidates_token_count/total_token_count/cached_content_token_count).
+    model_name - модель, которая ответила (None - основная модель config.MODEL_NAME).
+    """
+
+    def __init__(self, text, finish_reason="STOP", usage=None, model_name=None):
+        self.text = text
+        self.model_name = model_name
+        self.candidates = [SimpleNamespace(finish_reason=finish_reason)]
+        self.prompt_feedback = None
+        usage = usage or {}
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=usage.get("prompt_tokens", 0),
+            candidates_token_count=usage.get("completion_tokens", 0),
+            total_token_count=usage.get("total_tokens", 0),
+            cached_content_token_count=(usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+        )
+
+
+def close_stream(stream):
+    """Закрывает потоковый ответ, чтобы провайдер прекратил генерацию (BackendStream или поток google.generativeai)."""
+    close = getattr(stream, 'close', None) or getattr(getattr(stream, '_iterator', None), 'cancel', None)
+    if close:
+        try:
+            close()
+        except Exception as e:
+            logging.debug(f"Не удалось закрыть поток ответа: {e}")
+
+
+class BackendStream:
+    """
+    Потоковый ответ бэкенда в форме потокового ответа google.generativeai: итерация по фрагментам с полем text,
+    после чтения потока candidates/prompt_feedback/usage_metadata берутся из последнего фрагмента.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.last_chunk = BackendResponse("", "FINISH_REASON_UNSPECIFIED")
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.last_chunk = chunk
+            yield chunk
+
+    def close(self):
+        """Прекращает чтение потока (генерация больше не нужна); соединение бэкенда закрывается."""
+        close = getattr(self.chunks, 'close', None)
+        if close:
+            close()
+
+    @property
+    def candidates(self):
+        return self.last_chunk.candidates
+
+    @property
+    def prompt_feedback(self):
+        return self.last_chunk.prompt_feedback
+
+    @property
+    def usage_metadata(self):
+        return self.last_chunk.usage_metadata
+
+    @property
+    def model_name(self):
+        return getattr(self.last_chunk, 'model_name', None)
+
+
+class OpenAICompatibleBackend:
+    """
+    Клиент OpenAI-совместимого HTTP API (/chat/completions): OpenRouter, Chutes, OpenAI-эндпоинт Gemini и т.п.
+    Повторяет интерфейс GenerativeModel.generate_content, ошибки HTTP переводятся в исключения
+    google.api_core, поэтому логика повторов в phase2_translate не меняется.
+    """
+
+    def __init__(self, base_url, api_key, model, timeout=300):
+        self.url = base_url.rstrip('/') + "/chat/completions"
+        self.model = model
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"})
+
+    def generate_content(self, prompt_text, generation_config=None, safety_settings=None, request_options=None, stream=False):
+        generation_config = generation_config or {}
+        payload = {"model": self.model, "messages": [{"role": "user", "content": prompt_text}], "stream": stream}
+        if "temperature" in generation_config:
+            payload["temperature"] = generation_config["temperature"]
+        if "max_output_tokens" in generation_config:
+            payload["max_tokens"] = generation_config["max_output_tokens"]
+        timeout = (request_options or {}).get("timeout", self.timeout)
+        try:
+            http_response = self.session.post(self.url, json=payload, timeout=timeout, stream=stream)
+        except requests.Timeout as e:
+            raise google_exceptions.DeadlineExceeded(f"{self.url}: {e}")
+        except requests.ConnectionError as e:
+            raise google_exceptions.ServiceUnavailable(f"{self.url}: {e}")
+        self._raise_for_status(http_response)
+        if stream:
+            return BackendStream(self._iter_stream(http_response, self.model))
+        data = http_response.json()
+        choice = (data.get("choices") or [{}])[0]
+        text = (choice.get("message") or {}).get("content") or ""
+        finish_reason = FINISH_REASONS.get(choice.get("finish_reason"), "FINISH_REASON_UNSPECIFIED")
+        return BackendResponse(text, finish_reason, data.get("usage"), self.model)
+
+    @staticmethod
+    def _raise_for_status(http_response):
+        if http_response.status_code < 400:
+            return
+        message = f"HTTP {http_response.status_code}: {http_response.text[:300]}"
+        if http_response.status_code == 429:
+            raise google_exceptions.ResourceExhausted(message)
+        if http_response.status_code in (400, 422):
+            raise google_exceptions.InvalidArgument(message)
+        if http_response.status_code in (408, 504):
+            raise google_exceptions.DeadlineExceeded(message)
+        raise google_exceptions.ServiceUnavailable(message)
+
+    @staticmethod
+    def _iter_stream(http_response, model_name):
+        """Разбирает поток Server-Sent Events и выдает фрагменты с полем text (соединение закрывается и при досрочном выходе)."""
+        try:
+            for raw_line in http_response.iter_lines():
+                line = raw_line.decode('utf-8', errors='ignore')
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data)
+                except json.JSONDecodeError:
+                    continue
+                choice = (chunk.get("choices") or [{}])[0]
+                text = (choice.get("delta") or {}).get("content") or ""
+                finish_reason = FINISH_REASONS.get(choice.get("finish_reason"), "FINISH_REASON_UNSPECIFIED")
+                if text or chunk.get("usage") or choice.get("finish_reason"):
+                    yield BackendResponse(text, finish_reason, chunk.get("usage"), model_name)
+        finally:
+            http_response.close()
+
+
+class RoutedBackend:
+    """
+    Бэкенд маршрутизатора: клиент и собственный учет квоты (один провайдер + один ключ).
+    model_name - модель бэкенда (None - основная модель config.MODEL_NAME: Gemini и имитация).
+    """
+
+    def __init__(self, name, client, limiter, model_name=None):
+        self.name = name
+        self.client = client
+        self.limiter = limiter
+        self.model_name = model_name
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+
+
+class BackendRouter:
+    """
+    Распределяет запросы по нескольким бэкендам (провайдеры и ключи) по кругу.
+    Каждый бэкенд ограничен своим AdaptiveRateLimiter; запрос уходит первому бэкенду, у которого
+    сейчас есть квота. При 429 бэкенд замедляется, а запрос сразу переотправляется другому;
+    ResourceExhausted выбрасывается, только если 429 вернули все бэкенды. Для потокового ответа
+    переключение работает и при 429 во время чтения потока, пока не получен первый фрагмент.
+    Ограничители бэкендов - единственный учет квоты: общий ограничитель вызывающего кода при этом не нужен.
+    token_estimator - функция подсчета токенов промпта (для TPM).
+    """
+
+    def __init__(self, backends, token_estimator):
+        if not backends:
+            raise ValueError("Нет доступных бэкендов LLM")
+        self.backends = backends
+        self.token_estimator = token_estimator
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def _pick(self, tokens, throttled):
+        """Следующий по кругу бэкенд с доступной квотой: (бэкенд, 0) или (None, минимальное ожидание)."""
+        with self.lock:
+            start = self.next_index
+            min_wait = None
+            for offset in range(len(self.backends)):
+                backend = self.backends[(start + offset) % len(self.backends)]
+                if backend.name in throttled:
+                    continue
+                acquired, wait_time = backend.limiter.try_acquire(tokens)
+                if acquired:
+                    self.next_index = (start + offset + 1) % len(self.backends)
+                    return backend, 0.0
+                min_wait = wait_time if min_wait is None else min(min_wait, wait_time)
+            return None, min_wait
+
+    def _on_rate_limited(self, backend, throttled, error):
+        backend.rate_limited += 1
+        backend.limiter.on_rate_limited()
+        throttled.add(backend.name)
+        logging.warning(f"[Маршрутизатор] {backend.name}: 429 ({error}). Переключаемся на другой бэкенд.")
+
+    def _on_success(self, backend):
+        backend.requests += 1
+        backend.limiter.on_success()
+        logging.debug(f"[Маршрутизатор] Запрос выполнен через {backend.name}.")
+
+    def _send(self, prompt_text, kwargs, throttled):
+        """Отправляет запрос первому бэкенду с квотой, при 429 - следующему. Возвращает (бэкенд, ответ)."""
+        tokens = self.token_estimator(prompt_text) * 2 # Промпт плюс ответ примерно того же размера
+        while True:
+            backend, wait_time = self._pick(tokens, throttled)
+            if backend is None:
+                if wait_time is None:
+                    raise google_exceptions.ResourceExhausted("Все бэкенды LLM вернули 429")
+                time.sleep(wait_time)
+                continue
+            try:
+                return backend, backend.client.generate_content(prompt_text, **kwargs)
+            except google_exceptions.ResourceExhausted as e:
+                self._on_rate_limited(backend, throttled, e)
+            except Exception:
+                backend.errors += 1
+                raise
+
+    def generate_content(self, prompt_text, **kwargs):
+        if kwargs.get("stream"):
+            return BackendStream(self._iter_stream(prompt_text, kwargs))
+        backend, response = self._send(prompt_text, kwargs, set())
+        self._on_success(backend)
+        return response
+
+    def _iter_stream(self, prompt_text, kwargs):
+        """Фрагменты потокового ответа; 429 до первого фрагмента переключает запрос на другой бэкенд."""
+        throttled = set()
+        while True:
+            backend, stream = self._send(prompt_text, kwargs, throttled)
+            started = finished = False
+            try:
+                for chunk in stream:
+                    started = True
+                    yield chunk
+                finished = True
+            except google_exceptions.ResourceExhausted as e:
+                if started:
+                    backend.rate_limited += 1
+                    backend.limiter.on_rate_limited()
+                    raise
+                self._on_rate_limited(backend, throttled, e)
+                continue
+            except Exception:
+                backend.errors += 1
+                raise
+            finally:
+                if not finished:
+                    close_stream(stream) # Чтение прервано (брак, ошибка или переключение): генерация не нужна
+            self._on_success(backend)
+            return
+
+    def model_names(self):
+        """Модели бэкендов без повторов, в порядке бэкендов (None - основная модель)."""
+        return list(dict.fromkeys(backend.model_name for backend in self.backends))
+
+    def total_limits(self):
+        """Суммарные квоты всех бэкендов (RPM, TPM)."""
+        return (sum(backend.limiter.max_rpm for backend in self.backends),
+                sum(backend.limiter.max_tpm for backend in self.backends))
+
+    def stats(self):
+        """Статистика по бэкендам: {имя: {requests, rate_limited, errors, rate_fraction}}."""
+        return {
+            backend.name: {
+                "requests": backend.requests,
+                "rate_limited": backend.rate_limited,
+                "errors": backend.errors,
+                "rate_fraction": backend.limiter.rate_fraction,
+            }
+            for backend in self.backends
+        }
+
+
+def create_backend_router(backend_configs, gemini_client, token_estimator, timeout=300, limiter_kwargs=None, mock_settings=None):
+    """
+    Создает маршрутизатор по списку настроек бэкендов (config.LLM_BACKENDS).
+    Для type 'gemini' используется уже настроенный клиент google.generativeai (один ключ на процесс);
+    для type 'openai' в api_key можно перечислить несколько ключей через запятую - у каждого своя квота;
+    type 'mock' - локальная имитация (utils.mock_backend) для офлайн-проверки маршрутизации;
+    незаданные в настройках бэкенда latency/prompt_tokens_per_second/output_tokens_per_second/seed
+    берутся из mock_settings (общие настройки имитации MOCK_LLM_*).
+    Бэкенды без клиента или ключа пропускаются.
+    """
+    limiter_kwargs = limiter_kwargs or {}
+    mock_settings = mock_settings or {}
+    backends = []
+    for backend_config in backend_configs:
+        name = backend_config["name"]
+        rpm = backend_config.get("rpm", 10); tpm = backend_config.get("tpm", 1000000)
+        if backend_config.get("type") == "gemini":
+            if gemini_client is None:
+                logging.warning(f"[Маршрутизатор] Бэкенд {name} пропущен: клиент Gemini не инициализирован.")
+                continue
+            backends.append(RoutedBackend(name, gemini_client, AdaptiveRateLimiter(rpm, tpm, **limiter_kwargs)))
+            continue
+        if backend_config.get("type") == "mock":
+            from utils.mock_backend import MockLLMBackend # Ссылается на BackendResponse этого модуля
+            settings = {key: backend_config.get(key, mock_settings.get(key))
+                        for key in ("latency", "prompt_tokens_per_second", "output_tokens_per_second", "seed")}
+            client = MockLLMBackend(**{key: value for key, value in settings.items() if value is not None})
+            backends.append(RoutedBackend(name, client, AdaptiveRateLimiter(rpm, tpm, **limiter_kwargs)))
+            continue
+        api_keys = [key.strip() for key in (backend_config.get("api_key") or "").split(",") if key.strip()]
+        if not api_keys:
+            logging.info(f"[Маршрутизатор] Бэкенд {name} пропущен: нет ключа API.")
+            continue
+        for i, api_key in enumerate(api_keys):
+            backend_name = name if len(api_keys) == 1 else f"{name}#{i + 1}"
+            client = OpenAICompatibleBackend(backend_config["base_url"], api_key, backend_config["model"], timeout)
+            backends.append(RoutedBackend(backend_name, client, AdaptiveRateLimiter(rpm, tpm, **limiter_kwargs), backend_config["model"]))
+    logging.info(f"[Маршрутизатор] Бэкенды LLM: {', '.join(backend.name for backend in backends) or 'нет'}")
+    return BackendRouter(backends, token_estimator)
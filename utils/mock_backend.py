@@ -0,0 +1,123 @@
+import re
+import time
+import random
+import hashlib
+import threading
+from collections import Counter
+
+from utils.llm_backends import BackendResponse, BackendStream
+
+RUSSIAN_WORDS = (
+    "он", "она", "тихо", "сказал", "ночь", "город", "свет", "дорога", "старый", "мастер", "внезапно",
+    "посмотрел", "улыбнулась", "ветер", "дверь", "время", "сердце", "меч", "тень", "небо", "глаза",
+    "шаг", "долго", "молча", "ответил", "вокруг", "снова", "далеко", "голос", "рука", "огонь",
+)
+CHAPTER_RE = re.compile(r"\[ТЕКУЩАЯ_ГЛАВА: (.*?)\]\n(.*?)\n\[/ТЕКУЩАЯ_ГЛАВА\]", re.DOTALL)
+TERM_RE = re.compile(r"[\u4e00-\u9fff]{2,3}")
+SUMMARY_WORDS_RE = re.compile(r"не больше (\d+) слов")
+
+
+def estimate_tokens(text):
+    """Грубая оценка токенов: иероглиф - токен, остальное - примерно 4 символа на токен."""
+    chinese_chars = sum(1 for char in text if '\u4e00' <= char <= '\u9fff')
+    return chinese_chars + (len(text) - chinese_chars) // 4
+
+
+class MockLLMBackend:
+    """
+    Детерминированная локальная имитация generate_content (без сети и без расхода квоты).
+    По виду промпта возвращает ответ в ожидаемом формате: P1 с [ПЕРЕВОД_СТАРТ] и кандидатами в глоссарий,
+    P1 'glossary_only', P2, пакет глав с [ПЕРЕВОД_ГЛАВЫ: ...], нумерованный список названий или краткое содержание.
+    Время ответа: latency + токены промпта / prompt_tokens_per_second + токены ответа / output_tokens_per_second.
+    Один и тот же промпт при одном seed всегда дает один и тот же ответ.
+    """
+
+    def __init__(self, latency=0.5, prompt_tokens_per_second=20000, output_tokens_per_second=200, seed=0):
+        self.latency = latency
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.output_tokens_per_second = output_tokens_per_second
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.prompt_tokens = Counter()
+        self.output_tokens = Counter()
+
+    def _rng(self, text):
+        digest = hashlib.md5(f"{self.seed}:{text}".encode('utf-8')).hexdigest()
+        return random.Random(int(digest[:16], 16))
+
+    def _translate(self, source_text):
+        """Псевдоперевод: по абзацу на каждый абзац оригинала, русский текст примерно в 2 раза длиннее."""
+        paragraphs = [p for p in re.split(r'\n\s*\n+', source_text) if p.strip()] or [source_text]
+        result = []
+        for paragraph in paragraphs:
+            rng = self._rng(paragraph)
+            words = []; length = 0
+            while length < max(20, len(paragraph) * 2):
+                word = rng.choice(RUSSIAN_WORDS); words.append(word); length += len(word) + 1
+            result.append(" ".join(words).capitalize() + ".")
+        return "\n\n".join(result)
+
+    def _candidates(self, source_text, limit=3):
+        """Кандидаты в глоссарий: самые частые сочетания из 2-3 иероглифов."""
+        counts = Counter(TERM_RE.findall(source_text))
+        lines = []
+        for term, _ in sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]:
+            rng = self._rng(term)
+            lines.append(f"{term}: {rng.choice(RUSSIAN_WORDS).capitalize()}-{rng.randint(1, 999)}")
+        return "\n".join(lines)
+
+    def _respond(self, prompt_text):
+        """Возвращает (вид запроса, текст ответа)."""
+        if "ОРИГИНАЛЬНЫЕ НАЗВАНИЯ ДЛЯ ПЕРЕВОДА:" in prompt_text:
+            titles_section = prompt_text.split("ОРИГИНАЛЬНЫЕ НАЗВАНИЯ ДЛЯ ПЕРЕВОДА:", 1)[1]
+            numbers = re.findall(r"^\s*(\d+)\.", titles_section, re.MULTILINE)
+            return "titles", "\n".join(f"{number}. Глава {number}" for number in numbers)
+        if "[ГЛАВА_ДЛЯ_КРАТКОГО_СОДЕРЖАНИЯ:" in prompt_text or "[КРАТКОЕ_СОДЕРЖАНИЕ_ИСТОРИИ]" in prompt_text:
+            match = SUMMARY_WORDS_RE.search(prompt_text)
+            rng = self._rng(prompt_text)
+            words = [rng.choice(RUSSIAN_WORDS) for _ in range(int(match.group(1)) if match else 100)]
+            return "summary", " ".join(words).capitalize() + "."
+        chapters = CHAPTER_RE.findall(prompt_text)
+        if "ГЛАВЫ_ДЛЯ_ПЕРЕВОДА:" in prompt_text:
+            return "pack", "\n".join(f"[ПЕРЕВОД_ГЛАВЫ: {fn}]\n{self._translate(text)}\n[/ПЕРЕВОД_ГЛАВЫ]" for fn, text in chapters)
+        source_text = chapters[-1][1] if chapters else prompt_text
+        if "[GLOSSARY_CANDIDATES_START]" in prompt_text:
+            candidates_block = f"[GLOSSARY_CANDIDATES_START]\n{self._candidates(source_text)}\n[GLOSSARY_CANDIDATES_END]"
+            if "[ПЕРЕВОД_СТАРТ]" in prompt_text:
+                return "p1", f"[ПЕРЕВОД_СТАРТ]\n{self._translate(source_text)}\n[ПЕРЕВОД_КОНЕЦ]\n\n{candidates_block}"
+            return "p1_glossary", candidates_block
+        return "p2", self._translate(source_text)
+
+    def generate_content(self, prompt_text, generation_config=None, safety_settings=None, request_options=None, stream=False):
+        kind, text = self._respond(prompt_text)
+        prompt_tokens = estimate_tokens(prompt_text); output_tokens = estimate_tokens(text)
+        with self.lock:
+            self.requests[kind] += 1
+            self.prompt_tokens[kind] += prompt_tokens
+            self.output_tokens[kind] += output_tokens
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": output_tokens, "total_tokens": prompt_tokens + output_tokens}
+        time.sleep(self.latency + prompt_tokens / self.prompt_tokens_per_second)
+        if stream:
+            return BackendStream(self._iter_stream(text, usage))
+        time.sleep(output_tokens / self.output_tokens_per_second)
+        return BackendResponse(text, "STOP", usage)
+
+    def _iter_stream(self, text, usage, chunk_chars=200):
+        """Выдает ответ фрагментами со скоростью генерации; usage_metadata - в последнем фрагменте (как у Gemini)."""
+        for i in range(0, len(text), chunk_chars):
+            chunk = text[i:i + chunk_chars]
+            time.sleep(estimate_tokens(chunk) / self.output_tokens_per_second)
+            yield BackendResponse(chunk, "STOP", usage if i + chunk_chars >= len(text) else None)
+
+    def stats(self):
+        """Статистика по видам запросов: {вид: {requests, prompt_tokens, output_tokens}}."""
+        with self.lock:
+            return {
+                kind: {
+                    "requests": self.requests[kind],
+                    "prompt_tokens": self.prompt_tokens[kind],
+                    "output_tokens": self.output_tokens[kind],
+                }
+                for kind in self.requests
+            }
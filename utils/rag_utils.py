@@ -1,7 +1,9 @@
 import logging
 import re
-import chromadb
-from chromadb.utils import embedding_functions
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import config
 import os
 from tqdm import tqdm # Для индикатора прогресса
@@ -31,6 +33,9 @@ def initialize_rag():
         return False # Инициализация не требуется и не удалась
 
     try:
+        # ChromaDB и sentence-transformers (torch) импортируются только при инициализации RAG
+        import chromadb
+        from chromadb.utils import embedding_functions
         # 1. Инициализация модели эмбеддингов
         logging.info(f"[RAG Init] Инициализация модели эмбеддингов: {config.EMBEDDING_MODEL_NAME}")
         # Создаем локальную переменную, чтобы не присваивать глобальную до успеха
@@ -82,55 +87,29 @@ def chunk_text_by_paragraph(text):
     chunks = [p.strip() for p in paragraphs if p.strip() and len(p.strip()) > 10] # Добавим минимальную длину чанка
     return chunks
 
-def index_chapter(chapter_filename, chapter_text):
-    """Индексирует одну главу в ChromaDB."""
-    # Используем глобальный флаг для проверки инициализации
-    if not rag_init_success or not collection or not config.RAG_ENABLED:
-        logging.warning(f"RAG не инициализирован или отключен, пропуск индексации главы {chapter_filename}")
-        return
-
-    logging.debug(f"Индексация главы: {chapter_filename}")
-    if config.RAG_CHUNK_STRATEGY == 'paragraph':
-        chunks = chunk_text_by_paragraph(chapter_text)
-    else:
+def chunk_chapter(chapter_text):
+    """Делит главу на фрагменты по config.RAG_CHUNK_STRATEGY."""
+    if config.RAG_CHUNK_STRATEGY != 'paragraph':
         logging.warning(f"Неизвестная стратегия чанкинга: {config.RAG_CHUNK_STRATEGY}. Используем абзацы.")
-        chunks = chunk_text_by_paragraph(chapter_text)
-
-    if not chunks:
-        logging.warning(f"Нет подходящих фрагментов (>10 симв.) для индексации в главе {chapter_filename}")
-        return
-
-    base_filename = os.path.splitext(chapter_filename)[0]
-    ids = [f"{base_filename}-chunk-{i}" for i in range(len(chunks))]
-    metadatas = [{"source_chapter": chapter_filename} for _ in range(len(chunks))]
+    return chunk_text_by_paragraph(chapter_text)
 
-    try:
-        # Проверяем, существуют ли уже ID (чтобы избежать ошибки ChromaDB)
-        existing_data = collection.get(ids=ids, include=[]) # Просто проверяем ID
-        existing_ids = set(existing_data.get('ids', []))
-
-        ids_to_add = []
-        docs_to_add = []
-        meta_to_add = []
-
-        for i, chunk_id in enumerate(ids):
-            if chunk_id not in existing_ids:
-                ids_to_add.append(chunk_id)
-                docs_to_add.append(chunks[i])
-                meta_to_add.append(metadatas[i])
-
-        if ids_to_add:
-            collection.add(documents=docs_to_add, metadatas=meta_to_add, ids=ids_to_add)
-            logging.debug(f" -> Добавлено {len(ids_to_add)} новых чанков для {chapter_filename}.")
-        else:
-            logging.debug(f" -> Все чанки для {chapter_filename} уже проиндексированы.")
-
-    except Exception as e:
-         logging.error(f"Ошибка добавления чанков для {chapter_filename} в ChromaDB: {e}")
+def get_indexed_chapters():
+    """Главы, фрагменты которых уже есть в коллекции (читает метаданные всех фрагментов - медленно на больших индексах)."""
+    indexed_chapters_set = set()
+    all_metadata = collection.get(include=['metadatas']).get('metadatas', [])
+    if all_metadata:
+        for meta in all_metadata:
+            if meta and 'source_chapter' in meta:
+                indexed_chapters_set.add(meta['source_chapter'])
+    return indexed_chapters_set
 
 
-def index_all_chapters(force_reindex=False):
-    """Индексирует все оригинальные главы."""
+def index_all_chapters(force_reindex=False, manifest=None):
+    """
+    Индексирует все оригинальные главы.
+    manifest - манифест глав (utils.chapter_manifest): проиндексированные главы берутся из него,
+    а не из метаданных всех фрагментов коллекции; метаданные читаются один раз, если манифест еще пуст.
+    """
     # Используем флаг для проверки
     if not rag_init_success or not collection or not config.RAG_ENABLED:
         logging.info("RAG не инициализирован или отключен. Индексация пропущена.")
@@ -141,6 +120,7 @@ def index_all_chapters(force_reindex=False):
         logging.warning("Принудительная переиндексация: удаляем старую коллекцию.")
         try:
             client.delete_collection(name=config.CHROMA_COLLECTION_NAME)
+            if manifest: manifest.clear_indexed()
             # Важно: После удаления нужно снова вызвать initialize_rag, чтобы пересоздать коллекцию
             if not initialize_rag():
                  logging.error("Не удалось пересоздать коллекцию после удаления для переиндексации.")
@@ -159,12 +139,14 @@ def index_all_chapters(force_reindex=False):
     # Получаем список УЖЕ проиндексированных ГЛАВ (не чанков)
     indexed_chapters_set = set()
     try:
-         # Получаем все метаданные, извлекаем уникальные имена глав
-         all_metadata = collection.get(include=['metadatas']).get('metadatas', [])
-         if all_metadata:
-              for meta in all_metadata:
-                   if meta and 'source_chapter' in meta:
-                        indexed_chapters_set.add(meta['source_chapter'])
+         indexed_chapters_set = manifest.indexed_chapters() if manifest else set()
+         if manifest and indexed_chapters_set and collection.count() == 0:
+              logging.warning("Коллекция RAG пуста, а манифест отмечает главы проиндексированными. Индексируем заново.")
+              manifest.clear_indexed(); indexed_chapters_set = set()
+         if not indexed_chapters_set and collection.count() > 0:
+              # Манифеста нет или он еще пуст: один раз читаем метаданные фрагментов
+              indexed_chapters_set = get_indexed_chapters()
+              if manifest: manifest.mark_indexed(indexed_chapters_set)
          logging.info(f"Обнаружено {len(indexed_chapters_set)} уникальных глав в индексе ChromaDB.")
     except Exception as e:
          logging.warning(f"Не удалось получить метаданные из ChromaDB: {e}")
@@ -176,17 +158,131 @@ def index_all_chapters(force_reindex=False):
         return
 
     logging.info(f"Найдено {len(chapters_to_index)} глав для индексации. Начинаем процесс...")
-    for filename in tqdm(chapters_to_index, desc="Индексация глав"):
-        filepath = os.path.join(config.ORIGINAL_CHAPTERS_DIR, filename)
-        try:
-            with open(filepath, 'r', encoding=config.INPUT_FILE_ENCODING) as f: chapter_text = f.read()
-            if chapter_text: index_chapter(filename, chapter_text)
-            else: logging.warning(f"Пропущен пустой файл: {filename}")
-        except Exception as e: logging.error(f"Ошибка чтения/индексации {filename}: {e}")
-
+    ingest_chapters(chapters_to_index, manifest)
     logging.info("Индексация глав завершена.")
 
 
+def read_chapter_chunks(filenames, chunk_queue):
+    """
+    Поток чтения: кладет в очередь (глава, [(id фрагмента, текст), ...]) по главам, в конце - None.
+    Пустая глава (или только пробелы) идет с пустым списком фрагментов - ее не придется перечитывать при следующем запуске.
+    """
+    try:
+        for filename in filenames:
+            filepath = os.path.join(config.ORIGINAL_CHAPTERS_DIR, filename)
+            try:
+                with open(filepath, 'r', encoding=config.INPUT_FILE_ENCODING) as f: chapter_text = f.read()
+            except Exception as e:
+                logging.error(f"Ошибка чтения {filename}: {e}"); continue
+            if not chapter_text.strip():
+                logging.warning(f"Пустой файл: {filename}")
+                chunk_queue.put((filename, [])); continue
+            base_filename = os.path.splitext(filename)[0]
+            chunks = chunk_chapter(chapter_text)
+            if not chunks:
+                logging.warning(f"Нет подходящих фрагментов (>10 симв.) для индексации в главе {filename}")
+            chunk_queue.put((filename, [(f"{base_filename}-chunk-{i}", chunk) for i, chunk in enumerate(chunks)]))
+    finally:
+        chunk_queue.put(None)
+
+
+def ingest_chapters(filenames, manifest=None, batch_size=None):
+    """
+    Индексирует главы потоком фрагментов: фрагменты многих глав собираются в пакеты по batch_size
+    (config.RAG_EMBED_BATCH_SIZE), на пакет - одна проверка существующих id, одно кодирование моделью
+    эмбеддингов и одна запись в ChromaDB. Чтение файлов (отдельный поток), кодирование и запись
+    (отдельный поток) идут параллельно. Глава отмечается в манифесте, когда записаны все ее фрагменты.
+    Возвращает число записанных фрагментов.
+    """
+    batch_size = max(1, batch_size or config.RAG_EMBED_BATCH_SIZE)
+    chunk_queue = queue.Queue(maxsize=config.RAG_READ_AHEAD_CHAPTERS)
+    reader = threading.Thread(target=read_chapter_chunks, args=(filenames, chunk_queue), name="rag-reader", daemon=True)
+    reader.start()
+
+    remaining = {} # Глава -> сколько ее фрагментов еще не записано
+    failed = set()
+    written = 0; skipped = 0; chapters_done = 0
+    start = time.time()
+    progress = tqdm(desc="Индексация (фрагменты)", unit="фрагм")
+
+    def complete_batch(batch, future):
+        """Дожидается записи пакета и отмечает в манифесте главы, все фрагменты которых записаны."""
+        nonlocal written
+        try:
+            written += future.result() if future else 0
+        except Exception as e:
+            logging.error(f"Ошибка записи пакета фрагментов в ChromaDB: {e}")
+            failed.update(filename for filename, _, _ in batch)
+        done = []
+        for filename, _, _ in batch:
+            remaining[filename] -= 1
+            if remaining[filename] == 0:
+                del remaining[filename]
+                if filename not in failed: done.append(filename)
+        finish_chapters(done)
+        progress.update(len(batch))
+
+    def finish_chapters(done):
+        nonlocal chapters_done
+        if done:
+            chapters_done += len(done)
+            if manifest: manifest.mark_indexed(done)
+            progress.set_postfix(главы=chapters_done)
+
+    def write_batch(ids, documents, metadatas, embeddings):
+        collection.add(ids=ids, documents=documents, metadatas=metadatas, embeddings=embeddings)
+        return len(ids)
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="rag-writer") as writer:
+        pending_write = None # (пакет, future) - запись предыдущего пакета идет во время кодирования следующего
+
+        def flush(batch):
+            nonlocal pending_write, skipped
+            future = None
+            try:
+                existing_ids = set(collection.get(ids=[chunk_id for _, chunk_id, _ in batch], include=[]).get('ids', []))
+                new_items = [item for item in batch if item[1] not in existing_ids]
+                skipped += len(batch) - len(new_items)
+                if new_items:
+                    documents = [text for _, _, text in new_items]
+                    embeddings = embedding_function(documents)
+                    future = writer.submit(write_batch, [chunk_id for _, chunk_id, _ in new_items], documents,
+                                           [{"source_chapter": filename} for filename, _, _ in new_items], embeddings)
+            except Exception as e:
+                logging.error(f"Ошибка кодирования пакета фрагментов: {e}")
+                failed.update(filename for filename, _, _ in batch)
+            if pending_write:
+                complete_batch(*pending_write)
+            pending_write = (batch, future)
+
+        batch = []
+        while True:
+            item = chunk_queue.get()
+            if item is None:
+                break
+            filename, chunks = item
+            if not chunks:
+                finish_chapters([filename]) # Индексировать нечего - глава считается проиндексированной
+                continue
+            remaining[filename] = len(chunks)
+            for chunk_id, text in chunks:
+                batch.append((filename, chunk_id, text))
+                if len(batch) >= batch_size:
+                    flush(batch); batch = []
+        if batch:
+            flush(batch)
+        if pending_write:
+            complete_batch(*pending_write)
+    progress.close()
+
+    elapsed = time.time() - start
+    logging.info(f"Индексация: записано {written} фрагментов (уже были в индексе: {skipped}) из {chapters_done} глав "
+                 f"за {elapsed:.1f} с ({(written + skipped) / elapsed if elapsed else 0.0:.1f} фрагм/с, пакет {batch_size}).")
+    if failed:
+        logging.warning(f"Главы с ошибками индексации (будут проиндексированы при следующем запуске): {sorted(failed)}")
+    return written
+
+
 def find_relevant_chunks(query_text, num_results=5, exclude_chapter=None):
     """Находит наиболее релевантные чанки в БД для заданного текста."""
     global collection, rag_init_success # Убедимся, что флаг проверяется
@@ -197,7 +293,10 @@ def find_relevant_chunks(query_text, num_results=5, exclude_chapter=None):
     logging.debug(f"Поиск {num_results} RAG чанков для: '{query_text[:100]}...'")
     try:
         where_filter = None
-        if exclude_chapter:
+        if isinstance(exclude_chapter, (list, tuple)) and exclude_chapter:
+             where_filter = {"source_chapter": {"$nin": list(exclude_chapter)}}
+             logging.debug(f"Исключаем чанки из глав: {exclude_chapter}")
+        elif exclude_chapter:
              where_filter = {"source_chapter": {"$ne": exclude_chapter}}
              logging.debug(f"Исключаем чанки из главы: {exclude_chapter}")
 
@@ -0,0 +1,136 @@
+import time
+import random
+import logging
+import threading
+
+
+class AdaptiveRateLimiter:
+    """
+    Общий для процесса ограничитель запросов к API (token bucket + AIMD).
+    Следит сразу за двумя квотами: запросы в минуту (RPM) и токены в минуту (TPM).
+    - acquire() блокирует поток, пока в обоих "ведрах" не хватит места для запроса.
+    - on_rate_limited() при ответе 429 резко снижает текущую скорость (умножением)
+      и вводит паузу с джиттером для всех потоков.
+    - on_success() после серии успешных запросов плавно (сложением) возвращает скорость к лимиту.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, decrease_factor=0.5,
+                 increase_after=10, increase_step=0.05, min_fraction=0.1,
+                 cooldown_seconds=5.0, jitter=0.2, initial_burst=None):
+        self.max_rpm = float(requests_per_minute)
+        self.max_tpm = float(tokens_per_minute)
+        self.decrease_factor = decrease_factor
+        self.increase_after = increase_after
+        self.increase_step = increase_step # Доля от максимального лимита, добавляемая за один шаг
+        self.min_fraction = min_fraction
+        self.cooldown_seconds = cooldown_seconds
+        self.jitter = jitter
+
+        self.rate_fraction = 1.0 # Текущая доля от лимитов (AIMD регулирует именно ее)
+        # Стартовый запас запросов: первые initial_burst запросов уходят без ожидания (не больше минутной квоты).
+        # По умолчанию - один запрос, чтобы не было всплеска на старте
+        self.request_allowance = min(self.max_rpm, float(initial_burst or 1))
+        self.token_allowance = self.max_tpm
+        self.last_refill = time.monotonic()
+        self.cooldown_until = 0.0
+        self.consecutive_successes = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        """Пополняет оба ведра пропорционально прошедшему времени (вызывать под lock)."""
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if elapsed <= 0:
+            return
+        rpm = self.max_rpm * self.rate_fraction
+        tpm = self.max_tpm * self.rate_fraction
+        # Емкость ведра - минутная квота, чтобы после простоя не отправить лишнего
+        self.request_allowance = min(rpm, self.request_allowance + elapsed * rpm / 60.0)
+        self.token_allowance = min(tpm, self.token_allowance + elapsed * tpm / 60.0)
+
+    def _with_jitter(self, seconds):
+        return seconds * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _try_acquire_locked(self, tokens):
+        """Списывает квоту, если запрос укладывается в RPM/TPM. Возвращает 0.0 или время до освобождения квоты (под lock)."""
+        now = time.monotonic()
+        self._refill(now)
+        # Запрос больше всей минутной квоты все равно пропускаем при полном ведре
+        needed_tokens = min(float(tokens), self.max_tpm * self.rate_fraction)
+        if now >= self.cooldown_until and self.request_allowance >= 1.0 and self.token_allowance >= needed_tokens:
+            self.request_allowance -= 1.0
+            self.token_allowance -= needed_tokens
+            return 0.0
+        wait_time = max(0.0, self.cooldown_until - now)
+        rpm = self.max_rpm * self.rate_fraction
+        tpm = self.max_tpm * self.rate_fraction
+        if self.request_allowance < 1.0:
+            wait_time = max(wait_time, (1.0 - self.request_allowance) * 60.0 / rpm)
+        if self.token_allowance < needed_tokens:
+            wait_time = max(wait_time, (needed_tokens - self.token_allowance) * 60.0 / tpm)
+        return max(wait_time, 0.01)
+
+    def try_acquire(self, tokens=0):
+        """
+        Неблокирующая попытка списать квоту под запрос размером tokens.
+        Возвращает (True, 0.0) при успехе или (False, сколько примерно ждать в секундах).
+        """
+        with self.lock:
+            wait_time = self._try_acquire_locked(tokens)
+        return wait_time == 0.0, wait_time
+
+    def acquire(self, tokens=0):
+        """
+        Ждет, пока запрос размером tokens не уложится в RPM/TPM, и списывает квоту.
+        Возвращает время ожидания в секундах.
+        """
+        waited = 0.0
+        while True:
+            acquired, wait_time = self.try_acquire(tokens)
+            if acquired:
+                return waited
+            wait_time = self._with_jitter(wait_time)
+            logging.debug(f"[RateLimiter] Ожидание {wait_time:.2f} сек. (RPM={self.max_rpm * self.rate_fraction:.1f}, TPM={self.max_tpm * self.rate_fraction:.0f})")
+            time.sleep(wait_time)
+            waited += wait_time
+
+    def on_success(self):
+        """Успешный запрос: после серии успехов аддитивно повышаем скорость."""
+        with self.lock:
+            self.consecutive_successes += 1
+            if self.consecutive_successes >= self.increase_after and self.rate_fraction < 1.0:
+                self.rate_fraction = min(1.0, self.rate_fraction + self.increase_step)
+                self.consecutive_successes = 0
+                logging.debug(f"[RateLimiter] Скорость повышена до {self.rate_fraction:.0%} от лимита.")
+
+    def on_rate_limited(self):
+        """Ответ 429: мультипликативно снижаем скорость и делаем общую паузу."""
+        with self.lock:
+            self.consecutive_successes = 0
+            self.rate_fraction = max(self.min_fraction, self.rate_fraction * self.decrease_factor)
+            now = time.monotonic()
+            self._refill(now)
+            self.request_allowance = min(self.request_allowance, 0.0)
+            self.cooldown_until = max(self.cooldown_until, now + self._with_jitter(self.cooldown_seconds))
+            logging.warning(f"[RateLimiter] Получен 429: скорость снижена до {self.rate_fraction:.0%} от лимита "
+                            f"(RPM={self.max_rpm * self.rate_fraction:.1f}), пауза {self.cooldown_until - now:.1f} сек.")
+
+
+class UnlimitedRateLimiter:
+    """
+    Ограничитель с тем же интерфейсом, который ничего не ограничивает: используется вместо общего,
+    когда квоту уже учитывает другой слой (маршрутизатор бэкендов со своими AdaptiveRateLimiter),
+    чтобы 429 и скорость регулировал один ограничитель, а не два вложенных.
+    """
+
+    def try_acquire(self, tokens=0):
+        return True, 0.0
+
+    def acquire(self, tokens=0):
+        return 0.0
+
+    def on_success(self):
+        pass
+
+    def on_rate_limited(self):
+        pass
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+
+def make_cache_key(model_name, generation_config, prompt_text):
+    """Ключ кэша: хэш от модели, параметров генерации и текста промпта."""
+    payload = json.dumps(
+        {"model": model_name, "generation_config": generation_config, "prompt": prompt_text},
+        ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Локальный кэш ответов API в SQLite (адресация по содержимому запроса).
+    При превышении max_bytes удаляются записи, к которым дольше всего не обращались.
+    Размер кэша ведется счетчиком (total_bytes), полный подсчет по таблице - только при открытии и перед вытеснением.
+    """
+
+    def __init__(self, db_path, max_bytes):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+        self.conn.commit()
+        self.total_bytes = self._count_bytes()
+
+    def _count_bytes(self):
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _entry_size(self, key):
+        """Размер записи в байтах (0 - записи нет)."""
+        row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def get(self, key):
+        """Возвращает сохраненный ответ или None."""
+        return self.get_first([key])[1]
+
+    def get_first(self, keys):
+        """
+        Первый по порядку ключ с сохраненным ответом (например, ключи одного промпта для разных моделей):
+        (ключ, ответ) или (None, None). Считается одним обращением к кэшу.
+        """
+        with self.lock:
+            for key in keys:
+                row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.hits += 1
+                    self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                    self.conn.commit()
+                    return key, row[0]
+            self.misses += 1
+            return None, None
+
+    def put(self, key, response_text):
+        """Сохраняет ответ и при необходимости вытесняет старые записи."""
+        size = len(response_text.encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            replaced_size = self._entry_size(key)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, response_text, size, now, now)
+            )
+            self.total_bytes += size - replaced_size
+            self._evict()
+            self.conn.commit()
+
+    def invalidate(self, key):
+        """Удаляет запись (например, если ответ оказался браком)."""
+        with self.lock:
+            self.total_bytes -= self._entry_size(key)
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def _evict(self):
+        """Удаляет давно не использованные записи, пока кэш не станет меньше ~90% лимита (под lock)."""
+        if self.total_bytes <= self.max_bytes:
+            return
+        # Счетчик мог разойтись с таблицей (кэш общий с другим процессом): перед вытеснением считаем точно
+        total = self.total_bytes = self._count_bytes()
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall()
+        for key, size in rows:
+            if total <= target:
+                break
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        self.total_bytes = total
+        logging.info(f"[Кэш API] Вытеснено {evicted} записей, размер {total / 1024 / 1024:.1f} МБ.")
+
+    def stats(self):
+        """Статистика: попадания, промахи, число записей и размер в байтах."""
+        with self.lock:
+            count, total = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": count,
+            "size_bytes": total,
+        }
@@ -0,0 +1,74 @@
+import threading
+from collections import Counter
+
+
+class RetryStats:
+    """
+    Статистика пути повторов запросов к API:
+    попытки и неудачные попытки по видам, время пауз между попытками и ожидания ограничителя скорости,
+    ответы, отброшенные как брак (лишние запросы), и задержка восстановления - время от первой неудачи
+    в вызове до успешного ответа.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.attempts = 0
+        self.failures = Counter()
+        self.backoff_seconds = 0.0
+        self.limiter_wait_seconds = 0.0
+        self.recovered = 0
+        self.gave_up = 0
+        self.rejected = 0
+        self.recovery_latencies = []
+
+    def on_attempt(self):
+        with self.lock:
+            self.attempts += 1
+
+    def on_failure(self, kind):
+        """Неудачная попытка: kind - 'rate_limit', 'timeout', 'empty' (в том числе обрезанный по MAX_TOKENS ответ), 'blocked', 'invalid_argument', 'error'."""
+        with self.lock:
+            self.failures[kind] += 1
+
+    def on_backoff(self, seconds):
+        with self.lock:
+            self.backoff_seconds += seconds
+
+    def on_limiter_wait(self, seconds):
+        with self.lock:
+            self.limiter_wait_seconds += seconds
+
+    def on_rejected(self):
+        """Ответ получен, но отброшен как брак (запрос потрачен впустую)."""
+        with self.lock:
+            self.rejected += 1
+
+    def on_call_finished(self, success, recovery_seconds=None):
+        """Конец вызова; recovery_seconds - время от первой неудачи до успеха (None - неудач не было)."""
+        with self.lock:
+            self.calls += 1
+            if not success:
+                self.gave_up += 1
+            elif recovery_seconds is not None:
+                self.recovered += 1
+                self.recovery_latencies.append(recovery_seconds)
+
+    def summary(self):
+        """Сводка в виде словаря (для лога и отчета бенчмарка)."""
+        with self.lock:
+            latencies = sorted(self.recovery_latencies)
+            failed_attempts = sum(self.failures.values())
+            return {
+                "calls": self.calls,
+                "attempts": self.attempts,
+                "failures": dict(self.failures),
+                "wasted_requests": failed_attempts + self.rejected,
+                "rejected_responses": self.rejected,
+                "backoff_seconds": self.backoff_seconds,
+                "limiter_wait_seconds": self.limiter_wait_seconds,
+                "recovered_calls": self.recovered,
+                "failed_calls": self.gave_up,
+                "recovery_mean_seconds": sum(latencies) / len(latencies) if latencies else 0.0,
+                "recovery_max_seconds": latencies[-1] if latencies else 0.0,
+            }
@@ -0,0 +1,79 @@
+import time
+import threading
+from collections import Counter, deque
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по отсортированному списку (ближайший ранг); 0.0 для пустого списка."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class ServiceMetrics:
+    """
+    Метрики HTTP-сервиса перевода: запросы по статусам, запросы в работе и в очереди,
+    задержка (среднее и перцентили по последним window запросам) и пропускная способность с момента запуска.
+    """
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.statuses = Counter()
+        self.in_flight = 0
+        self.queued = 0
+        self.latencies = deque(maxlen=window)
+        self.source_chars = 0
+        self.translated_chars = 0
+
+    def try_enqueue(self, max_queue):
+        """Ставит запрос в очередь, если в ней меньше max_queue запросов (проверка и учет под одной блокировкой)."""
+        with self.lock:
+            if self.queued >= max_queue:
+                return False
+            self.queued += 1
+            return True
+
+    def on_started(self):
+        with self.lock:
+            self.queued -= 1
+            self.in_flight += 1
+
+    def on_rejected(self, status):
+        """Запрос отклонен до перевода (неверный запрос, очередь заполнена)."""
+        with self.lock:
+            self.statuses[status] += 1
+
+    def on_finished(self, status, seconds, source_chars, translated_chars):
+        with self.lock:
+            self.in_flight -= 1
+            self.statuses[status] += 1
+            self.latencies.append(seconds)
+            self.source_chars += source_chars
+            self.translated_chars += translated_chars
+
+    def summary(self):
+        with self.lock:
+            uptime = time.time() - self.started
+            latencies = sorted(self.latencies)
+            completed = self.statuses.get("ok", 0)
+            return {
+                "uptime_seconds": uptime,
+                "requests": dict(self.statuses),
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "latency_seconds": {
+                    "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+                    "p50": percentile(latencies, 0.5),
+                    "p90": percentile(latencies, 0.9),
+                    "p99": percentile(latencies, 0.99),
+                    "max": latencies[-1] if latencies else 0.0,
+                    "window": len(latencies),
+                },
+                "throughput": {
+                    "translations_per_minute": completed / uptime * 60 if uptime else 0.0,
+                    "source_chars_per_second": self.source_chars / uptime if uptime else 0.0,
+                    "translated_chars_per_second": self.translated_chars / uptime if uptime else 0.0,
+                },
+            }
@@ -0,0 +1,53 @@
+import os
+import time
+import sqlite3
+import threading
+
+# Виды записей: краткое содержание одной главы и накопленное содержание истории по эту главу включительно
+KIND_CHAPTER = "chapter"
+KIND_STORY = "story"
+
+
+class SummaryStore:
+    """
+    Хранилище кратких содержаний в SQLite: по главам и накопленное содержание истории.
+    Для каждой главы есть свой lock (lock_for), чтобы параллельные задачи не запрашивали
+    одно и то же содержание дважды.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.chapter_locks = {}
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            " kind TEXT NOT NULL, filename TEXT NOT NULL, summary TEXT NOT NULL, created REAL NOT NULL,"
+            " PRIMARY KEY (kind, filename))"
+        )
+        self.conn.commit()
+
+    def lock_for(self, kind, filename):
+        with self.lock:
+            return self.chapter_locks.setdefault((kind, filename), threading.Lock())
+
+    def get(self, kind, filename):
+        with self.lock:
+            row = self.conn.execute("SELECT summary FROM summaries WHERE kind = ? AND filename = ?", (kind, filename)).fetchone()
+        return row[0] if row else None
+
+    def put(self, kind, filename, summary):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO summaries (kind, filename, summary, created) VALUES (?, ?, ?, ?)",
+                (kind, filename, summary, time.time())
+            )
+            self.conn.commit()
+
+    def filenames(self, kind):
+        """Главы, для которых есть запись данного вида."""
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT filename FROM summaries WHERE kind = ?", (kind,))}
@@ -0,0 +1,141 @@
+import os
+import json
+import logging
+import threading
+from collections import Counter
+
+# Классы символов и начальные оценки (токенов на символ) для токенизатора Gemini
+CHAR_CLASSES = ("cjk", "cyrillic", "latin", "whitespace", "other")
+DEFAULT_RATIOS = {"cjk": 0.7, "cyrillic": 0.3, "latin": 0.25, "whitespace": 0.15, "other": 0.5}
+
+
+def classify_char(char):
+    """Класс символа: иероглифы и полноширинная пунктуация, кириллица, латиница, пробелы, прочее."""
+    if '\u4e00' <= char <= '\u9fff' or '\u3400' <= char <= '\u4dbf' or '\u3000' <= char <= '\u303f' or '\uff00' <= char <= '\uffef':
+        return "cjk"
+    if '\u0400' <= char <= '\u04ff':
+        return "cyrillic"
+    if char.isspace():
+        return "whitespace"
+    if char.isascii() and char.isalpha() or '\u00c0' <= char <= '\u024f':
+        return "latin"
+    return "other"
+
+
+def solve_linear_system(matrix, vector):
+    """Решает квадратную систему методом Гаусса с выбором главного элемента (None, если вырождена)."""
+    size = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(size)]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            return None
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(size):
+            if r != col:
+                factor = rows[r][col] / rows[col][col]
+                rows[r] = [a - factor * b for a, b in zip(rows[r], rows[col])]
+    return [rows[i][size] / rows[i][i] for i in range(size)]
+
+
+class TokenEstimator:
+    """
+    Быстрая оценка числа токенов без BPE-кодирования: за один проход по тексту считаются символы
+    по классам (CHAR_CLASSES), оценка - сумма (символов класса * токенов на символ класса).
+    Коэффициенты калибруются по реальному prompt_token_count из ответов API (гребневая регрессия
+    с притяжением к DEFAULT_RATIOS, вес которых равен prior_samples наблюдениям) и хранятся в calibration_file.
+    """
+
+    def __init__(self, calibration_file=None, prior_samples=20, save_every=10):
+        self.calibration_file = calibration_file
+        self.prior_samples = prior_samples
+        self.save_every = save_every
+        self.lock = threading.Lock()
+        self.char_classes = {} # Кэш классов уже встреченных символов
+        self.ratios = dict(DEFAULT_RATIOS)
+        size = len(CHAR_CLASSES)
+        # Накопленные X^T X и X^T y по наблюдениям (X - символы по классам, y - реальные токены)
+        self.xtx = [[0.0] * size for _ in range(size)]
+        self.xty = [0.0] * size
+        self.samples = 0
+        self.unsaved = 0
+        self._load()
+
+    def _load(self):
+        if not self.calibration_file or not os.path.exists(self.calibration_file):
+            return
+        try:
+            with open(self.calibration_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.xtx = data["xtx"]; self.xty = data["xty"]; self.samples = data["samples"]
+            self.ratios.update(data.get("ratios", {}))
+            logging.info(f"[Токены] Калибровка загружена ({self.samples} наблюдений): "
+                         + ", ".join(f"{name} {ratio:.3f}" for name, ratio in self.ratios.items()))
+        except Exception as e:
+            logging.warning(f"[Токены] Не удалось загрузить калибровку {self.calibration_file}: {e}. Используются коэффициенты по умолчанию.")
+
+    def save(self):
+        """Сохраняет калибровку на диск."""
+        if not self.calibration_file:
+            return
+        with self.lock:
+            data = {"ratios": self.ratios, "xtx": self.xtx, "xty": self.xty, "samples": self.samples}
+            self.unsaved = 0
+        try:
+            calibration_dir = os.path.dirname(self.calibration_file)
+            if calibration_dir and not os.path.exists(calibration_dir):
+                os.makedirs(calibration_dir)
+            tmp_path = self.calibration_file + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.calibration_file)
+        except Exception as e:
+            logging.warning(f"[Токены] Не удалось сохранить калибровку: {e}")
+
+    def class_counts(self, text):
+        """Число символов каждого класса: кортеж в порядке CHAR_CLASSES."""
+        counts = dict.fromkeys(CHAR_CLASSES, 0)
+        for char, count in Counter(text).items(): # Подсчет символов - один проход на C
+            char_class = self.char_classes.get(char)
+            if char_class is None:
+                char_class = self.char_classes[char] = classify_char(char)
+            counts[char_class] += count
+        return tuple(counts[name] for name in CHAR_CLASSES)
+
+    def estimate_counts(self, counts):
+        """Оценка токенов по числу символов классов."""
+        return int(round(sum(count * self.ratios[name] for name, count in zip(CHAR_CLASSES, counts))))
+
+    def estimate(self, text):
+        """Оценка числа токенов в тексте."""
+        return self.estimate_counts(self.class_counts(text)) if text else 0
+
+    def observe(self, counts, actual_tokens):
+        """Добавляет наблюдение (символы по классам, реальное число токенов) и пересчитывает коэффициенты."""
+        if actual_tokens <= 0 or not any(counts):
+            return
+        with self.lock:
+            for i, count_i in enumerate(counts):
+                self.xty[i] += count_i * actual_tokens
+                for j, count_j in enumerate(counts):
+                    self.xtx[i][j] += count_i * count_j
+            self.samples += 1
+            self.unsaved += 1
+            self._refit()
+            should_save = self.unsaved >= self.save_every
+        if should_save:
+            self.save()
+
+    def _refit(self):
+        """Пересчитывает коэффициенты (под lock): (X^T X + λI) r = X^T y + λ r0."""
+        size = len(CHAR_CLASSES)
+        strength = self.prior_samples * sum(self.xtx[i][i] for i in range(size)) / size / self.samples
+        matrix = [[self.xtx[i][j] + (strength if i == j else 0.0) for j in range(size)] for i in range(size)]
+        vector = [self.xty[i] + strength * DEFAULT_RATIOS[name] for i, name in enumerate(CHAR_CLASSES)]
+        solution = solve_linear_system(matrix, vector)
+        if solution is None:
+            return
+        # Отрицательные коэффициенты бессмысленны: такой класс остается с прежней оценкой
+        for name, ratio in zip(CHAR_CLASSES, solution):
+            if ratio > 0:
+                self.ratios[name] = ratio
@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+
+class TokenCounter:
+    """
+    Подсчет токенов с мемоизацией по хэшу содержимого.
+    Одни и те же строки (глоссарий, предыдущие главы, шаблоны промптов) кодируются один раз,
+    сколько бы раз они ни попадали в промпты P1/P2. Хвост текста кодируется без кодирования всей главы.
+    С estimator (utils.token_estimator.TokenEstimator) токены оцениваются по классам символов без кодирования,
+    а полное кодирование токенизатором выполняется только для проверок у границы бюджета (refine_near_budget).
+    """
+
+    def __init__(self, tokenizer, max_entries=4096, estimator=None, exact_margin=0.1):
+        self.tokenizer = tokenizer
+        self.estimator = estimator
+        self.exact_margin = exact_margin
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(text, extra=None):
+        digest = hashlib.blake2b(text.encode('utf-8', errors='ignore'), digest_size=16).digest()
+        return (len(text), digest, extra)
+
+    def _get(self, key):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key]
+            self.misses += 1
+            return None
+
+    def _put(self, key, value):
+        with self.lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+
+    def count(self, text):
+        """Подсчитывает токены в тексте (примерно)."""
+        if not text:
+            return 0
+        if self.estimator:
+            return self.estimator.estimate_counts(self.class_counts(text))
+        return self.count_exact(text)
+
+    def class_counts(self, text):
+        """Число символов по классам оценщика (мемоизируется)."""
+        key = self._key(text, 'classes')
+        cached = self._get(key)
+        if cached is None:
+            cached = self.estimator.class_counts(text)
+            self._put(key, cached)
+        return cached
+
+    def count_exact(self, text):
+        """Подсчет токенов полным кодированием токенизатором (без токенизатора - грубая оценка)."""
+        if not text:
+            return 0
+        if not self.tokenizer:
+            return len(text) // 3 # Грубая оценка
+        key = self._key(text, 'exact')
+        cached = self._get(key)
+        if cached is not None:
+            return cached
+        try:
+            result = len(self.tokenizer.encode(text))
+        except Exception as e:
+            logging.warning(f"Ошибка tiktoken.encode: {e}. Возвращаем оценку.")
+            result = len(text) // 3
+        self._put(key, result)
+        return result
+
+    def refine_near_budget(self, estimate, budget, *texts):
+        """
+        Уточняет оценку у границы бюджета: если estimate ближе exact_margin к budget (или больше него),
+        тексты кодируются полностью и возвращается большее из двух значений. Иначе возвращается estimate.
+        """
+        if not self.estimator or not self.tokenizer or estimate < budget * (1 - self.exact_margin):
+            return estimate
+        return max(estimate, sum(self.count_exact(text) for text in texts))
+
+    def observe(self, texts, actual_tokens):
+        """Калибровка оценщика: тексты промпта и реальное число токенов из ответа API."""
+        if not self.estimator:
+            return
+        counts = [self.class_counts(text) for text in texts if text]
+        self.estimator.observe(tuple(map(sum, zip(*counts))), actual_tokens)
+
+    def last_n_tokens(self, text, n_tokens):
+        """
+        Возвращает примерно последние N токенов текста.
+        С оценщиком хвост отрезается по средней плотности токенов в тексте; иначе кодируется
+        только хвост текста (окно удваивается, если токенов в нем не хватило).
+        """
+        if self.estimator and n_tokens > 0:
+            total_tokens = self.count(text)
+            if total_tokens <= n_tokens:
+                return text
+            # Не меньше одного символа: text[-0:] вернул бы весь текст
+            return text[-max(1, int(len(text) * n_tokens / total_tokens)):]
+        if not self.tokenizer or n_tokens <= 0:
+            estimated_chars = n_tokens * 4
+            return text[-estimated_chars:] if estimated_chars > 0 else ""
+        key = self._key(text, n_tokens)
+        cached = self._get(key)
+        if cached is not None:
+            return cached
+        try:
+            window = n_tokens * 4 # В одном токене редко больше ~4 символов
+            while True:
+                tail_text = text[-window:]
+                tokens = self.tokenizer.encode(tail_text)
+                if len(tokens) > n_tokens:
+                    # Первый токен окна мог быть разрезан границей окна, поэтому берем строго N последних
+                    result = self.tokenizer.decode(tokens[-n_tokens:], errors='ignore')
+                    break
+                if window >= len(text):
+                    result = text # Весь текст короче N токенов
+                    break
+                window *= 2
+        except Exception as e:
+            logging.warning(f"Ошибка get_last_n_tokens: {e}. Возвращаем срез.")
+            result = text[-n_tokens * 4:]
+        self._put(key, result)
+        return result
@@ -0,0 +1,130 @@
+import os
+import time
+import sqlite3
+import threading
+
+# Проход, к которому относятся лишние запросы (повторы после сбоев и ответы, отброшенные как брак)
+RETRY_PASS = "retries"
+
+
+def get_usage_counts(response):
+    """
+    Токены из usage_metadata ответа: (промпт, ответ, из кэша контекста).
+    Для потокового ответа usage_metadata доступно после чтения потока; если данных нет - нули.
+    """
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return 0, 0, 0
+    return (getattr(usage, 'prompt_token_count', 0) or 0,
+            getattr(usage, 'candidates_token_count', 0) or 0,
+            getattr(usage, 'cached_content_token_count', 0) or 0)
+
+
+def estimate_cost(prices, model, prompt_tokens, candidates_tokens, cached_tokens):
+    """
+    Стоимость по ценам за миллион токенов: prices[model] или prices['*'] -
+    {'input': ..., 'output': ..., 'cached_input': ...}. Токены из кэша контекста входят в prompt_tokens,
+    но оплачиваются по цене cached_input.
+    """
+    model_prices = prices.get(model) or prices.get('*') or {}
+    input_price = model_prices.get('input', 0.0)
+    cached_price = model_prices.get('cached_input', input_price)
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price
+            + candidates_tokens * model_prices.get('output', 0.0)) / 1000000
+
+
+class UsageLedger:
+    """
+    Журнал расхода квоты API в SQLite: строка на каждую попытку запроса.
+    Хранит имя запроса (глава, сегмент *_segNN или пакет *_packN) и главы, к которым он относится
+    (source_chapter: исходная глава сегмента или список глав пакета), проход (p1, p1_glossary, p2, pack_p1, pack_p2, titles), номер попытки, исход
+    ('ok', 'empty', 'blocked', 'aborted', 'rate_limit', 'timeout', 'error', 'rejected'),
+    токены из usage_metadata ответа (промпт, ответ, из кэша контекста), оценку токенов промпта
+    локальным токенизатором и время ответа.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, created REAL NOT NULL, chapter TEXT, pass TEXT NOT NULL,"
+            " model TEXT, request_key TEXT, attempt INTEGER NOT NULL, outcome TEXT NOT NULL,"
+            " prompt_tokens INTEGER NOT NULL, candidates_tokens INTEGER NOT NULL, cached_tokens INTEGER NOT NULL,"
+            " estimated_prompt_tokens INTEGER NOT NULL, latency REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(usage)")}
+        if "source_chapter" not in columns: # Журнал прежней версии
+            self.conn.execute("ALTER TABLE usage ADD COLUMN source_chapter TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_chapter ON usage(chapter)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_request_key ON usage(request_key)")
+        self.conn.commit()
+
+    def record(self, chapter, pass_name, model, request_key, attempt, outcome, usage_counts, estimated_prompt_tokens, latency,
+               source_chapter=None):
+        """
+        Записывает попытку запроса; usage_counts - результат get_usage_counts.
+        source_chapter - глава (или главы через запятую), к которой относится запрос; None - сама chapter.
+        """
+        prompt_tokens, candidates_tokens, cached_tokens = usage_counts
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO usage (created, chapter, source_chapter, pass, model, request_key, attempt, outcome, prompt_tokens,"
+                " candidates_tokens, cached_tokens, estimated_prompt_tokens, latency) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), chapter, source_chapter or chapter, pass_name, model, request_key, attempt, outcome, prompt_tokens,
+                 candidates_tokens, cached_tokens, estimated_prompt_tokens, latency)
+            )
+            self.conn.commit()
+
+    def mark_rejected(self, request_key):
+        """Помечает последний успешный ответ на запрос как брак (квота на него потрачена впустую)."""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE usage SET outcome = 'rejected' WHERE id = ("
+                " SELECT MAX(id) FROM usage WHERE request_key = ? AND outcome = 'ok')",
+                (request_key,)
+            )
+            self.conn.commit()
+
+    def _totals(self, group_by, prices):
+        """
+        Суммы по группам: {группа: {requests, prompt_tokens, candidates_tokens, cached_tokens,
+        estimated_prompt_tokens, seconds, cost}}. Стоимость считается по ценам модели (см. estimate_cost).
+        """
+        rows = self.conn.execute(
+            f"SELECT {group_by}, model, COUNT(*), SUM(prompt_tokens), SUM(candidates_tokens), SUM(cached_tokens),"
+            f" SUM(estimated_prompt_tokens), SUM(latency) FROM usage GROUP BY 1, 2 ORDER BY 1"
+        ).fetchall()
+        totals = {}
+        for group, model, requests, prompt_tokens, candidates_tokens, cached_tokens, estimated_tokens, seconds in rows:
+            group_totals = totals.setdefault(group, {"requests": 0, "prompt_tokens": 0, "candidates_tokens": 0, "cached_tokens": 0,
+                                                     "estimated_prompt_tokens": 0, "seconds": 0.0, "cost": 0.0})
+            group_totals["requests"] += requests
+            group_totals["prompt_tokens"] += prompt_tokens
+            group_totals["candidates_tokens"] += candidates_tokens
+            group_totals["cached_tokens"] += cached_tokens
+            group_totals["estimated_prompt_tokens"] += estimated_tokens
+            group_totals["seconds"] += seconds
+            group_totals["cost"] += estimate_cost(prices, model, prompt_tokens, candidates_tokens, cached_tokens)
+        return totals
+
+    def summary(self, prices=None):
+        """
+        Сводка журнала: {'chapters': суммы по главам (сегменты - в своей главе, пакет - одной строкой со списком глав),
+        'passes': суммы по проходам}.
+        В 'passes' удачные попытки учитываются в своем проходе, а неудачные попытки и брак - в RETRY_PASS.
+        prices - цены за миллион токенов (config.USAGE_PRICES_PER_MILLION).
+        """
+        prices = prices or {}
+        with self.lock:
+            chapters = self._totals("COALESCE(source_chapter, chapter, '-')", prices)
+            passes = self._totals(f"CASE WHEN outcome != 'ok' THEN '{RETRY_PASS}' ELSE pass END", prices)
+        return {"chapters": chapters, "passes": passes}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()